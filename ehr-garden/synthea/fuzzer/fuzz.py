@@ -1,39 +1,68 @@
 import os
 import json
 import stat
+import random
+import time
 import tempfile
+import functools
+import threading
+import multiprocessing
 from argparse import Namespace
-from pyjfuzz.lib import PJFConfiguration, PJFFactory
+from pyjfuzz.lib import PJFConfiguration, PJFFactory, PJFMutation
 import dataclasses
 from typing import Optional, Dict
 from pathlib import Path
-from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import Future, ProcessPoolExecutor
 import logging
 
 logging.basicConfig(level=logging.DEBUG)
 
 logger = logging.getLogger(__name__)
 
+# Processes mutating seed files, mutation is CPU bound pure python
+FUZZ_WORKERS = int(os.getenv("FUZZ_WORKERS", os.cpu_count() or 1))
+# Fuzzers of parsed seed files every worker keeps warm
+SEEDS_CACHED = int(os.getenv("FUZZ_SEEDS_CACHED", "4"))
+
+
+@functools.lru_cache(maxsize=SEEDS_CACHED)
+def load_fuzzer(path, mtime_ns):
+    """Parse a seed file and configure its fuzzer, once per worker process and
+    version of the file"""
+    with open(path, "r") as f:
+        seed = json.load(f)
+    # the factory copies containers while mutating, so the parsed seed stays intact
+    return PJFFactory(PJFConfiguration(Namespace(json=seed, level=6, nologo=True)))
+
+
+def fuzz_file(input_path, output_path, seed):
+    """Write the mutation of the seed file at input_path for seed to output_path.
+    Runs in a worker process"""
+    fuzzer = load_fuzzer(input_path, os.stat(input_path).st_mtime_ns)
+    random.seed(seed)
+    # the mutators draw some of their payloads when they are built, rebuild them
+    # so the output only depends on seed and not on the worker's earlier events
+    fuzzer.mutator = PJFMutation(fuzzer.config)
+    with open(output_path, "w") as out:
+        out.write(fuzzer.fuzzed)
+
 
 @dataclasses.dataclass
 class JsonFuzzEvent:
     input_path: Path
     output_path: Optional[Path] = None
     fuzzed: bool = False
+    # the mutation raised, the output is not written and no longer pending
+    failed: bool = False
+    # the mutation written to output_path is a function of the input and seed
+    seed: Optional[int] = None
+    # set once the event is submitted, done when its output is written
+    future: Optional[Future] = dataclasses.field(default=None, repr=False)
 
     @property
     def filename(self) -> str:
         return self.input_path.name
 
-    def fuzz(self, data):
-        fuzzer = PJFFactory(
-            PJFConfiguration(Namespace(json=json.loads(data), level=6, nologo=True))
-        )
-        fuzzed = fuzzer.fuzzed
-        with open(self.output_path, "w") as out:
-            out.write(fuzzed)
-        self.fuzzed = True
-
     @property
     def output_name(self) -> str:
         if self.output_path:
@@ -59,31 +88,103 @@ class JsonFuzzEvent:
 class JsonFuzzSession:
     SESSIONS = {}
     OUTPUT_DIR = Path("/synthea/output/fuzzed")
-    THREAD_POOL = ThreadPoolExecutor(max_workers=5)
+    # worker processes shared by all sessions, started on first use by pool()
+    POOL = None
+    POOL_LOCK = threading.Lock()
 
     def __init__(self, filepath: str, seed=None, *args, **kwargs):
         self.filepath = Path(filepath)
         self.events = []
-        if seed is not None:
-            random.seed(seed)
-
-    def fuzz(self, count=1) -> JsonFuzzEvent:
+        # draws the seed of every event, fuzzing a file with the same session
+        # seed gives the same mutations
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        # events submitted and not finished yet, and the throughput of the
+        # current or last run of fuzzing
+        self.running = 0
+        self.finished = 0
+        self.started = None
+        self.stopped = None
+
+    def fuzz(self, count=1, seed=None) -> JsonFuzzEvent:
+        """Submit count mutations of the file, a seed restarts the event seeds"""
         logger.info("Fuzing %s times", count)
-        if not hasattr(self, "_data"):
-            with open(self.filepath, "r") as f:
-                self._data = f.read()
-        objs = [JsonFuzzEvent(self.filepath) for _ in range(count)]
-        [self.THREAD_POOL.submit(o.fuzz, self._data) for o in objs]
-        self.events += objs
+        # requests run in threads, the seeds of one request are drawn together
+        with self.lock:
+            if seed is not None:
+                self.random.seed(seed)
+            objs = [
+                JsonFuzzEvent(self.filepath, seed=self.random.getrandbits(64))
+                for _ in range(count)
+            ]
+            if not self.running:
+                self.finished = 0
+                self.started = time.monotonic()
+                self.stopped = None
+            self.running += count
+            self.events += objs
+        for o in objs:
+            o.future = self.pool().submit(
+                fuzz_file, str(self.filepath), str(o.output_path), o.seed
+            )
+            o.future.add_done_callback(functools.partial(self._fuzzed, o))
         return objs
 
+    def _fuzzed(self, event, future):
+        if future.exception() is None:
+            event.fuzzed = True
+        else:
+            event.failed = True
+            logger.error("Fuzzing %s failed: %s", event.filename, future.exception())
+        with self.lock:
+            self.running -= 1
+            self.finished += 1
+            done = not self.running
+            if done:
+                self.stopped = time.monotonic()
+        if done:
+            stats = self.stats
+            logger.info(
+                "Fuzzed %s %s times in %.2fs, %.1f files/s",
+                self.filepath.name,
+                stats["fuzzed"],
+                stats["seconds"],
+                stats["files_per_second"],
+            )
+
+    @property
+    def stats(self):
+        """Files fuzzed in the current or last run of fuzzing and their throughput"""
+        with self.lock:
+            if self.started is None:
+                return {"fuzzed": 0, "seconds": 0.0, "files_per_second": 0.0}
+            seconds = (self.stopped or time.monotonic()) - self.started
+            return {
+                "fuzzed": self.finished,
+                "seconds": seconds,
+                "files_per_second": self.finished / seconds if seconds else 0.0,
+            }
+
     @property
     def pending_fuzzes(self):
-        pending = [o for o in self.events if not o.fuzzed]
-        if not pending:
-            self.events = []
+        with self.lock:
+            pending = [o for o in self.events if not (o.fuzzed or o.failed)]
+            if not pending:
+                self.events = []
         return [o.output_path for o in pending]
 
+    @classmethod
+    def pool(cls):
+        """Start the worker processes from a forkserver, forking the threaded
+        server itself could copy locks held by its other threads"""
+        with cls.POOL_LOCK:
+            if cls.POOL is None:
+                cls.POOL = ProcessPoolExecutor(
+                    max_workers=FUZZ_WORKERS,
+                    mp_context=multiprocessing.get_context("forkserver"),
+                )
+            return cls.POOL
+
     @classmethod
     def rm_session(cls, id):
         if id in cls.SESSIONS:
@@ -0,0 +1,146 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim:fenc=utf-8
+#
+"""
+Registry of asynchronous generation and fuzzing jobs. A job runs on a thread
+pool, or finishes once the futures of work already submitted elsewhere are done.
+Clients wait for it by long-polling or by subscribing to its events
+"""
+import os
+import time
+import uuid
+import queue
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+# Jobs running at the same time
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "4"))
+# Finished jobs kept for clients that have not fetched them yet
+JOBS_KEPT = int(os.getenv("JOBS_KEPT", "1000"))
+
+
+class Job:
+    """A unit of work submitted through the job API"""
+
+    def __init__(self, kind, params):
+        self.id = uuid.uuid4().hex
+        self.kind = kind
+        self.params = params
+        self.status = "pending"
+        self.result = None
+        self.error = None
+        self.created = time.time()
+        self.finished = None
+        self.done = threading.Event()
+
+    def to_dict(self):
+        return {
+            "id": self.id,
+            "kind": self.kind,
+            "params": self.params,
+            "status": self.status,
+            "result": self.result,
+            "error": self.error,
+            "created": self.created,
+            "finished": self.finished,
+        }
+
+
+class JobRegistry:
+    """Run jobs on a thread pool and publish every status change to subscribers"""
+
+    def __init__(self, workers=JOB_WORKERS, kept=JOBS_KEPT):
+        self.jobs = OrderedDict()
+        self.kept = kept
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(workers, thread_name_prefix="job")
+        self.subscribers = []
+
+    def submit(self, kind, params, fn, *args):
+        """Create a job that runs fn(*args) and return it without waiting"""
+        job = Job(kind, params)
+        with self.lock:
+            self.jobs[job.id] = job
+            self._evict()
+        self._publish(job)
+        self.executor.submit(self._run, job, fn, args)
+        return job
+
+    def submit_futures(self, kind, params, futures, fn, *args):
+        """Create a job that finishes with fn(*args) once all futures are done and
+        return it without waiting. The job holds no worker while they run"""
+        job = Job(kind, params)
+        with self.lock:
+            self.jobs[job.id] = job
+            self._evict()
+        self._publish(job)
+        job.status = "running"
+        self._publish(job)
+        remaining = [len(futures)]
+        lock = threading.Lock()
+
+        def done(future):
+            with lock:
+                remaining[0] -= 1
+                last = not remaining[0]
+            if last:
+                self._finish(job, fn, args)
+
+        if not futures:
+            self._finish(job, fn, args)
+        for future in futures:
+            future.add_done_callback(done)
+        return job
+
+    def get(self, job_id):
+        with self.lock:
+            return self.jobs.get(job_id)
+
+    def wait(self, job_id, timeout):
+        """Return the job once it finished or timeout seconds passed, None if unknown"""
+        job = self.get(job_id)
+        if job is not None:
+            job.done.wait(timeout)
+        return job
+
+    def subscribe(self):
+        """Return a queue receiving the dict of every job whose status changes"""
+        events = queue.Queue()
+        with self.lock:
+            self.subscribers.append(events)
+        return events
+
+    def unsubscribe(self, events):
+        with self.lock:
+            self.subscribers.remove(events)
+
+    def _run(self, job, fn, args):
+        job.status = "running"
+        self._publish(job)
+        self._finish(job, fn, args)
+
+    def _finish(self, job, fn, args):
+        try:
+            job.result = fn(*args)
+            job.status = "done"
+        except Exception as e:
+            job.error = str(e)
+            job.status = "failed"
+        job.finished = time.time()
+        job.done.set()
+        self._publish(job)
+
+    def _publish(self, job):
+        event = job.to_dict()
+        with self.lock:
+            subscribers = list(self.subscribers)
+        for events in subscribers:
+            events.put(event)
+
+    def _evict(self):
+        """Forget the oldest finished jobs beyond the number kept"""
+        finished = [k for k, job in self.jobs.items() if job.done.is_set()]
+        for job_id in finished[: max(0, len(finished) - self.kept)]:
+            del self.jobs[job_id]
@@ -5,27 +5,245 @@
 """
 
 """
-from flask import Flask, request
+from flask import Flask, Response, request
 from flask import jsonify
 import os
 import json
+import time
+import queue
+import shutil
+import tempfile
+import subprocess
+import threading
+from collections import deque
 from fuzzer import fuzz
+from jobs import JobRegistry
 
 app = Flask(__name__)
+output_dir = "/synthea/output/"
 fhir_dir = "/synthea/output/fhir/"
+# Each generation exports into its own directory below this one
+jobs_dir = "/synthea/output/jobs/"
+
+# Start script built by `gradlew installDist`, so a generation does not start gradle
+SYNTHEA = os.getenv("SYNTHEA_BIN", "/synthea/build/install/synthea/bin/synthea")
+# Bundles generated ahead of time for requests without a seed or modules, 0 disables
+POOL_SIZE = int(os.getenv("SYNTHEA_POOL_SIZE", "10"))
+# Longest a GET /jobs/<id>?wait= request is held open, in seconds
+MAX_WAIT = 60
+# Seconds between keep-alive comments on an idle event stream
+HEARTBEAT = 15
+
+
+def generate(count=1, seed=None, modules=()):
+    """Run Synthea for count patients in a single JVM and return the names of
+    the generated fhir bundles. Every run exports into a job directory of its
+    own and moves the results into the shared output directories afterwards,
+    so concurrent runs never see each other's files"""
+    os.makedirs(jobs_dir, exist_ok=True)
+    job_dir = tempfile.mkdtemp(prefix="job-", dir=jobs_dir)
+    args = [SYNTHEA, "-p", str(count), f"--exporter.baseDirectory={job_dir}/"]
+    if seed is not None:
+        args += ["-s", str(seed)]
+    if modules:
+        args += ["-m", ":".join(modules)]
+    try:
+        subprocess.run(args, cwd="/synthea", check=True)
+        # every patient has a ccda document, fhir also holds hospital and practitioner files
+        job_ccda_dir = os.path.join(job_dir, "ccda")
+        filenames = sorted(
+            f"{name.split('.')[0]}.json" for name in os.listdir(job_ccda_dir)
+        )
+        for sub in os.listdir(job_dir):
+            os.makedirs(os.path.join(output_dir, sub), exist_ok=True)
+            for name in os.listdir(os.path.join(job_dir, sub)):
+                os.replace(
+                    os.path.join(job_dir, sub, name),
+                    os.path.join(output_dir, sub, name),
+                )
+    finally:
+        shutil.rmtree(job_dir, ignore_errors=True)
+    return filenames
+
+
+class Pool:
+    """Bundles generated by a background thread before they are requested,
+    refilled in a single batch whenever some are taken"""
+
+    def __init__(self, size):
+        self.size = size
+        self.files = deque()
+        self.cond = threading.Condition()
+        self.thread = None
+
+    def start(self):
+        """Start filling the pool, once. Called by the first generation request
+        rather than on import, so importing the server generates nothing"""
+        with self.cond:
+            if self.size > 0 and self.thread is None:
+                self.thread = threading.Thread(target=self.fill, daemon=True)
+                self.thread.start()
+
+    def fill(self):
+        while True:
+            with self.cond:
+                self.cond.wait_for(lambda: len(self.files) < self.size)
+                missing = self.size - len(self.files)
+            try:
+                files = generate(missing)
+            except (OSError, subprocess.CalledProcessError) as e:
+                print(f"Error filling the generation pool: {e}")
+                time.sleep(10)
+                continue
+            with self.cond:
+                self.files.extend(files)
+
+    def take(self, count):
+        """Remove and return up to count pooled bundles"""
+        with self.cond:
+            taken = [self.files.popleft() for _ in range(min(count, len(self.files)))]
+            self.cond.notify()
+        return taken
+
+
+pool = Pool(POOL_SIZE)
+jobs = JobRegistry()
+
+
+def generate_patients(count, seed, modules):
+    """Return the filenames of count patients, from the pool where possible"""
+    pool.start()
+    filenames = []
+    if seed is None and not modules:
+        filenames = pool.take(count)
+    if len(filenames) < count:
+        filenames += generate(count - len(filenames), seed, modules)
+    if not filenames:
+        raise RuntimeError("no patients generated")
+    return {"filename": filenames[0], "filenames": filenames}
+
+
+def count_arg():
+    """Read the count parameter of a request, a positive integer that defaults to 1"""
+    try:
+        count = int(request.args.get("count", "1"))
+    except ValueError:
+        raise ValueError("count must be an integer")
+    if count < 1:
+        raise ValueError("count must be positive")
+    return count
+
+
+def generate_args():
+    """Read the count, seed and module parameters of a generation request"""
+    return (
+        count_arg(),
+        request.args.get("seed", None, type=int),
+        request.args.getlist("module"),
+    )
 
 
 @app.route("/")
 def hello_world():
-    output_dir = "/synthea/output/ccda/"
-    if not os.path.exists(output_dir):
-        os.makedirs(output_dir)
-    files_original = os.listdir(output_dir)
-    os.system("./gradlew run")
-    new_file = list(set(os.listdir("/synthea/output/ccda/")) - set(files_original))[0]
-    filename = new_file.split(".")[0]
-    json_file = {"filename": f"{filename}.json"}
-    return jsonify(json_file)
+    """Generate `count` patients, optionally with a `seed` and restricted to
+    Synthea modules given as repeated `module` parameters. Requests without a
+    seed or modules are served from the pool where possible"""
+    try:
+        args = generate_args()
+    except ValueError as e:
+        return jsonify({"success": False, "error": str(e)}), 400
+    try:
+        return jsonify(generate_patients(*args))
+    except (OSError, RuntimeError, subprocess.CalledProcessError) as e:
+        return jsonify({"success": False, "error": str(e)}), 500
+
+
+def fuzz_results(events):
+    """Input and output names of fuzz events, known as soon as they are submitted"""
+    return [
+        {
+            "filename": event.filename,
+            "output_name": event.output_name,
+            "seed": event.seed,
+        }
+        for event in events
+    ]
+
+
+def fuzz_all(sess, events):
+    """Return the output names of the finished fuzz events of a job and the
+    throughput of the session"""
+    for event in events:
+        # raises the error of a failed event
+        event.future.result()
+    return {"results": fuzz_results(events), "stats": sess.stats}
+
+
+@app.route("/jobs/generate", methods=["POST"])
+def submit_generate():
+    """Start generating patients in the background, takes the same
+    parameters as /"""
+    try:
+        count, seed, modules = generate_args()
+    except ValueError as e:
+        return jsonify({"success": False, "error": str(e)}), 400
+    params = {"count": count, "seed": seed, "modules": modules}
+    job = jobs.submit("generate", params, generate_patients, count, seed, modules)
+    return jsonify(dict(job.to_dict(), success=True)), 202
+
+
+@app.route("/jobs/fuzz/<filename>", methods=["POST"])
+def submit_fuzz(filename):
+    """Start fuzzing a generated file `count` times in the background, the
+    response already lists the names the outputs will be written to"""
+    filepath = os.path.join(fhir_dir, filename)
+    if not os.path.exists(filepath):
+        return jsonify({"success": False, "error": "file not found"}), 400
+    try:
+        count = count_arg()
+    except ValueError as e:
+        return jsonify({"success": False, "error": str(e)}), 400
+    seed = request.args.get("seed", None, type=int)
+    sess = fuzz.JsonFuzzSession.get_session(filepath, filepath, seed=seed)
+    events = sess.fuzz(count, seed)
+    params = {"filename": filename, "count": count, "seed": seed}
+    # finished by the events' futures, long fuzz jobs do not hold a job worker
+    # that generation jobs are waiting for
+    futures = [event.future for event in events]
+    job = jobs.submit_futures("fuzz", params, futures, fuzz_all, sess, events)
+    return jsonify(dict(job.to_dict(), success=True, results=fuzz_results(events))), 202
+
+
+@app.route("/jobs/events")
+def job_events():
+    """Stream the status changes of all jobs as server-sent events"""
+    events = jobs.subscribe()
+
+    def stream():
+        try:
+            while True:
+                try:
+                    event = events.get(timeout=HEARTBEAT)
+                except queue.Empty:
+                    yield ": keep-alive\n\n"
+                    continue
+                yield f"event: job\ndata: {json.dumps(event)}\n\n"
+        finally:
+            jobs.unsubscribe(events)
+
+    return Response(
+        stream(), mimetype="text/event-stream", headers={"Cache-Control": "no-cache"}
+    )
+
+
+@app.route("/jobs/<job_id>")
+def get_job(job_id):
+    """Return a job, with `wait` wait up to that many seconds for it to finish"""
+    timeout = min(request.args.get("wait", 0, type=float), MAX_WAIT)
+    job = jobs.wait(job_id, timeout)
+    if job is None:
+        return jsonify({"success": False, "error": "job not found"}), 404
+    return jsonify(dict(job.to_dict(), success=True))
 
 
 @app.route("/status")
@@ -59,20 +277,16 @@ def do_fuzz(filename):
     filepath = os.path.join(fhir_dir, filename)
     if not os.path.exists(filepath):
         return jsonify({"success": False, "error": "file not found"}), 400
+    try:
+        count = count_arg()
+    except ValueError as e:
+        return jsonify({"success": False, "error": str(e)}), 400
     seed = request.args.get("seed", None)
     if seed is not None:
         seed = int(seed)
     sess = fuzz.JsonFuzzSession.get_session(filepath, filepath, seed=seed)
-    events = sess.fuzz(int(request.args.get("count", 1)))
-    return jsonify(
-        {
-            "success": True,
-            "results": [
-                {"filename": event.filename, "output_name": event.output_name}
-                for event in events
-            ],
-        }
-    )
+    events = sess.fuzz(count, seed)
+    return jsonify({"success": True, "results": fuzz_results(events)})
 
 
 def _is_fuzzing(filename):
@@ -87,8 +301,7 @@ def _is_fuzzing(filename):
         sess = fuzz.JsonFuzzSession.get_session(filepath, filepath)
         sessions = [sess] if sess else []
     for sess in sessions:
-        pend = sess.pending_fuzzes
-        pending += pending
+        pending += sess.pending_fuzzes
     return jsonify(
         {
             "result": bool(pending),
@@ -0,0 +1,90 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim:fenc=utf-8
+#
+"""
+Benchmark per-hop latency of the FHIR clients with and without connection reuse
+"""
+import sys
+import time
+import statistics
+
+import click
+import urllib3
+from tabulate import tabulate
+
+sys.path.append("./clients")
+from abstract_client import AbstractClient, build_session
+from telephone import client_map, validate_options
+
+
+def unpooled_session():
+    """Session that opens a new connection for every request, like module-level requests.get"""
+    session = build_session(retries=0)
+    session.headers["Connection"] = "close"
+    return session
+
+
+def time_hops(client, data, file_type, rounds):
+    """Run the first step of a chain `rounds` times and return the latency of each hop"""
+    latencies = []
+    for _ in range(rounds):
+        start = time.perf_counter()
+        client.step(0, data, file_type)
+        latencies.append((time.perf_counter() - start) * 1000)
+    return latencies
+
+
+@click.command()
+@click.option("--file", type=click.File("r"), required=True)
+@click.option(
+    "--type",
+    "file_type",
+    type=click.Choice(["json", "xml"]),
+    default="json",
+    help="Patient file type - json or xml",
+)
+@click.option(
+    "--chain",
+    "-c",
+    multiple=True,
+    type=click.Choice(list(client_map.keys())),
+    help="Servers to benchmark, default is all",
+)
+@click.option("--rounds", type=click.IntRange(min=1), default=10)
+def cli_options(file, file_type, chain, rounds):
+    """
+    Time single hops against each server, first opening a new connection per request
+    and then through the shared keep-alive session
+    """
+    urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+    chain = chain or list(client_map.keys())
+    validate_options(file_type, chain, False)
+    data = file.read()
+
+    rows = []
+    for name in chain:
+        client = client_map[name]
+        AbstractClient.session = unpooled_session()
+        before = time_hops(client, data, file_type, rounds)
+        AbstractClient.configure_session()
+        after = time_hops(client, data, file_type, rounds)
+        rows.append(
+            [
+                name,
+                f"{statistics.median(before):.1f}",
+                f"{statistics.median(after):.1f}",
+                f"{statistics.median(before) / statistics.median(after):.2f}x",
+            ]
+        )
+    print(
+        tabulate(
+            rows,
+            headers=["Server", "New connection (ms)", "Keep-alive (ms)", "Speedup"],
+            tablefmt="pretty",
+        )
+    )
+
+
+if __name__ == "__main__":
+    cli_options()
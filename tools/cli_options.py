@@ -30,6 +30,25 @@ def add_diff_options(func):
         default="full",
         help="Diff output type - summary or full",
     )
+    @click.option(
+        "--workers",
+        type=click.IntRange(min=1),
+        default=None,
+        help="Number of processes computing diffs, default is one per core",
+    )
+    @click.option(
+        "--no-cache",
+        "no_cache",
+        is_flag=True,
+        default=False,
+        help="Diff every pair instead of reusing cached diffs",
+    )
+    @click.option(
+        "--engine",
+        type=click.Choice(["deepdiff", "fhir"]),
+        default="deepdiff",
+        help="Diff whole documents, or match Bundle entries by resource identity",
+    )
     @optgroup.group(
         "Either choose depth = 1 or choose all depths.",
         cls=RequiredMutuallyExclusiveOptionGroup,
@@ -47,6 +66,19 @@ def add_chain_options(func):
     """Decorator to add chain options to a Click command."""
 
     @click.option("--chain-length", "chain_length", default=3, type=int)
+    @click.option(
+        "--workers",
+        type=click.IntRange(min=1),
+        default=8,
+        help="Maximum number of hops processed concurrently with --all-chains",
+    )
+    @click.option(
+        "--no-cache",
+        "no_cache",
+        is_flag=True,
+        default=False,
+        help="Send every hop to the servers instead of replaying cached results",
+    )
     @click.option(
         "--type",
         "file_type",
@@ -6,11 +6,48 @@
 Define an abstract class to all the other clients have the same set of methods
 """
 from abc import ABCMeta, abstractmethod
+import aiohttp
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+
+def build_session(pool_maxsize=16, retries=3, backoff_factor=0.5):
+    """
+    Create a keep-alive session with a bounded connection pool per host
+    Failed connections are retried with exponential backoff for every method.
+    Gateway errors are only retried for idempotent methods, so a POST never creates a patient twice.
+    """
+    retry = Retry(
+        total=retries,
+        backoff_factor=backoff_factor,
+        status_forcelist=(502, 503, 504),
+        raise_on_status=False,
+    )
+    # pool_block makes pool_maxsize a hard limit on concurrent connections to a host
+    adapter = HTTPAdapter(
+        pool_connections=16,
+        pool_maxsize=pool_maxsize,
+        pool_block=True,
+        max_retries=retry,
+    )
+    session = requests.Session()
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
 
 
 class AbstractClient(metaclass=ABCMeta):
     """Ensure that these methods are implemented in each implementation"""
 
+    # Shared by every client, so connections to a server are reused across clients and hops
+    session = build_session()
+
+    @classmethod
+    def configure_session(cls, **kwargs):
+        """Replace the shared session, see build_session for the options"""
+        AbstractClient.session = build_session(**kwargs)
+
     @abstractmethod
     def __init__(self, fhir, base):
         """Constructor to ensure that we get the FHIR URL and API base URL"""
@@ -30,3 +67,61 @@ class AbstractClient(metaclass=ABCMeta):
     @abstractmethod
     def export_patient(self, p_id):
         """Extracts one Patient data using a FHIR output"""
+
+    def fingerprint(self):
+        """
+        Identify the server software and version from its CapabilityStatement
+        Used to invalidate cached hop results when a server is upgraded
+        """
+        try:
+            r = self.session.get(
+                f"{self.fhir}/{self.base}/metadata",
+                timeout=100,
+                verify=False,
+                auth=getattr(self, "auth", None),
+            )
+            software = r.json().get("software", {})
+            return f"{software.get('name')}/{software.get('version')}"
+        except Exception:
+            return "unknown"
+
+
+class AsyncAbstractClient(metaclass=ABCMeta):
+    """
+    Asynchronous counterpart of AbstractClient, for driving many hops from one event loop
+    Use as `async with Client(fhir, base) as client:` so the connection pool is closed afterwards
+    """
+
+    def __init__(self, fhir, base, limit=100, limit_per_host=16):
+        """Constructor to ensure that we get the FHIR URL and API base URL"""
+        self.fhir = fhir
+        self.base = base
+        self.limit = limit
+        self.limit_per_host = limit_per_host
+        self.session = None
+
+    async def __aenter__(self):
+        connector = aiohttp.TCPConnector(
+            limit=self.limit, limit_per_host=self.limit_per_host, ssl=False
+        )
+        self.session = aiohttp.ClientSession(connector=connector)
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.session.close()
+
+    @abstractmethod
+    async def export_patients(self):
+        """Extracts Patient data using a FHIR output"""
+
+    @abstractmethod
+    async def create_patient(self, data, file_type):
+        """A function that creates a user by sending a FHIR JSON/XML object"""
+
+    @abstractmethod
+    async def export_patient(self, p_id, file_type):
+        """Extracts one Patient data using a FHIR output"""
+
+    @abstractmethod
+    async def step(self, step_number: int, data, file_type):
+        """Ingest data and export it again, returns (patient_id, response, export)"""
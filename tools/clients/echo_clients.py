@@ -8,16 +8,25 @@ Create a client for the json echoing servers
 
 import click
 import json
-import requests
+import os
 from pathlib import Path
 import time
 import enum
 import dataclasses
 import logging
 
+try:
+    from abstract_client import AbstractClient
+except ImportError:
+    # Imported as clients.echo_clients by test_json_echo.py
+    from clients.abstract_client import AbstractClient
+
 logger = logging.getLogger(__name__)
 logging.basicConfig()
 
+# Bytes read from an echo response at a time
+CHUNK_SIZE = 1 << 16
+
 
 class Langs(enum.StrEnum):
     JAVA = "java"
@@ -58,11 +67,18 @@ class Parsers(enum.StrEnum):
 
 @dataclasses.dataclass(frozen=True, eq=True)
 class EHRInfo:
-    """Information on a single EHR's language and parser"""
+    """Information on a single EHR's language and parser, endpoint is
+    the path of its echo servlet on the language's server"""
 
     ehr: EHRs
     language: Langs
     parser: Parsers
+    endpoint: str
+
+    @property
+    def key(self):
+        """EHRs with the same key echo identical results"""
+        return (self.language, self.parser, self.endpoint)
 
 
 class EHRMapping:
@@ -71,8 +87,11 @@ class EHRMapping:
     EHR_MAPPING = {}
 
     @classmethod
-    def create(cls, ehr, lang, parser):
-        cls.EHR_MAPPING[ehr] = EHRInfo(EHRs(ehr), Langs(lang), Parsers(parser))
+    def create(cls, ehr, lang, parser, endpoint=None):
+        endpoint = endpoint or f"/{ehr}echo"
+        cls.EHR_MAPPING[ehr] = EHRInfo(
+            EHRs(ehr), Langs(lang), Parsers(parser), endpoint
+        )
 
     @classmethod
     def get(cls, name):
@@ -80,11 +99,19 @@ class EHRMapping:
 
     @classmethod
     def iter_unique(cls):
-        parsers = set()
+        """Iterate over one EHR per distinct (language, parser, endpoint)"""
+        keys = set()
+        for ehr in cls.EHR_MAPPING.values():
+            if ehr.key not in keys:
+                yield ehr
+                keys.add(ehr.key)
+
+    @classmethod
+    def iter_aliases(cls, who):
+        """Iterate over the other EHRs whose echo is the same as who's"""
         for ehr in cls.EHR_MAPPING.values():
-            # if ehr.parser not in parsers:
-            yield ehr
-            parsers.add(ehr.parser)
+            if ehr.key == who.key and ehr != who:
+                yield ehr
 
     @classmethod
     def iter_names(cls):
@@ -92,7 +119,8 @@ class EHRMapping:
             yield ehr.ehr.value
 
 
-# Create EHRMapping object for each EHR parser
+# Create EHRMapping object for each EHR parser. hapi and openmrs both use
+# jackson, but their servlets configure the ObjectMapper differently
 EHRMapping.create("ibm", "java", "jakarta")
 EHRMapping.create("hapi", "java", "fasterxml.jackson")
 EHRMapping.create("openmrs", "java", "fasterxml.jackson")
@@ -102,6 +130,31 @@ EHRMapping.create("gnuhealth", "python", "python")
 EHRMapping.create("openemr", "php", "php")
 
 
+def write_chunks(chunks, output):
+    """Write chunks to output through a .part file, so an interrupted
+    response never leaves a partial result behind"""
+    part = output.with_name(output.name + ".part")
+    try:
+        with open(part, "wb") as f:
+            for chunk in chunks:
+                f.write(chunk)
+        part.replace(output)
+    finally:
+        part.unlink(missing_ok=True)
+
+
+def link_result(output, alias):
+    """Materialize the result at output under alias as a hardlink,
+    falling back to a copy where the filesystem has no hardlinks"""
+    part = alias.with_name(alias.name + ".part")
+    part.unlink(missing_ok=True)
+    try:
+        os.link(output, part)
+    except OSError:
+        part.write_bytes(output.read_bytes())
+    part.replace(alias)
+
+
 class EchoClient:
     """Client for posting (deserialized) json to the json echo
     serversq"""
@@ -120,40 +173,60 @@ class EchoClient:
         self.pythonurl = pythonurl
         self.phpurl = phpurl
 
-    def post(self, who, data):
+    @property
+    def session(self):
+        """The shared session, looked up on every request so that
+        AbstractClient.configure_session applies to existing clients"""
+        return AbstractClient.session
+
+    def post(self, who, data, raw=False, output=None):
         """Given an EHRMapping object (who) and parsed json data,
-        POST request to parser's echo server"""
+        POST request to parser's echo server. By default the response is
+        read line by line with the line breaks dropped, raw keeps the exact
+        bytes sent by the server. With an output path the response is
+        streamed to that file instead of being returned"""
         if not isinstance(who, EHRInfo):
             who = EHRMapping.get(str(who))
         which = who.language
-        url = getattr(self, which + "url") + f"/{who.ehr.value}echo"
+        url = getattr(self, which + "url") + who.endpoint
         try:
-            r = requests.request(
+            # Closing the streamed response returns its connection to the pool,
+            # also when reading or writing it fails
+            with self.session.request(
                 "POST",
                 url,
                 data=data,
                 stream=True,
                 timeout=100,
                 headers={"Content-Type": "application/json; charset=utf-8"},
-            )
-            resp = b""
-            for line in r.iter_lines():
-                resp += line
+            ) as r:
+                if raw:
+                    chunks = r.iter_content(chunk_size=CHUNK_SIZE)
+                else:
+                    chunks = r.iter_lines(chunk_size=CHUNK_SIZE)
+                if output is None:
+                    resp = b"".join(chunks)
+                else:
+                    resp = None
+                    if r.ok:
+                        write_chunks(chunks, Path(output))
         except Exception as e:
             logger.error("error connecting to %s at %s: %s", who.ehr, url, e)
             return None, None
         return r, resp
 
-    def post_all(self, data):
+    def post_all(self, data, raw=False):
         """Given path to file (data) POSTs request to all unique
-        parser echo servers"""
+        parser echo servers, EHRs sharing a parser share its result"""
         results = {}
         with open(data, "rb") as f:
             data = f.read()
         for ehr in EHRMapping.iter_unique():
-            r, res = self.post(ehr, data)
+            r, res = self.post(ehr, data, raw)
             if r and r.ok:
                 results[ehr.ehr.value] = res
+                for alias in EHRMapping.iter_aliases(ehr):
+                    results[alias.ehr.value] = res
         return results
 
 
@@ -171,11 +244,12 @@ class EchoClient:
 @click.option("-c", "--clojureurl", default="http://localhost:8282")
 @click.option("-v", "--vistaurl", default="http://localhost:8383")
 @click.option("-j", "--javaurl", default="http://localhost:8181")
-def cli_options(file, pythonurl, clojureurl, vistaurl, javaurl, phpurl, output):
+@click.option("--raw", is_flag=True, help="Keep the exact response bytes")
+def cli_options(file, pythonurl, clojureurl, vistaurl, javaurl, phpurl, output, raw):
     """Send --file to each parser and print the returned results"""
     client = EchoClient(javaurl, vistaurl, clojureurl, pythonurl, phpurl)
     for f in file:
-        results = client.post_all(f)
+        results = client.post_all(f, raw)
         for k in sorted(results.keys()):
             v = results[k]
             print(k, ":", v)
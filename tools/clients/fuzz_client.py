@@ -11,9 +11,10 @@ import json
 import requests
 from pathlib import Path
 import time
+from job_client import JobClient
 
 
-class FuzzClient:
+class FuzzClient(JobClient):
     """Allow users to easy create a new patient and export all patients"""
 
     def __init__(self, url):
@@ -26,7 +27,7 @@ class FuzzClient:
             filename = ""
         url = f"{self.url}/{path}/{filename}"
         try:
-            r = requests.get(url, params=params, timeout=100)
+            r = self.session.get(url, params=params, timeout=100)
         except Exception as e:
             return (-1, str(e))
         try:
@@ -39,6 +40,13 @@ class FuzzClient:
         kwargs["count"] = str(count)
         return self._request("fuzz", filename, kwargs)
 
+    def submit_fuzz(self, filename, count=1, seed=None):
+        """Start a job fuzzing filename count times, see JobClient.wait_job"""
+        params = {"count": count}
+        if seed is not None:
+            params["seed"] = seed
+        return self.submit(f"fuzz/{filename}", params)
+
     def pending_fuzz(self, filename):
         status, data = self._request("pending_fuzz", filename)
         return [] if status != 200 else data.get("pending", [])
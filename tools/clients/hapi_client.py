@@ -8,10 +8,55 @@ Create a Client for vista that can create patients and pull data
 
 import json
 import click
-import requests
-from abstract_client import AbstractClient
+import aiohttp
+from abstract_client import AbstractClient, AsyncAbstractClient
 from defusedxml.ElementTree import fromstring, tostring, parse, ParseError
 
+NS = {"fhir": "http://hl7.org/fhir"}
+
+
+def _headers(file_type):
+    """Content negotiation headers for FHIR JSON/XML"""
+    header_text = "application/fhir+" + file_type
+    return {
+        "Accept": header_text,
+        "Content-Type": header_text,
+    }
+
+
+def _collection_payload(data, file_type):
+    """Turn the bundle into a collection, so HAPI stores it as is"""
+    if file_type == "json":
+        data["type"] = "collection"
+        return json.dumps(data)
+    data = data.strip()
+    root = fromstring(data)
+    type_element = root.find("fhir:type", NS)
+    if type_element is not None:
+        type_element.set("value", "collection")
+        data = tostring(root, encoding="utf-8")
+    return data
+
+
+def _patient_id(text, file_type):
+    """Read the id of the created Bundle from the response body"""
+    if file_type == "json":
+        return json.loads(text)["id"]
+    patient_id_element = fromstring(text).find("fhir:id", NS)
+    if patient_id_element is not None:
+        return patient_id_element.get("value")
+    return None
+
+
+def _step_input(step_number, data, file_type):
+    """The first step gets the JSON file as text, later steps get a parsed export"""
+    if step_number == 0 and file_type == "json":
+        try:
+            return json.loads(data)
+        except json.JSONDecodeError:
+            raise click.BadParameter("Malformed input json file.")
+    return data
+
 
 class HapiClient(AbstractClient):
     """Allow users to easy create a new patient and export all patients"""
@@ -25,7 +70,7 @@ class HapiClient(AbstractClient):
         """Calls the FHIR API to export all patients"""
         # TBD: XML capabilities
         try:
-            r = requests.get(f"{self.fhir}/{self.base}/Bundle", timeout=100)
+            r = self.session.get(f"{self.fhir}/{self.base}/Bundle", timeout=100)
             return (r.status_code, r.json())
         except Exception as e:
             return (-1, str(e))
@@ -34,7 +79,7 @@ class HapiClient(AbstractClient):
         """Calls the FHIR API to export patients with given ID"""
         header_text = "application/fhir+" + file_type
         headers = {"Accept": header_text}
-        r = requests.get(
+        r = self.session.get(
             f"{self.fhir}/{self.base}/Bundle/{p_id}",
             headers=headers,
             timeout=100,
@@ -49,69 +94,29 @@ class HapiClient(AbstractClient):
     def create_patient_fromfile(self, file, file_type):
         """Create a new patient from a FHIR XML/JSON file"""
         patient_id = None
-        header_text = "application/fhir+" + file_type
-        headers = {
-            "Accept": header_text,
-            "Content-Type": header_text,
-        }
-        r = requests.post(
+        r = self.session.post(
             f"{self.fhir}/{self.base}/Bundle",
             data=file.read(),
             timeout=10,
-            headers=headers,
+            headers=_headers(file_type),
             verify=False,
         )
         if r.status_code == 201:
-            if file_type == "json":
-                response = r.json()
-                patient_id = response["id"]
-            else:
-                response = r.text
-                root = fromstring(response)
-                ns = {"fhir": "http://hl7.org/fhir"}
-                patient_id_element = root.find("fhir:id", ns)
-                if patient_id_element is not None:
-                    patient_id = patient_id_element.get("value")
+            patient_id = _patient_id(r.text, file_type)
         return (patient_id, r)
 
     def create_patient(self, data, file_type):
         """Create a new patient from a FHIR XML/JSON file"""
         patient_id = None
-        header_text = "application/fhir+" + file_type
-        headers = {
-            "Accept": header_text,
-            "Content-Type": header_text,
-        }
-        if file_type == "json":
-            data["type"] = "collection"
-            data = json.dumps(data)
-        else:
-            ns = {"fhir": "http://hl7.org/fhir"}
-            data = data.strip()
-            root = fromstring(data)
-            type_element = root.find("fhir:type", ns)
-            if type_element is not None:
-                type_element.set("value", "collection")
-                data = tostring(root, encoding="utf-8")
-
-        r = requests.post(
+        r = self.session.post(
             f"{self.fhir}/{self.base}/Bundle",  # /$everything returns Bundle type
-            data=data,
+            data=_collection_payload(data, file_type),
             timeout=10,
-            headers=headers,
+            headers=_headers(file_type),
             verify=False,
         )
         if r.status_code == 201:
-            if file_type == "json":
-                response = r.json()
-                patient_id = response["id"]
-            else:
-                response = r.text
-                root = fromstring(response)
-                ns = {"fhir": "http://hl7.org/fhir"}
-                patient_id_element = root.find("fhir:id", ns)
-                if patient_id_element is not None:
-                    patient_id = patient_id_element.get("value")
+            patient_id = _patient_id(r.text, file_type)
 
         return (patient_id, r)
 
@@ -122,21 +127,9 @@ class HapiClient(AbstractClient):
         We must extract the patient data from it.
         If not, then we can import the file as is
         """
-        patient_id = None
-        response_data = None
-        if step_number == 0:
-            if file_type == "json":
-                try:
-                    patient_data = json.loads(data)
-                except json.JSONDecodeError:
-                    raise click.BadParameter("Malformed input json file.")
-            else:
-                # File type is XML
-                patient_data = data
-            (patient_id, response_data) = self.create_patient(patient_data, file_type)
-        else:
-            # This means we just got a full file from another server, simply upload it
-            (patient_id, response_data) = self.create_patient(data, file_type)
+        (patient_id, response_data) = self.create_patient(
+            _step_input(step_number, data, file_type), file_type
+        )
 
         if patient_id is None:
             return_response = (
@@ -150,6 +143,56 @@ class HapiClient(AbstractClient):
         return (patient_id, return_response, export_response)
 
 
+class AsyncHapiClient(AsyncAbstractClient):
+    """asyncio variant of HapiClient, shares its request and response handling"""
+
+    async def export_patients(self):
+        """Calls the FHIR API to export all patients"""
+        try:
+            async with self.session.get(
+                f"{self.fhir}/{self.base}/Bundle",
+                timeout=aiohttp.ClientTimeout(total=100),
+            ) as r:
+                return (r.status, await r.json(content_type=None))
+        except Exception as e:
+            return (-1, str(e))
+
+    async def export_patient(self, p_id, file_type):
+        """Calls the FHIR API to export patients with given ID"""
+        async with self.session.get(
+            f"{self.fhir}/{self.base}/Bundle/{p_id}",
+            headers={"Accept": "application/fhir+" + file_type},
+            timeout=aiohttp.ClientTimeout(total=100),
+        ) as r:
+            text = await r.text()
+        return (r.status, json.loads(text) if file_type == "json" else text)
+
+    async def create_patient(self, data, file_type):
+        """Create a new patient from a FHIR XML/JSON file, returns (patient_id, body)"""
+        patient_id = None
+        async with self.session.post(
+            f"{self.fhir}/{self.base}/Bundle",
+            data=_collection_payload(data, file_type),
+            headers=_headers(file_type),
+            timeout=aiohttp.ClientTimeout(total=10),
+        ) as r:
+            text = await r.text()
+        if r.status == 201:
+            patient_id = _patient_id(text, file_type)
+        return (patient_id, json.loads(text) if file_type == "json" else text)
+
+    async def step(self, step_number: int, data, file_type):
+        """See HapiClient.step"""
+        (patient_id, response_data) = await self.create_patient(
+            _step_input(step_number, data, file_type), file_type
+        )
+        if patient_id is None:
+            return (patient_id, response_data, None)
+
+        (_, export_response) = await self.export_patient(patient_id, file_type)
+        return (patient_id, response_data, export_response)
+
+
 @click.command()
 @click.option("--file", type=click.File("r"))
 def cli_options(file):
@@ -5,10 +5,70 @@
 """
 Create a Client for ibm that can create patients and pull data
 """
+import re
 import json
 import click
-import requests
-from abstract_client import AbstractClient
+import aiohttp
+from abstract_client import AbstractClient, AsyncAbstractClient
+
+NEWEST_BUNDLE = {"_sort": "-_lastUpdated", "_count": "1"}
+
+HEADERS = {
+    "Accept": "application/fhir+json",
+    "Content-Type": "application/json",
+}
+
+
+def _created_bundle_id(location, body):
+    """
+    Read the id of the created Bundle from the Location header, e.g. .../Bundle/<id>/_history/1
+    Falls back to the response body when the server returns the resource
+    or a transaction-response. Returns None when neither identifies the Bundle.
+    """
+    match = re.search(r"Bundle/([^/]+)", location or "")
+    if match:
+        return match.group(1)
+    try:
+        response = json.loads(body)
+    except (TypeError, ValueError):
+        return None
+    if not isinstance(response, dict):
+        return None
+    if response.get("type") == "transaction-response":
+        for entry in response.get("entry", []):
+            match = re.search(
+                r"Bundle/([^/]+)", entry.get("response", {}).get("location", "")
+            )
+            if match:
+                return match.group(1)
+        return None
+    if response.get("resourceType") == "Bundle":
+        return response.get("id")
+    return None
+
+
+def _newest_bundle_id(search_json):
+    """Read the id from a Bundle search sorted by -_lastUpdated"""
+    entries = search_json.get("entry", []) if isinstance(search_json, dict) else []
+    if entries:
+        return entries[0]["resource"]["id"]
+    return None
+
+
+def _step_payload(step_number, data, file_type):
+    """
+    The first step gets the JSON file as text, which is validated and sent as is
+    Later steps get another server's export, which IBM only accepts as a transaction
+    """
+    if step_number == 0:
+        try:
+            return json.dumps(json.loads(data))
+        except json.JSONDecodeError:
+            raise click.BadParameter("Malformed input json file.")
+    if file_type == "json":
+        data["type"] = "transaction"
+        data = json.dumps(data)
+    return data
 
 
 class IBMFHIRClient(AbstractClient):
@@ -18,15 +78,16 @@ class IBMFHIRClient(AbstractClient):
         """Constructor"""
         self.fhir = fhir
         self.base = base
+        self.auth = ("fhiruser", "change-password")
 
     def export_patients(self):
         """Calls the FHIR API to export all patients"""
         try:
-            r = requests.get(
+            r = self.session.get(
                 f"{self.fhir}/{self.base}/Bundle",
                 timeout=100,
                 verify=False,
-                auth=("fhiruser", "change-password"),
+                auth=self.auth,
             )
             response = r.json()
             return (r.status_code, response)
@@ -35,66 +96,63 @@ class IBMFHIRClient(AbstractClient):
 
     def export_patient(self, p_id):
         """Calls the FHIR API to export patients with given ID"""
-        r = requests.get(
+        r = self.session.get(
             f"{self.fhir}/{self.base}/Bundle/{p_id}",
             timeout=100,
             verify=False,
-            auth=("fhiruser", "change-password"),
+            auth=self.auth,
         )
         response = r.json()
         return (r.status_code, response)
 
-    def __get_new_patient_id(self, before_json):
+    def __get_new_patient_id(self, r):
         """
-        Get the patient ID by pulling full list of patients before and after
+        Get the patient ID from the upload response
+        Only if the server did not report it, ask for the most recently updated Bundle.
+        This is one request however many Bundles are stored, but it is only the Bundle
+        just uploaded if no other upload ran at the same time, so callers must not
+        upload to the same server concurrently.
         """
-        (_, after_json) = self.export_patients()
-
-        if len(after_json["entry"]) == 1:
-            return after_json["entry"][0]["resource"]["id"]
-
-        for entry in after_json["entry"]:
-            if entry not in before_json["entry"]:
-                return entry["resource"]["id"]
+        patient_id = _created_bundle_id(r.headers.get("Location"), r.text)
+        if patient_id is not None:
+            return patient_id
+        r = self.session.get(
+            f"{self.fhir}/{self.base}/Bundle",
+            params=NEWEST_BUNDLE,
+            timeout=100,
+            verify=False,
+            auth=self.auth,
+        )
+        return _newest_bundle_id(r.json())
 
     def create_patient_fromfile(self, file):
         """Create a new patient from a FHIR JSON file"""
-        (_, before_json) = self.export_patients()
-        headers = {
-            "Accept": "application/fhir+json",
-            "Content-Type": "application/json",
-        }
-        r = requests.post(
+        r = self.session.post(
             f"{self.fhir}/{self.base}/Bundle",
             data=file.read(),
             timeout=10,
-            headers=headers,
+            headers=HEADERS,
             verify=False,
-            auth=("fhiruser", "change-password"),
+            auth=self.auth,
         )
         patient_id = None
         if r.status_code == 201:
-            patient_id = self.__get_new_patient_id(before_json)
+            patient_id = self.__get_new_patient_id(r)
         return (patient_id, r)
 
     def create_patient(self, data):
         """Create a new patient from a FHIR JSON file"""
-        (_, before_json) = self.export_patients()
-        headers = {
-            "Accept": "application/fhir+json",
-            "Content-Type": "application/json",
-        }
-        r = requests.post(
+        r = self.session.post(
             f"{self.fhir}/{self.base}/Bundle",
             data=data,
             timeout=10,
-            headers=headers,
+            headers=HEADERS,
             verify=False,
-            auth=("fhiruser", "change-password"),
+            auth=self.auth,
         )
         patient_id = None
         if r.status_code == 201:
-            patient_id = self.__get_new_patient_id(before_json)
+            patient_id = self.__get_new_patient_id(r)
         return (patient_id, r)
 
     def step(self, step_number: int, data, file_type):
@@ -104,20 +162,9 @@ class IBMFHIRClient(AbstractClient):
         We must extract the patient data from it.
         If not, then we can import the file as is
         """
-        patient_id = None
-        if step_number == 0:
-            try:
-                patient_data = json.loads(data)
-                (patient_id, _) = self.create_patient(json.dumps(patient_data))
-            except json.JSONDecodeError:
-                raise click.BadParameter("Malformed input json file.")
-        else:
-            # This means we just got a full file from another server, simply upload it
-            if file_type == "json":
-                data["type"] = "transaction"
-                data = json.dumps(data)
-
-            (patient_id, _) = self.create_patient(data)
+        (patient_id, _) = self.create_patient(
+            _step_payload(step_number, data, file_type)
+        )
 
         if patient_id is None:
             return (patient_id, {}, None)
@@ -126,6 +173,71 @@ class IBMFHIRClient(AbstractClient):
         return (patient_id, {}, export_response)
 
 
+class AsyncIBMFHIRClient(AsyncAbstractClient):
+    """asyncio variant of IBMFHIRClient, shares its request and response handling"""
+
+    def __init__(self, fhir, base, **kwargs):
+        """Constructor"""
+        super().__init__(fhir, base, **kwargs)
+        self.auth = aiohttp.BasicAuth("fhiruser", "change-password")
+
+    async def export_patients(self):
+        """Calls the FHIR API to export all patients"""
+        try:
+            async with self.session.get(
+                f"{self.fhir}/{self.base}/Bundle",
+                auth=self.auth,
+                timeout=aiohttp.ClientTimeout(total=100),
+            ) as r:
+                return (r.status, await r.json(content_type=None))
+        except Exception as e:
+            return (-1, str(e))
+
+    async def export_patient(self, p_id, file_type="json"):
+        """Calls the FHIR API to export patients with given ID"""
+        async with self.session.get(
+            f"{self.fhir}/{self.base}/Bundle/{p_id}",
+            auth=self.auth,
+            timeout=aiohttp.ClientTimeout(total=100),
+        ) as r:
+            return (r.status, await r.json(content_type=None))
+
+    async def create_patient(self, data, file_type="json"):
+        """Create a new patient from a FHIR JSON file, returns (patient_id, status)"""
+        async with self.session.post(
+            f"{self.fhir}/{self.base}/Bundle",
+            data=data,
+            headers=HEADERS,
+            auth=self.auth,
+            timeout=aiohttp.ClientTimeout(total=10),
+        ) as r:
+            body = await r.text()
+        patient_id = None
+        if r.status == 201:
+            patient_id = _created_bundle_id(r.headers.get("Location"), body)
+            if patient_id is None:
+                # See IBMFHIRClient.__get_new_patient_id
+                async with self.session.get(
+                    f"{self.fhir}/{self.base}/Bundle",
+                    params=NEWEST_BUNDLE,
+                    auth=self.auth,
+                    timeout=aiohttp.ClientTimeout(total=100),
+                ) as search:
+                    patient_id = _newest_bundle_id(await search.json(content_type=None))
+        return (patient_id, r.status)
+
+    async def step(self, step_number: int, data, file_type):
+        """See IBMFHIRClient.step"""
+        (patient_id, _) = await self.create_patient(
+            _step_payload(step_number, data, file_type)
+        )
+        if patient_id is None:
+            return (patient_id, {}, None)
+
+        (_, export_response) = await self.export_patient(patient_id)
+        return (patient_id, {}, export_response)
+
+
 @click.command()
 @click.option("--file", type=click.File("r"))
 def cli_options(file):
@@ -0,0 +1,66 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim:fenc=utf-8
+#
+"""
+Client for the job API of the synthea server
+"""
+import json
+import time
+
+from abstract_client import AbstractClient
+
+# Jobs in these states will not change any more
+FINISHED = ("done", "failed")
+
+
+class JobClient:
+    """Submit generation and fuzzing jobs and wait for them to finish.
+    Subclasses set url"""
+
+    # Seconds a single long-polling request waits on the server
+    POLL_SECONDS = 30
+
+    @property
+    def session(self):
+        """The shared session, looked up on every request so that
+        AbstractClient.configure_session applies to existing clients"""
+        return AbstractClient.session
+
+    def submit(self, path, params=None):
+        """Start a job at /jobs/<path> and return (status code, job)"""
+        try:
+            r = self.session.post(f"{self.url}/jobs/{path}", params=params, timeout=100)
+        except Exception as e:
+            return (-1, str(e))
+        return (r.status_code, r.json())
+
+    def wait_job(self, job_id, timeout=None):
+        """Long-poll a job until it is finished or timeout seconds have passed
+        and return (status code, job)"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            wait = self.POLL_SECONDS
+            if deadline is not None:
+                wait = max(0, min(wait, deadline - time.monotonic()))
+            try:
+                r = self.session.get(
+                    f"{self.url}/jobs/{job_id}",
+                    params={"wait": wait},
+                    timeout=wait + 100,
+                )
+            except Exception as e:
+                return (-1, str(e))
+            job = r.json()
+            if r.status_code != 200 or job["status"] in FINISHED:
+                return (r.status_code, job)
+            if deadline is not None and time.monotonic() >= deadline:
+                return (r.status_code, job)
+
+    def iter_events(self):
+        """Yield the dict of every job whose status changes, read from the
+        server-sent event stream"""
+        with self.session.get(f"{self.url}/jobs/events", stream=True) as r:
+            for line in r.iter_lines(decode_unicode=True):
+                if line and line.startswith("data:"):
+                    yield json.loads(line[len("data:") :])
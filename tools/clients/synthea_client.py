@@ -6,32 +6,55 @@
 Create a Client for the synthea server
 """
 import click
-import requests
+from job_client import JobClient
 
 
-class SyntheaClient:
+class SyntheaClient(JobClient):
     """Client for generating ehr documents via synthea"""
 
     def __init__(self, url):
         self.url = url
 
-    def generate(self):
+    def generate(self, seed=None, modules=()):
+        status, filenames = self.generate_batch(1, seed, modules)
+        if status != 200:
+            return (status, filenames)
+        return (status, filenames[0])
+
+    def generate_batch(self, count, seed=None, modules=()):
+        """Generate count patients in one request and return their
+        filenames, modules restricts Synthea to those disease modules"""
+        params = {"count": count, "module": list(modules)}
+        if seed is not None:
+            params["seed"] = seed
         try:
-            r = requests.get(self.url, timeout=100)
+            r = self.session.get(self.url, params=params, timeout=100)
         except Exception as e:
             return (-1, str(e))
         data = r.json()
-        return (r.status_code, data["filename"])
+        if r.status_code != 200:
+            return (r.status_code, data.get("error"))
+        return (r.status_code, data["filenames"])
+
+    def submit_generate(self, count=1, seed=None, modules=()):
+        """Start a job generating count patients, see JobClient.wait_job"""
+        params = {"count": count, "module": list(modules)}
+        if seed is not None:
+            params["seed"] = seed
+        return self.submit("generate", params)
 
 
 @click.command()
 @click.option("-u", "--url", default="http://localhost:9000")
-def cli_options(url):
+@click.option("-n", "--count", type=click.IntRange(min=1), default=1)
+@click.option("-s", "--seed", type=int, default=None)
+@click.option("-m", "--module", multiple=True, help="Synthea module to generate from")
+def cli_options(url, count, seed, module):
     """
     Send a request to synthea generate an ehr document
     """
     client = SyntheaClient(url)
-    print(client.generate())
+    print(client.generate_batch(count, seed, module))
 
 
 if __name__ == "__main__":
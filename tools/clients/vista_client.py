@@ -8,8 +8,24 @@ Create a Client for vista that can create patients and pull data
 
 import json
 import click
-import requests
-from abstract_client import AbstractClient
+import aiohttp
+from abstract_client import AbstractClient, AsyncAbstractClient
+
+VEHU = "http://localhost:9080"
+
+
+def _loaded_patient_id(response):
+    """Read the IEN of the new patient from the /addpatient response"""
+    if response["status"] == "ok" and response.get("ien"):
+        return response["ien"]
+    return None
+
+
+def _step_payload(step_number, data):
+    """The first step gets the Bundle as text, later steps get a parsed export"""
+    if step_number == 0:
+        return data
+    return json.dumps(data)
 
 
 class VistaClient(AbstractClient):
@@ -17,21 +33,21 @@ class VistaClient(AbstractClient):
 
     def __init__(self, fhir, base):
         """Constructor"""
-        self.vehu = "http://localhost:9080"
+        self.vehu = VEHU
         self.fhir = fhir
         self.base = base
 
     def export_patients(self):
         """Calls the FHIR API to export all patients"""
         try:
-            r = requests.get(f"{self.fhir}/{self.base}/Patient", timeout=100)
+            r = self.session.get(f"{self.fhir}/{self.base}/Patient", timeout=100)
             return (r.status_code, r.json())
         except Exception as e:
             return (-1, str(e))
 
     def export_patient(self, p_id):
         """Calls the FHIR API to export patients with given ID"""
-        r = requests.get(f"{self.vehu}/showfhir", timeout=100, params={"ien": p_id})
+        r = self.session.get(f"{self.vehu}/showfhir", timeout=100, params={"ien": p_id})
         if r.status_code == 200:
             return (r.status_code, r.json())
         try:
@@ -41,7 +57,7 @@ class VistaClient(AbstractClient):
 
     def create_patient_fromfile(self, file):
         """Calls the MUMPS API to create a new patient from a FHIR JSON"""
-        r = requests.post(f"{self.vehu}/addpatient", data=file.read(), timeout=100)
+        r = self.session.post(f"{self.vehu}/addpatient", data=file.read(), timeout=100)
         patient_id = None
         if r.status_code == 201:
             response = r.json()
@@ -51,12 +67,10 @@ class VistaClient(AbstractClient):
 
     def create_patient(self, data):
         """Calls the MUMPS API to create a new patient from a FHIR JSON"""
-        r = requests.post(f"{self.vehu}/addpatient", data=data, timeout=100)
+        r = self.session.post(f"{self.vehu}/addpatient", data=data, timeout=100)
         patient_id = None
         if r.status_code == 201:
-            response = r.json()
-            if response["status"] == "ok" and response.get("ien"):
-                patient_id = response["ien"]
+            patient_id = _loaded_patient_id(r.json())
         return (patient_id, r)
 
     def step(self, step_number: int, data, _):
@@ -65,13 +79,9 @@ class VistaClient(AbstractClient):
         If its the first step, we just got a FHIR JSON file from Synthea.
         If not, then we need to bundle it in a FHIR JSON with the resourceType: Bundle
         """
-        patient_id = None
-        response_json = None
-        if step_number == 0:
-            # This means we just got a full file, simply upload it
-            (patient_id, response_json) = self.create_patient(data)
-        else:
-            (patient_id, response_json) = self.create_patient(json.dumps(data))
+        (patient_id, response_json) = self.create_patient(
+            _step_payload(step_number, data)
+        )
         if patient_id is None:
             # Creating the patient failed
             return (patient_id, response_json.json(), None)
@@ -80,6 +90,62 @@ class VistaClient(AbstractClient):
         return (patient_id, response_json.json(), export_response)
 
 
+class AsyncVistaClient(AsyncAbstractClient):
+    """asyncio variant of VistaClient, shares its request and response handling"""
+
+    def __init__(self, fhir, base, **kwargs):
+        """Constructor"""
+        super().__init__(fhir, base, **kwargs)
+        self.vehu = VEHU
+
+    async def export_patients(self):
+        """Calls the FHIR API to export all patients"""
+        try:
+            async with self.session.get(
+                f"{self.fhir}/{self.base}/Patient",
+                timeout=aiohttp.ClientTimeout(total=100),
+            ) as r:
+                return (r.status, await r.json(content_type=None))
+        except Exception as e:
+            return (-1, str(e))
+
+    async def export_patient(self, p_id, file_type="json"):
+        """Calls the FHIR API to export patients with given ID"""
+        async with self.session.get(
+            f"{self.vehu}/showfhir",
+            params={"ien": p_id},
+            timeout=aiohttp.ClientTimeout(total=100),
+        ) as r:
+            try:
+                return (r.status, await r.json(content_type=None))
+            except Exception:
+                return (r.status, {})
+
+    async def create_patient(self, data, file_type="json"):
+        """Calls the MUMPS API to create a new patient, returns (patient_id, body)"""
+        async with self.session.post(
+            f"{self.vehu}/addpatient",
+            data=data,
+            timeout=aiohttp.ClientTimeout(total=100),
+        ) as r:
+            response = await r.json(content_type=None)
+        patient_id = None
+        if r.status == 201:
+            patient_id = _loaded_patient_id(response)
+        return (patient_id, response)
+
+    async def step(self, step_number: int, data, file_type="json"):
+        """See VistaClient.step"""
+        (patient_id, response_json) = await self.create_patient(
+            _step_payload(step_number, data)
+        )
+        if patient_id is None:
+            return (patient_id, response_json, None)
+
+        (_, export_response) = await self.export_patient(patient_id)
+        return (patient_id, response_json, export_response)
+
+
 @click.command()
 @click.option("--file", type=click.File("r"))
 def cli_options(file):
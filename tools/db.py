@@ -12,6 +12,10 @@ TODO: Functions in this file will throw errors/Exceptions.
 from neo4j import GraphDatabase
 import json
 import os
+import zlib
+import hashlib
+import atexit
+import threading
 
 neo4j_env = os.getenv("COMPOSE_PROFILES", "neo4jDev")
 
@@ -23,16 +27,59 @@ elif neo4j_env == "neo4jTest":
     AUTH = ("neo4j", "test-garden")
 
 
-def __create_servers(tx, name):
-    """Create new Server node with given name, if not exists already"""
+# Buffered edges are written once this many are queued or the first is this old
+EDGE_BATCH_SIZE = 100
+EDGE_BATCH_SECONDS = 5.0
+
+driver = None
+driver_lock = threading.Lock()
+
+# Hashes of the Payload nodes this process has written, so their data is not sent again
+stored_payloads = set()
+
+
+def get_driver():
+    """Create the driver on first use and share it for the rest of the process"""
+    global driver
+    with driver_lock:
+        if driver is None:
+            driver = GraphDatabase.driver(URI, auth=AUTH)
+            driver.verify_connectivity()
+            atexit.register(driver.close)
+    return driver
+
+
+SCHEMA = [
+    # Every diff query selects the edges of one run by guid
+    "CREATE INDEX link_guid IF NOT EXISTS FOR ()-[r:LINK]-() ON (r.guid)",
+    "CREATE CONSTRAINT server_name IF NOT EXISTS FOR (s:Server) REQUIRE s.name IS UNIQUE",
+    "CREATE CONSTRAINT payload_sha256 IF NOT EXISTS FOR (p:Payload) REQUIRE p.sha256 IS UNIQUE",
+]
+schema_created = False
+
+
+def create_schema():
+    """Create the indexes and constraints used by telephone.py and diff.py, once per process"""
+    global schema_created
+    if schema_created:
+        return
+    with get_driver().session(database="neo4j") as session:
+        for statement in SCHEMA:
+            session.run(statement).consume()
+    schema_created = True
+
+
+def __create_servers(tx, names):
+    """Create new Server nodes with the given names, if not exists already"""
     result = tx.run(
         """
-        MERGE (p:Server {name: $name})
+        UNWIND $names AS name
+        MERGE (p:Server {name: name})
         RETURN p.name AS name
         """,
-        name=name,
+        names=names,
     )
-    return result
+    return [record["name"] for record in result]
 
 
 def create_nodes(nodes: list[str]):
@@ -41,39 +88,239 @@ def create_nodes(nodes: list[str]):
     NOTE: Functions in this file will throw errors/Exceptions.
     Especially when the connection to Neo4J fails
     """
-    with GraphDatabase.driver(URI, auth=AUTH) as driver:
-        driver.verify_connectivity()
-        with driver.session(database="neo4j") as session:
-            for name in nodes:
-                return_id = session.execute_write(__create_servers, name)
-                print(f"{name} {return_id}")
+    create_schema()
+    with get_driver().session(database="neo4j") as session:
+        names = session.execute_write(__create_servers, nodes)
+        print(f"Server nodes {names}")
+
+
+def __create_edges(tx, edges, payloads):
+    """Store new Payloads once per hash, then create new Edges referencing them, in list order"""
+    tx.run(
+        """
+        UNWIND $payloads AS payload
+        MERGE (p:Payload {sha256: payload.sha256})
+        ON CREATE SET p.data = payload.data
+        """,
+        payloads=payloads,
+    )
+    result = tx.run(
+        """
+        UNWIND $edges AS edge
+        MATCH (n1:Server {name: edge.node1}), (n2:Server {name: edge.node2})
+        CREATE (n1)-[p:LINK {
+            guid: edge.guid,
+            payload: edge.payload,
+            cached: edge.cached,
+            chain_length: edge.chain_length,
+            chain: edge.chain,
+            hop: edge.hop
+        }]->(n2)
+        RETURN count(p) AS created
+        """,
+        edges=edges,
+    )
+    return result.single()["created"]
+
+
+def write_edges(edges: list[dict]):
+    """Write a batch of edges built by edge_record in a single transaction"""
+    payloads = {e["payload"]: e["data"] for e in edges if e["data"] is not None}
+    links = [{k: v for k, v in e.items() if k != "data"} for e in edges]
+    with get_driver().session(database="neo4j") as session:
+        created = session.execute_write(
+            __create_edges,
+            links,
+            [{"sha256": sha256, "data": data} for sha256, data in payloads.items()],
+        )
+        print(f"Wrote {created} edges, {len(payloads)} new payloads")
+    stored_payloads.update(payloads)
+
+
+def edge_record(
+    guid: str,
+    node1: str,
+    node2: str,
+    json_string,
+    cached=False,
+    chain_length=None,
+    chain=None,
+    hop=None,
+):
+    """
+    Parameters of one LINK edge, as expected by __create_edges
+    The edge only carries the sha256 of the serialized payload. The compressed payload
+    itself is attached unless this process already stored it.
+    """
+    raw = json.dumps(json_string).encode("utf-8")
+    sha256 = hashlib.sha256(raw).hexdigest()
+    return {
+        "guid": guid,
+        "node1": node1,
+        "node2": node2,
+        "payload": sha256,
+        "data": None if sha256 in stored_payloads else zlib.compress(raw),
+        "cached": cached,
+        "chain_length": chain_length,
+        "chain": chain,
+        "hop": hop,
+    }
 
 
-def __create_edges(tx, guid, node1, node2, json_string):
-    """Create new Edges"""
+def __read_path_bound(tx, guid):
+    """Recorded chain length and number of edges of a run"""
     result = tx.run(
         """
-        MATCH (n1:Server {name: $node1}), (n2:Server {name: $node2})
-        CREATE (n1)-[p:LINK {guid: $guid, json: $json_string}]->(n2)
-        RETURN p.guid AS guid
+        MATCH ()-[r:LINK {guid: $guid}]->()
+        RETURN max(r.chain_length) AS chain_length, count(r) AS edges
         """,
-        node1=node1,
-        node2=node2,
         guid=guid,
-        json_string=json.dumps(json_string),
     )
-    return result
+    return result.single()
+
+
+def max_path_length(guid: str):
+    """
+    Upper bound on the number of edges in a start-to-end path of a run
+    A chain of n servers has n + 1 edges. Runs recorded before chain_length was stored
+    fall back to their edge count.
+    """
+    with get_driver().session(database="neo4j") as session:
+        record = session.execute_read(__read_path_bound, guid)
+    if record["chain_length"] is not None:
+        return record["chain_length"] + 1
+    return record["edges"]
+
+
+def __read_payloads(tx, hashes):
+    """Fetch the compressed data of the given Payloads"""
+    result = tx.run(
+        """
+        UNWIND $hashes AS sha256
+        MATCH (p:Payload {sha256: sha256})
+        RETURN p.sha256 AS sha256, p.data AS data
+        """,
+        hashes=hashes,
+    )
+    return {record["sha256"]: record["data"] for record in result}
+
+
+def load_payloads(hashes):
+    """
+    Fetch payloads by hash
+    Returns a dict of sha256 to the serialized JSON string, the same value
+    that edges used to carry in their json property
+    """
+    with get_driver().session(database="neo4j") as session:
+        payloads = session.execute_read(__read_payloads, list(hashes))
+    return {
+        sha256: zlib.decompress(data).decode("utf-8")
+        for sha256, data in payloads.items()
+    }
 
 
-def create_edge(guid: str, node1: str, node2: str, json_string):
+def create_edge(
+    guid: str,
+    node1: str,
+    node2: str,
+    json_string,
+    cached=False,
+    chain_length=None,
+    chain=None,
+    hop=None,
+):
     """
     Create edges for various Servers and other metadata
+    cached marks edges whose hop was replayed from the hop cache
+    chain_length is the number of servers in the chain, it bounds the diff.py path queries
+    chain lists the servers of the chain up to the edge and hop is the edge's position
+    in it. Chains of a run share their prefixes, so this identifies the edge within
+    the run, and diff.py only follows edges of one chain.
     """
     print(f"{guid} {node1} {node2}")
-    with GraphDatabase.driver(URI, auth=AUTH) as driver:
-        driver.verify_connectivity()
-        with driver.session(database="neo4j") as session:
-            return_id = session.execute_write(
-                __create_edges, guid, node1, node2, json_string
-            )
-            print(f"{guid} {return_id}")
+    write_edges(
+        [edge_record(guid, node1, node2, json_string, cached, chain_length, chain, hop)]
+    )
+
+
+class EdgeWriter:
+    """
+    Buffer edges and write them in batched transactions
+    Edges keep the order they were added in, which diff.py relies on.
+    A batch is written when it is full, max_seconds after its first edge was queued
+    (by a timer, so a chain stalled on a slow server does not hold its edges back),
+    or when flush() is called at the end of a chain or run.
+    """
+
+    def __init__(self, max_edges=EDGE_BATCH_SIZE, max_seconds=EDGE_BATCH_SECONDS):
+        self.max_edges = max_edges
+        self.max_seconds = max_seconds
+        self.edges = []
+        self.timer = None
+        # error of a batch the timer failed to write, raised by the next flush()
+        self.error = None
+        self.lock = threading.Lock()
+
+    def add(
+        self,
+        guid: str,
+        node1: str,
+        node2: str,
+        json_string,
+        cached=False,
+        chain_length=None,
+        chain=None,
+        hop=None,
+    ):
+        """Queue an edge, see create_edge"""
+        print(f"{guid} {node1} {node2}")
+        edge = edge_record(
+            guid, node1, node2, json_string, cached, chain_length, chain, hop
+        )
+        with self.lock:
+            if not self.edges:
+                self._start_timer()
+            self.edges.append(edge)
+            due = len(self.edges) >= self.max_edges
+        if due:
+            self.flush()
+
+    def flush(self):
+        """
+        Write all queued edges
+        Raises the error of a batch the timer failed to write, after writing its edges
+        """
+        # The lock is held while writing so concurrent batches reach Neo4j in order
+        with self.lock:
+            error, self.error = self.error, None
+            self._write()
+        if error is not None:
+            raise error
+
+    def _start_timer(self):
+        self.timer = threading.Timer(self.max_seconds, self._flush_stale)
+        self.timer.daemon = True
+        self.timer.start()
+
+    def _flush_stale(self):
+        """Write the batch from the timer thread, a failed batch stays queued and is
+        retried by the next timer or flush()"""
+        with self.lock:
+            try:
+                self._write()
+            except Exception as e:
+                self.error = e
+                self._start_timer()
+
+    def _write(self):
+        """Write all queued edges, the lock must be held"""
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        edges, self.edges = self.edges, []
+        if edges:
+            try:
+                write_edges(edges)
+            except Exception:
+                self.edges = edges + self.edges
+                raise
@@ -5,45 +5,61 @@ Compare input and output patient data files passing through different FHIR nodes
 import json
 import re
 import textwrap
-import os
+from itertools import repeat
+from concurrent.futures import ProcessPoolExecutor
 
 import click
 import xmltodict
 from defusedxml.ElementTree import fromstring, ParseError
 from tabulate import tabulate
-from neo4j import GraphDatabase
 from deepdiff import DeepDiff
 
+import db
 from llm_4_diff import gpt_diff_output
+from diff_cache import DiffCache
+from utils.canonical import identical
+from fhir_diff import fhir_diff
 
 from cli_options import add_diff_options
 
-neo4j_env = os.getenv("COMPOSE_PROFILES", "neo4jDev")
 
-if neo4j_env == "neo4jDev":
-    URI = "neo4j://localhost:7687"
-    AUTH = ("neo4j", "fhir-garden")
-elif neo4j_env == "neo4jTest":
-    URI = "neo4j://localhost:7688"
-    AUTH = ("neo4j", "test-garden")
+def run_query(query, params=None):
+    """Execute Cypher query on the shared driver"""
+    try:
+        with db.get_driver().session(database="neo4j") as session:
+            result = session.run(query, parameters=params)
+            paths = [record["path"] for record in result]
+            if not paths:
+                print("No paths found matching the criteria.")
+            return paths
+    except Exception as e:
+        print(f"Error {e} verifying db connection")
 
 
-def run_query(query, params=None):
-    """Connect to db and execute Cypher query"""
-    with GraphDatabase.driver(URI, auth=AUTH) as driver:
-        try:
-            driver.verify_connectivity()
-            # print("Connection to db successful.")
-            with driver.session(database="neo4j") as session:
-                result = session.run(query, parameters=params)
-                paths = [record["path"] for record in result]
-                if not paths:
-                    print("No paths found matching the criteria.")
-                return paths
-        except Exception as e:
-            print(f"Error {e} verifying db connection")
-        finally:
-            driver.close()
+# Options passed to DeepDiff, part of the diff cache key
+DEEPDIFF_OPTIONS = {"ignore_order": False}
+
+# Diff whole documents with DeepDiff, or FHIR Bundles resource by resource, see fhir_diff.py
+DIFF_ENGINES = {"deepdiff": DeepDiff, "fhir": fhir_diff}
+
+# Diffs of payload pairs already compared in earlier runs, see diff_cache.py
+diff_cache = DiffCache()
+
+# Payloads fetched so far by sha256, so each one is loaded at most once per run
+payload_cache = {}
+
+
+def edge_payload(relationship):
+    """
+    Serialized JSON carried by an edge, loaded from its Payload node on first use
+    Edges written before the payload store carry the JSON inline
+    """
+    sha256 = relationship.get("payload", None)
+    if sha256 is None:
+        return relationship.get("json", None)
+    if sha256 not in payload_cache:
+        payload_cache.update(db.load_payloads([sha256]))
+    return payload_cache.get(sha256)
 
 
 def clean_string_from_file(file):
@@ -53,12 +69,15 @@ def clean_string_from_file(file):
     return file
 
 
-def compare_function(file1, file2, file_type, diff_type):
-    """Compare two objects and return their differences using DeepDiff"""
+def compare_function(file1, file2, file_type, diff_type, engine="deepdiff"):
+    """Compare two objects and return their differences using the diff engine,
+    objects with the same canonical form are identical without running it"""
     if file_type.lower() == "xml":
         file1 = xmltodict.parse(clean_string_from_file(file1))
         file2 = xmltodict.parse(clean_string_from_file(file2))
-    diff = DeepDiff(file1, file2, ignore_order=False)
+    if identical(file1, file2, DEEPDIFF_OPTIONS["ignore_order"]):
+        return True, f"{file_type} FHIR data is identical."
+    diff = DIFF_ENGINES[engine](file1, file2, **DEEPDIFF_OPTIONS)
     if not diff:
         return True, f"{file_type} FHIR data is identical."
     if diff_type == "summary":
@@ -80,6 +99,21 @@ def is_increasing_consecutive(numbers):
     return True
 
 
+def chain_path(path):
+    """
+    Check that a path follows a single chain, i.e. its n-th edge is hop n of the chain
+    of servers on the path. Concurrent chains of a run interleave their edges, so a
+    path can combine edges of different chains that happen to meet at a server.
+    """
+    servers = [relationship.end_node.get("name") for relationship in path.relationships]
+    for hop, relationship in enumerate(path.relationships):
+        if relationship.get("hop") != hop:
+            return False
+        if list(relationship.get("chain")) != servers[: min(hop + 1, len(servers) - 1)]:
+            return False
+    return True
+
+
 def xml_parse(xml_content):
     """Clean XML by replacing escaped newline characters with actual newlines"""
     corrected_xml = re.sub(
@@ -118,9 +152,101 @@ def check_xml(file):
     return clean_file.strip().startswith("<")
 
 
-def compare_paths(paths, chains, file_type, diff_type):
-    """Create struct for all segments of a path and internally compare those segments."""
+def diff_pair(file1, file2, source, file_type, diff_type, engine="deepdiff"):
+    """
+    Parse and compare the payloads of two consecutive links, source is the start node of the first
+    Runs in a worker process. Returns (match, result), or None when a payload is empty.
+    """
+    parse = json.loads if file_type.lower() == "json" else xml_parse
+    file1 = parse(file1)
+    file2 = parse(file2)
+
+    if not (file1 and file2):
+        return None
+    if source == "synthea" or source == "file":
+        if file_type.lower() == "json":
+            try:
+                file1 = json.loads(
+                    file1
+                )  # Need to load json twice as the data contains escaped spaces in string format
+            except json.JSONDecodeError as e:
+                print("Chain created, but input JSON is invalid:", e)
+                file1 = None
+                # Here, we say that the input file to a server is invalid, but then how did the server import it?
+                # We skip the compare path function and directly print an invalid message to the table.
+
+        else:
+            file1 = clean_string_from_file(file1)
+            file2 = clean_string_from_file(file2)
+
+    if file1 is not None:
+        return compare_function(file1, file2, file_type, diff_type, engine)
+    return False, f"Malformed {file_type} input. Cannot perform Diff."
+
+
+def run_diffs(jobs, file_type, diff_type, workers=None, engine="deepdiff"):
+    """
+    Run diff_pair for every (file1, file2, source) job and return the results in job order
+    Jobs are spread over a process pool of `workers` processes, default one per core
+    """
+    if not jobs:
+        return []
+    args = list(zip(*jobs)) + [
+        repeat(file_type, len(jobs)),
+        repeat(diff_type, len(jobs)),
+        repeat(engine, len(jobs)),
+    ]
+    if workers == 1 or len(jobs) == 1:
+        return list(map(diff_pair, *args))
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        return list(pool.map(diff_pair, *args))
+
+
+def cached_diffs(jobs, file_type, diff_type, workers=None, engine="deepdiff"):
+    """
+    Like run_diffs, but pairs found in the diff cache are not diffed again
+    and identical pairs within the run are only diffed once
+    """
+    keys = []
+    for file1, file2, source in jobs:
+        options = dict(
+            DEEPDIFF_OPTIONS,
+            diff_type=diff_type,
+            engine=engine,
+            # Input files are parsed differently, see diff_pair
+            initial=source == "synthea" or source == "file",
+        )
+        keys.append(diff_cache.key(file1, file2, file_type, options))
+
+    results = {}
+    missing = {}
+    for key, job in zip(keys, jobs):
+        if key in results or key in missing:
+            continue
+        cached = diff_cache.get(key)
+        if cached is None:
+            missing[key] = job
+        else:
+            results[key] = cached
+
+    computed = run_diffs(list(missing.values()), file_type, diff_type, workers, engine)
+    for key, result in zip(missing, computed):
+        diff_cache.put(key, result)
+        results[key] = result
+    return [results[key] for key in keys]
+
+
+def compare_paths(paths, chains, file_type, diff_type, workers=None, engine="deepdiff"):
+    """
+    Create struct for all segments of a path and internally compare those segments.
+    All link pairs are collected first and diffed in parallel, then printed in path order.
+    Pairs compared in earlier runs are read from the diff cache.
+    """
     edge_list = []
+    # (guid, chain links of each compared pair) for every table, in output order
+    tables = []
+    # (file1, file2, source) for every compared pair, in the same order
+    jobs = []
     for path in paths:
         # Dict to store json data by GUID. Each entry contains another dict with link number as key.
         json_data_map = {}
@@ -128,7 +254,10 @@ def compare_paths(paths, chains, file_type, diff_type):
 
         # Get path ids
         relationship_ids = [relationship.id for relationship in path.relationships]
-        if chains:
+        if all(r.get("hop") is not None for r in path.relationships):
+            chain_order = chain_path(path)
+        elif chains:
+            # Runs recorded before edges had a hop were written one chain at a time
             chain_order = is_increasing_consecutive(relationship_ids)
         else:
             chain_order = False if relationship_ids[0] in edge_list else True
@@ -137,18 +266,18 @@ def compare_paths(paths, chains, file_type, diff_type):
             # Each segment of the path will have relationships
             for relationship in path.relationships:
                 guid = relationship.get("guid", None)
-                json_data = relationship.get("json", None)
                 start_node_name = relationship.start_node.get("name", None)
                 end_node_name = relationship.end_node.get("name", None)
 
                 if guid not in json_data_map:
                     json_data_map[guid] = {}
 
-                # Store data by link number in sub-struct for corresponding GUID
+                # Store the edge by link number in sub-struct for corresponding GUID
+                # Its payload is only fetched if the link gets compared
                 json_data_map[guid][link_number] = (
                     start_node_name,
                     end_node_name,
-                    json_data,
+                    relationship,
                 )
                 link_number += 1
                 edge_list.append(
@@ -164,156 +293,144 @@ def compare_paths(paths, chains, file_type, diff_type):
                     continue
 
                 # Compare json data between consecutive link numbers within same guid
-                table_data = []
+                rows = []
                 for i in range(len(sorted_link_numbers) - 1):
                     current_link_number = sorted_link_numbers[i]
                     next_link_number = sorted_link_numbers[i + 1]
 
-                    file1 = links[current_link_number][2]
-                    file2 = links[next_link_number][2]
+                    file1 = edge_payload(links[current_link_number][2])
+                    file2 = edge_payload(links[next_link_number][2])
 
                     # Validating file with user input file_type
-                    if (
+                    if not (
                         check_json(file1)
                         and check_json(file2)
                         and file_type.lower() == "json"
-                    ):
-                        parse = json.loads
-                    elif (
+                    ) and not (
                         check_xml(file1)
                         and check_xml(file2)
                         and file_type.lower() == "xml"
                     ):
-                        parse = xml_parse
-                    else:
                         raise click.BadParameter("Re-check file type.")
 
-                    file1 = parse(file1)
-                    file2 = parse(file2)
-
-                    if file1 and file2:
-                        if (
-                            links[current_link_number][0] == "synthea"
-                            or links[current_link_number][0] == "file"
-                        ):
-                            if file_type.lower() == "json":
-                                try:
-                                    file1 = json.loads(
-                                        file1
-                                    )  # Need to load json twice as the data contains escaped spaces in string format
-                                except json.JSONDecodeError as e:
-                                    print(
-                                        "Chain created, but input JSON is invalid:", e
-                                    )
-                                    file1 = None
-                                    # Here, we say that the input file to a server is invalid, but then how did the server import it?
-                                    # We skip the compare path function and directly print an invalid message to the table.
-
-                            else:
-                                file1 = clean_string_from_file(file1)
-                                file2 = clean_string_from_file(file2)
-
-                        if file1 is not None:
-                            match, result = compare_function(
-                                file1, file2, file_type, diff_type
-                            )
-
-                        else:
-                            match = False
-                            result = (
-                                f"Malformed {file_type} input. Cannot perform Diff."
-                            )
-
-                        chain_links = f"{links[current_link_number][0]} -> {links[current_link_number][1]} and {links[next_link_number][0]} -> {links[next_link_number][1]}"
-
-                        # Wrap text for columns
-                        wrapped_guid = wrap_text(guid, 40)
-                        wrapped_chain_links = wrap_text(chain_links, 40)
-
-                        if diff_type == "summary":
-                            severity = result["Category"] if not match else "N/A"
-                            summary = result["Summary"] if not match else result
-
-                            wrapped_severity = wrap_text(severity, 20)
-                            wrapped_diff = wrap_text(summary, 60)
-
-                            table_data.append(
-                                [
-                                    wrapped_guid,
-                                    wrapped_chain_links,
-                                    wrapped_severity,
-                                    wrapped_diff,
-                                ]
-                            )
-                            table_data.append(["" * 40, "-" * 40, "-" * 20, "-" * 60])
-
-                        else:
-                            wrapped_diff = wrap_text(result, 60)
-                            table_data.append(
-                                [
-                                    wrapped_guid,
-                                    wrapped_chain_links,
-                                    wrapped_diff,
-                                ]
-                            )
-                            table_data.append(["" * 40, "-" * 40, "-" * 60])
-
-                if table_data:
-                    # Remove the last separator row
-                    table_data.pop()
-
-                    # Merge GUID column for consecutive rows with the same GUID
-                    current_guid = None
-                    for row in table_data:
-                        if row[1] == "-" * 40 or row[0] == current_guid:
-                            row[0] = ""
-                        else:
-                            current_guid = row[0]
-
-                    headers = (
-                        ["GUID", "Chain Links", "Severity", "Diff"]
-                        if diff_type == "summary"
-                        else ["GUID", "Chain Links", "Diff"]
-                    )
-                    print(
-                        tabulate(
-                            table_data,
-                            headers=headers,
-                            tablefmt="pretty",
-                        )
-                    )
-
-                # print("\n")
-
-        else:
-            pass
+                    chain_links = f"{links[current_link_number][0]} -> {links[current_link_number][1]} and {links[next_link_number][0]} -> {links[next_link_number][1]}"
+                    rows.append(chain_links)
+                    jobs.append((file1, file2, links[current_link_number][0]))
+                tables.append((guid, rows))
+
+    results = iter(cached_diffs(jobs, file_type, diff_type, workers, engine))
+    for guid, rows in tables:
+        table_data = []
+        for chain_links in rows:
+            outcome = next(results)
+            if outcome is None:
+                continue
+            match, result = outcome
+
+            # Wrap text for columns
+            wrapped_guid = wrap_text(guid, 40)
+            wrapped_chain_links = wrap_text(chain_links, 40)
+
+            if diff_type == "summary":
+                severity = result["Category"] if not match else "N/A"
+                summary = result["Summary"] if not match else result
+
+                wrapped_severity = wrap_text(severity, 20)
+                wrapped_diff = wrap_text(summary, 60)
+
+                table_data.append(
+                    [
+                        wrapped_guid,
+                        wrapped_chain_links,
+                        wrapped_severity,
+                        wrapped_diff,
+                    ]
+                )
+                table_data.append(["" * 40, "-" * 40, "-" * 20, "-" * 60])
+
+            else:
+                wrapped_diff = wrap_text(result, 60)
+                table_data.append(
+                    [
+                        wrapped_guid,
+                        wrapped_chain_links,
+                        wrapped_diff,
+                    ]
+                )
+                table_data.append(["" * 40, "-" * 40, "-" * 60])
+
+        if table_data:
+            # Remove the last separator row
+            table_data.pop()
+
+            # Merge GUID column for consecutive rows with the same GUID
+            current_guid = None
+            for row in table_data:
+                if row[1] == "-" * 40 or row[0] == current_guid:
+                    row[0] = ""
+                else:
+                    current_guid = row[0]
+
+            headers = (
+                ["GUID", "Chain Links", "Severity", "Diff"]
+                if diff_type == "summary"
+                else ["GUID", "Chain Links", "Diff"]
+            )
+            print(
+                tabulate(
+                    table_data,
+                    headers=headers,
+                    tablefmt="pretty",
+                )
+            )
 
 
 @click.command()
 @add_diff_options
-def diff_cli_options(guid, depth, all_depths, file_type, diff_type):
-    db_query(guid, depth, all_depths, file_type, diff_type)
+def diff_cli_options(
+    guid, depth, all_depths, file_type, diff_type, workers, no_cache, engine
+):
+    db_query(
+        guid, depth, all_depths, file_type, diff_type, workers, not no_cache, engine
+    )
 
 
-def db_query(guid, depth, all_depths, file_type, diff_type):
+def db_query(
+    guid,
+    depth,
+    all_depths,
+    file_type,
+    diff_type,
+    workers=None,
+    use_cache=True,
+    engine="deepdiff",
+):
     """Command line options to run comparisons"""
+    diff_cache.enabled = use_cache
 
     if guid:
         params = {"guid": guid}
+        db.create_schema()
         if depth == 1:
             # Search for paths with exactly one intermediate node, filtered by GUID
             query = """
-                MATCH path = (a:Server)-[:LINK*1..1]->(b:Server)-[:LINK*1..1]->(c:Server {name: 'end'})
-                WHERE a.name IN ['synthea', 'file'] AND ALL(r IN relationships(path) WHERE r.guid = $guid)
+                MATCH path = (a:Server WHERE a.name IN ['synthea', 'file'])
+                    -[:LINK {guid: $guid}]->(b:Server)
+                    -[:LINK {guid: $guid}]->(c:Server {name: 'end'})
                 RETURN path
             """
             chains = False  # Set flag where depth search is hardcoded to 1. TO DO: Change logic to work for depth > 1
         elif all_depths:
-            # Search for all paths, filtered by GUID
-            # TBD: --all-depths query takes too long to process, when diff.py is run in isolation with --all-chains generated guid
-            query = """
-                MATCH path = (a:Server)-[:LINK*]->(c:Server {name: 'end'})
-                WHERE a.name IN ['synthea', 'file'] AND ALL(r IN relationships(path) WHERE r.guid = $guid)
+            # Search for all paths, filtered by GUID while expanding and bounded by the
+            # recorded chain length, so only this run's edges are ever traversed
+            max_length = db.max_path_length(guid)
+            if max_length == 0:
+                print("No paths found matching the criteria.")
+                return
+            query = f"""
+                MATCH path = (a:Server WHERE a.name IN ['synthea', 'file'])
+                    (()-[:LINK {{guid: $guid}}]->()){{1,{max_length}}}
+                    (c:Server {{name: 'end'}})
                 RETURN path
             """
             chains = True  # Set flag to show that chain sequence is defined by user
@@ -324,7 +441,7 @@ def db_query(guid, depth, all_depths, file_type, diff_type):
         print("Please specify a GUID option.")
         return
     paths = run_query(query, params)
-    compare_paths(paths, chains, file_type, diff_type)
+    compare_paths(paths, chains, file_type, diff_type, workers, engine)
 
 
 if __name__ == "__main__":
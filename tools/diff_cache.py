@@ -0,0 +1,119 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim:fenc=utf-8
+#
+"""
+Persistent cache of pairwise diffs, so a pair of payloads that was already compared
+is not run through DeepDiff or the LLM summary again
+"""
+
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+
+base_path = os.path.abspath(os.path.join(os.path.dirname(__file__), "../"))
+CACHE_PATH = os.getenv(
+    "DIFF_CACHE", os.path.join(base_path, "files/cache/diffs.sqlite")
+)
+# Least recently used entries are evicted beyond this many
+CACHE_SIZE = int(os.getenv("DIFF_CACHE_SIZE", "10000"))
+
+
+def payload_hash(data):
+    """sha256 of a payload as stored on the edge, the same hash as db.edge_record"""
+    return hashlib.sha256(data.encode("utf-8")).hexdigest()
+
+
+class DiffCache:
+    """
+    Map (sha256 of file1, sha256 of file2, file type, diff options) to the (match, result)
+    returned by diff.diff_pair. Entries are evicted least recently used first.
+    """
+
+    def __init__(self, path=CACHE_PATH, max_entries=CACHE_SIZE):
+        self.path = path
+        self.max_entries = max_entries
+        self.enabled = True
+        self.lock = threading.Lock()
+        self.conn = None
+
+    def __connect(self):
+        """Open the database on first use, so importing this module has no side effects"""
+        if self.conn is None:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            self.conn = sqlite3.connect(self.path, check_same_thread=False)
+            self.conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS diffs (
+                    file1 TEXT,
+                    file2 TEXT,
+                    file_type TEXT,
+                    options TEXT,
+                    result TEXT,
+                    last_used REAL,
+                    PRIMARY KEY (file1, file2, file_type, options)
+                )
+                """
+            )
+            self.conn.execute(
+                "CREATE INDEX IF NOT EXISTS diffs_last_used ON diffs (last_used)"
+            )
+        return self.conn
+
+    @staticmethod
+    def key(file1, file2, file_type, options):
+        """Build the lookup key for a pair of serialized payloads and a dict of diff options"""
+        return (
+            payload_hash(file1),
+            payload_hash(file2),
+            file_type.lower(),
+            json.dumps(options, sort_keys=True),
+        )
+
+    def get(self, key):
+        """Return the stored (match, result) tuple or None, marking the entry as used"""
+        if not self.enabled:
+            return None
+        with self.lock:
+            conn = self.__connect()
+            row = conn.execute(
+                """
+                SELECT result FROM diffs
+                WHERE file1 = ? AND file2 = ? AND file_type = ? AND options = ?
+                """,
+                key,
+            ).fetchone()
+            if row is None:
+                return None
+            conn.execute(
+                """
+                UPDATE diffs SET last_used = ?
+                WHERE file1 = ? AND file2 = ? AND file_type = ? AND options = ?
+                """,
+                (time.time(),) + key,
+            )
+            conn.commit()
+        return tuple(json.loads(row[0]))
+
+    def put(self, key, result):
+        """Store the (match, result) tuple of a diff and evict the oldest entries"""
+        if not self.enabled or result is None:
+            return
+        with self.lock:
+            conn = self.__connect()
+            conn.execute(
+                "INSERT OR REPLACE INTO diffs VALUES (?, ?, ?, ?, ?, ?)",
+                key + (json.dumps(result), time.time()),
+            )
+            conn.execute(
+                """
+                DELETE FROM diffs WHERE rowid IN (
+                    SELECT rowid FROM diffs ORDER BY last_used DESC LIMIT -1 OFFSET ?
+                )
+                """,
+                (self.max_entries,),
+            )
+            conn.commit()
@@ -0,0 +1,188 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim:fenc=utf-8
+#
+"""
+Compare FHIR Bundles resource by resource. Entries are matched on their identity
+instead of their position, so a reordered bundle does not show up as thousands of
+positional changes
+"""
+
+from collections import defaultdict
+
+from deepdiff import DeepDiff
+
+from utils.canonical import identical
+
+
+def value(element):
+    """Primitive value of a JSON element or of an xmltodict element with a value attribute"""
+    if isinstance(element, dict) and "@value" in element:
+        return element["@value"]
+    return element
+
+
+def as_list(element):
+    """xmltodict returns a repeated element that occurs once as a single dict"""
+    if element is None:
+        return []
+    return element if isinstance(element, list) else [element]
+
+
+def bundle_of(document):
+    """Return (bundle, path of the bundle) if document is a FHIR Bundle, else None"""
+    if not isinstance(document, dict):
+        return None
+    if document.get("resourceType") == "Bundle":
+        return document, "root"
+    if list(document) == ["Bundle"] and isinstance(document["Bundle"], dict):
+        return document["Bundle"], "root['Bundle']"
+    return None
+
+
+def resource_of(entry):
+    """Return the (resourceType, resource) of a bundle entry in JSON or xmltodict form"""
+    resource = entry.get("resource") if isinstance(entry, dict) else None
+    if not isinstance(resource, dict):
+        return None, None
+    if "resourceType" in resource:
+        return resource["resourceType"], resource
+    if len(resource) == 1:
+        resource_type, inner = next(iter(resource.items()))
+        if isinstance(inner, dict):
+            return resource_type, inner
+    return None, None
+
+
+def entry_keys(entry):
+    """Identities an entry can be matched on, strongest first: its resource id, the id
+    at the end of its fullUrl, the fullUrl itself and the resource's identifiers"""
+    resource_type, resource = resource_of(entry)
+    if resource is None:
+        return []
+    keys = []
+    resource_id = value(resource.get("id"))
+    if resource_id is not None:
+        keys.append((resource_type, "id", str(resource_id)))
+    full_url = value(entry.get("fullUrl"))
+    if isinstance(full_url, str):
+        # urn:uuid:<id> and <base>/<type>/<id>
+        keys.append(
+            (resource_type, "id", full_url.rsplit(":", 1)[-1].rsplit("/", 1)[-1])
+        )
+        keys.append((resource_type, "fullUrl", full_url))
+    for identifier in as_list(resource.get("identifier")):
+        if isinstance(identifier, dict) and identifier.get("value") is not None:
+            keys.append(
+                (
+                    resource_type,
+                    "identifier",
+                    str(value(identifier.get("system"))),
+                    str(value(identifier["value"])),
+                )
+            )
+    return keys
+
+
+def match_entries(entries1, entries2):
+    """
+    Pair up the entries of two bundles and return (pairs, removed, added) as lists of
+    entry indices. Entries are matched on their identities first. Servers assign their own
+    ids, so remaining entries of the same resourceType are then paired in bundle order.
+    """
+    index = defaultdict(list)
+    for j, entry in enumerate(entries2):
+        for key in dict.fromkeys(entry_keys(entry)):
+            index[key].append(j)
+
+    matched = {}
+    used = set()
+    for i, entry in enumerate(entries1):
+        for key in entry_keys(entry):
+            j = next((j for j in index.get(key, ()) if j not in used), None)
+            if j is not None:
+                matched[i] = j
+                used.add(j)
+                break
+
+    unmatched = defaultdict(list)
+    for j, entry in enumerate(entries2):
+        if j not in used:
+            unmatched[resource_of(entry)[0]].append(j)
+    for i, entry in enumerate(entries1):
+        candidates = unmatched[resource_of(entry)[0]]
+        if i not in matched and candidates:
+            matched[i] = candidates.pop(0)
+            used.add(matched[i])
+
+    pairs = sorted(matched.items())
+    removed = [i for i in range(len(entries1)) if i not in matched]
+    added = [j for j in range(len(entries2)) if j not in used]
+    return pairs, removed, added
+
+
+def merge_diff(result, diff, prefix):
+    """Add the reports of a DeepDiff of a part of a bundle to result, with the paths
+    rewritten from root to prefix"""
+    for report, changes in diff.items():
+        if report == "deep_distance":
+            continue
+        if isinstance(changes, dict):
+            merged = result.setdefault(report, {})
+            for path, change in changes.items():
+                merged[prefix + path[len("root") :]] = change
+        else:
+            merged = result.setdefault(report, [])
+            merged.extend(prefix + path[len("root") :] for path in changes)
+
+
+def describe(entry):
+    """Short name of an entry for the added and removed reports, its resource's
+    type and id or else its fullUrl"""
+    resource_type, resource = resource_of(entry)
+    if resource is not None and value(resource.get("id")) is not None:
+        return f"{resource_type}/{value(resource.get('id'))}"
+    if isinstance(entry, dict) and entry.get("fullUrl") is not None:
+        return str(value(entry["fullUrl"]))
+    return resource_type
+
+
+def diff_bundles(bundle1, bundle2, prefix="root", **options):
+    """
+    Diff two bundles entry by entry with DeepDiff. Returns a dict of DeepDiff style
+    reports, plus resource_removed and resource_added for entries without a match
+    """
+    entries1 = as_list(bundle1.get("entry"))
+    entries2 = as_list(bundle2.get("entry"))
+    result = {}
+
+    # everything but the entries, e.g. type, total and meta
+    rest1 = {k: v for k, v in bundle1.items() if k != "entry"}
+    rest2 = {k: v for k, v in bundle2.items() if k != "entry"}
+    merge_diff(result, DeepDiff(rest1, rest2, **options), prefix)
+
+    pairs, removed, added = match_entries(entries1, entries2)
+    for i, j in pairs:
+        if identical(entries1[i], entries2[j], options.get("ignore_order", False)):
+            continue
+        diff = DeepDiff(entries1[i], entries2[j], **options)
+        merge_diff(result, diff, f"{prefix}['entry'][{i}]")
+    if removed:
+        result["resource_removed"] = {
+            f"{prefix}['entry'][{i}]": describe(entries1[i]) for i in removed
+        }
+    if added:
+        result["resource_added"] = {
+            f"{prefix}['entry'][{j}]": describe(entries2[j]) for j in added
+        }
+    return result
+
+
+def fhir_diff(document1, document2, **options):
+    """Diff two parsed FHIR documents, bundles by resource identity and anything else
+    with a plain DeepDiff. options are passed on to DeepDiff"""
+    bundle1 = bundle_of(document1)
+    bundle2 = bundle_of(document2)
+    if bundle1 is None or bundle2 is None or bundle1[1] != bundle2[1]:
+        return DeepDiff(document1, document2, **options)
+    return diff_bundles(bundle1[0], bundle2[0], bundle1[1], **options)
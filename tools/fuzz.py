@@ -43,19 +43,25 @@ class FuzzInputFilePath(click.Path):
 
 
 def fuzz(client, filename, count, no_wait):
-    res, data = client.fuzz(filename, count)
-    rlts = data.get("results", [])
-
-    if res != 200 or not rlts:
+    res, job = client.submit_fuzz(filename, count)
+    if res != 202:
         print(
             f"Failed to fuzz file {filename}. ",
             "Can only fuzz generated files or files in files/fhir subdirectory",
         )
         sys.exit(1)
-    if not no_wait:
+    if no_wait:
+        # the output names are known before the job finishes
+        print(f"Fuzzing {filename} in job {job['id']}", file=sys.stderr)
+        results = job["results"]
+    else:
         # wait for fuzz to finish before reading file
-        client.wait_until_done(filename)
-    files = [f"../files/fuzzed/{r['output_name']}" for r in rlts]
+        res, job = client.wait_job(job["id"])
+        if res != 200 or job["status"] != "done":
+            print(f"Failed to fuzz file {filename}: {job}")
+            sys.exit(1)
+        results = job["result"]["results"]
+    files = [f"../files/fuzzed/{r['output_name']}" for r in results]
     for f in files:
         # print names of created fuzzed files
         print(f)
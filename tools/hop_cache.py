@@ -0,0 +1,109 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim:fenc=utf-8
+#
+"""
+Persistent cache of hop results, so a payload that already went through a server
+is not uploaded and exported again on later runs
+"""
+
+import os
+import json
+import sqlite3
+import hashlib
+import threading
+
+base_path = os.path.abspath(os.path.join(os.path.dirname(__file__), "../"))
+CACHE_PATH = os.getenv("HOP_CACHE", os.path.join(base_path, "files/cache/hops.sqlite"))
+
+
+def payload_hash(data):
+    """sha256 of a hop input. Parsed JSON is hashed in its sorted-key serialization"""
+    if isinstance(data, bytes):
+        raw = data
+    elif isinstance(data, str):
+        raw = data.encode("utf-8")
+    else:
+        raw = json.dumps(data, sort_keys=True).encode("utf-8")
+    return hashlib.sha256(raw).hexdigest()
+
+
+class HopCache:
+    """
+    Map (payload hash, server, server fingerprint, file type, stage) to the result of a step.
+    The stage separates the first hop, which receives the raw file, from later hops,
+    which receive another server's export.
+    Only successful hops are stored, so a server that was down is retried on the next run.
+    """
+
+    def __init__(self, path=CACHE_PATH):
+        self.path = path
+        self.enabled = True
+        self.lock = threading.Lock()
+        self.conn = None
+
+    def __connect(self):
+        """Open the database on first use, so importing this module has no side effects"""
+        if self.conn is None:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            self.conn = sqlite3.connect(self.path, check_same_thread=False)
+            self.conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS hops (
+                    payload TEXT,
+                    server TEXT,
+                    fingerprint TEXT,
+                    file_type TEXT,
+                    stage TEXT,
+                    patient_id TEXT,
+                    response TEXT,
+                    export TEXT,
+                    PRIMARY KEY (payload, server, fingerprint, file_type, stage)
+                )
+                """
+            )
+        return self.conn
+
+    @staticmethod
+    def key(data, server, fingerprint, file_type, stage):
+        """
+        Build the lookup key for a hop
+        Must be computed before the step runs, as the clients modify parsed bundles in place
+        """
+        return (payload_hash(data), server, fingerprint, file_type, stage)
+
+    def get(self, key):
+        """Return the stored (patient_id, response, export) tuple or None"""
+        if not self.enabled:
+            return None
+        with self.lock:
+            row = (
+                self.__connect()
+                .execute(
+                    """
+                    SELECT patient_id, response, export FROM hops
+                    WHERE payload = ? AND server = ? AND fingerprint = ?
+                    AND file_type = ? AND stage = ?
+                    """,
+                    key,
+                )
+                .fetchone()
+            )
+        if row is None:
+            return None
+        return (row[0], json.loads(row[1]), json.loads(row[2]))
+
+    def put(self, key, result):
+        """Store the (patient_id, response, export) tuple returned by a client step"""
+        (patient_id, response, export) = result
+        if not self.enabled or patient_id is None:
+            return
+        # XML steps return the raw requests.Response for the upload
+        response = getattr(response, "text", response)
+        with self.lock:
+            conn = self.__connect()
+            conn.execute(
+                "INSERT OR REPLACE INTO hops VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                key + (str(patient_id), json.dumps(response), json.dumps(export)),
+            )
+            conn.commit()
@@ -80,6 +80,13 @@ def split_deepdiff_output(diff_output):
             old_value = value["old_value"]
             new_value = value["new_value"]
             chunks.append(f"Value Changed at {key}: from {old_value} to {new_value}")
+    # Bundle entries without a match in the other bundle, see fhir_diff.py
+    if "resource_added" in diff_output:
+        for key, resource in diff_output["resource_added"].items():
+            chunks.append(f"Resource Added at {key}: {resource}")
+    if "resource_removed" in diff_output:
+        for key, resource in diff_output["resource_removed"].items():
+            chunks.append(f"Resource Removed at {key}: {resource}")
 
     return chunks
 
@@ -37,7 +37,17 @@ def validate_file_type(file_type, file):
 
 @click.command()
 @add_chain_options
-def main(chain_length, file, generate, chain, all_chains, file_type, diff_type):
+def main(
+    chain_length,
+    workers,
+    no_cache,
+    file,
+    generate,
+    chain,
+    all_chains,
+    file_type,
+    diff_type,
+):
     """Construct cli command and sequentially run telephone.py and diff.py"""
     # Validate --generate and --file arguments
     if generate and file:
@@ -67,7 +77,15 @@ def main(chain_length, file, generate, chain, all_chains, file_type, diff_type):
 
     # Run telephone.py with either --generate or --file
     guid = telephone_function(
-        chain_length, file, generate, chain, all_chains, file_type, diff_type
+        chain_length,
+        file,
+        generate,
+        chain,
+        all_chains,
+        file_type,
+        diff_type,
+        workers,
+        not no_cache,
     )
     all_depths = False
     depth = 0
@@ -77,7 +95,7 @@ def main(chain_length, file, generate, chain, all_chains, file_type, diff_type):
     if all_chains:
         # Return results of depth = 1 only
         depth = 1
-    db_query(guid, depth, all_depths, file_type, diff_type)
+    db_query(guid, depth, all_depths, file_type, diff_type, use_cache=not no_cache)
 
 
 if __name__ == "__main__":
@@ -9,11 +9,14 @@ import os
 import sys
 import uuid
 import copy
+import threading
 import configparser
+from concurrent.futures import ThreadPoolExecutor
 import requests
 
 import db
 from cli_options import add_chain_options
+from hop_cache import HopCache
 
 import click
 from click_option_group import OptionGroup
@@ -52,6 +55,33 @@ client_map = {
     "blaze": blaze_client,
 }
 
+# Maximum number of in-flight steps per server when running --all-chains.
+# The VistA MUMPS listener handles one request at a time, so it is serialized.
+# IBM is serialized too: when an upload response does not identify the new Bundle,
+# the client takes the most recently updated one, which is only ours without
+# concurrent uploads.
+server_limits = {"vista": 1, "ibm": 1, "hapi": 4, "blaze": 4}
+server_semaphores = {
+    name: threading.BoundedSemaphore(limit) for name, limit in server_limits.items()
+}
+
+# Keeps the edges written by one step adjacent to each other in Neo4j
+db_lock = threading.Lock()
+
+# Edges are buffered for the run and written to Neo4j in batches
+edge_writer = db.EdgeWriter()
+
+# Results of hops already seen in earlier runs, see hop_cache.py
+hop_cache = HopCache()
+server_fingerprints = {}
+
+
+def server_fingerprint(step):
+    """Look up the software version of a server once per run"""
+    if step not in server_fingerprints:
+        server_fingerprints[step] = client_map[step].fingerprint()
+    return server_fingerprints[step]
+
 
 def validate_options(file_type, chain, all_chains):
     """Validate the combination of options."""
@@ -120,11 +150,56 @@ def process_chain(guid, first_node, chain, file, file_type):
         if error:
             print(f"Error encountered processing step {step_number}, node {step}")
             break
+    edge_writer.flush()
 
 
-def dfs(guid, first_node, counter, step, chain, chain_length, file, file_type):
+class ChainExecutor:
+    """
+    Run the subtrees of the all-chains search concurrently.
+    Each task processes a single hop and then schedules its children, so a child
+    still waits on its parent's output while independent subtrees overlap.
+    """
+
+    def __init__(self, max_workers):
+        self.pool = ThreadPoolExecutor(max_workers=max_workers)
+        self.pending = 0
+        self.errors = []
+        self.condition = threading.Condition()
+
+    def submit(self, fn, *args):
+        """Schedule fn(*args) and count it as pending until it returns"""
+        with self.condition:
+            self.pending += 1
+        self.pool.submit(self.__run, fn, *args)
+
+    def __run(self, fn, *args):
+        try:
+            fn(*args)
+        except Exception as e:
+            with self.condition:
+                self.errors.append(e)
+        finally:
+            with self.condition:
+                self.pending -= 1
+                if self.pending == 0:
+                    self.condition.notify_all()
+
+    def wait(self):
+        """Block until every scheduled task, including the ones they spawned, is done"""
+        with self.condition:
+            while self.pending > 0:
+                self.condition.wait()
+        self.pool.shutdown()
+        if self.errors:
+            raise self.errors[0]
+
+
+def dfs(
+    guid, first_node, counter, step, chain, chain_length, file, file_type, executor=None
+):
     """
     Run a depth-first search to compute all possible chains
+    With an executor, every child subtree is scheduled on it instead of being walked inline
     """
     error = False
     if len(chain) > 0:
@@ -146,16 +221,31 @@ def dfs(guid, first_node, counter, step, chain, chain_length, file, file_type):
     if error:
         return
     for node in list(config.keys()):
-        dfs(
-            guid,
-            first_node,
-            counter + 1,
-            node,
-            chain + [node],
-            chain_length,
-            file,
-            file_type,
-        )
+        if executor is None:
+            dfs(
+                guid,
+                first_node,
+                counter + 1,
+                node,
+                chain + [node],
+                chain_length,
+                file,
+                file_type,
+            )
+        else:
+            # Clients modify the parsed bundle in place, so every subtree gets its own copy
+            executor.submit(
+                dfs,
+                guid,
+                first_node,
+                counter + 1,
+                node,
+                chain + [node],
+                chain_length,
+                copy.deepcopy(file),
+                file_type,
+                executor,
+            )
 
 
 def process_step(
@@ -164,49 +254,79 @@ def process_step(
     """
     Process one entire step
     Checks if we got a patient id generated by ingesting a file. If not, we hit an error.
+    Hops already seen with the same input and server version are replayed from the cache.
     """
-    (patient_id, response_json_1, response_json_2) = client_map[step].step(
-        step_number, file, file_type
-    )
-    if patient_id is None:
-        print(
-            f"Chain terminated at step {step_number} {step} {response_json_1} {response_json_2}"
+    result = None
+    if hop_cache.enabled:
+        stage = "initial" if step_number == 0 else "relay"
+        key = hop_cache.key(file, step, server_fingerprint(step), file_type, stage)
+        result = hop_cache.get(key)
+    cached = result is not None
+    if cached:
+        print(f"Replaying cached result for step {step_number} {step}")
+    else:
+        with server_semaphores[step]:
+            result = client_map[step].step(step_number, file, file_type)
+        if hop_cache.enabled:
+            hop_cache.put(key, result)
+    (patient_id, response_json_1, response_json_2) = result
+
+    # Concurrent chains interleave their edges, so every edge records the servers
+    # of its chain so far and its position, see db.create_edge
+    servers = list(chain[: step_number + 1])
+
+    def add_edge(node1, node2, payload, hop=step_number):
+        edge_writer.add(
+            guid,
+            node1,
+            node2,
+            payload,
+            cached=cached,
+            chain_length=chain_length,
+            chain=servers,
+            hop=hop,
         )
-        """
-        Connection to this current node failed.
-        So either this node could not ingest the file or could not export
-        Either way, we create an edge to this node
-        and another edge from this node to terminated
-        Why: a JSON blob is returned when the node cannot ingest it
-        This way we also know clearly where it failed
-        """
-        if step_number == 0:
-            db.create_edge(guid, first_node, step, file)
-            db.create_edge(guid, step, "termination", response_json_2)
-        else:
-            db.create_edge(guid, chain[step_number - 1], step, file)
-            db.create_edge(guid, step, "termination", response_json_2)
-
-        return (True, response_json_2)
-        # We must not be terminating the entire run, just what cannot be reached after
-    if step_number == chain_length - 1 and step_number == 0:
-        # Last element
-        db.create_edge(guid, first_node, step, file)
-        db.create_edge(guid, step, "end", response_json_2)
-    elif step_number == 0:
-        """
-        If its the first hop then we need to read the first_node field
-        """
-        db.create_edge(guid, first_node, step, file)
-    elif step_number == chain_length - 1:
-        # Last element
-        db.create_edge(guid, chain[step_number - 1], step, file)
-        db.create_edge(guid, step, "end", response_json_2)
 
-    else:
-        db.create_edge(guid, chain[step_number - 1], step, file)
+    with db_lock:
+        if patient_id is None:
+            print(
+                f"Chain terminated at step {step_number} {step} {response_json_1} {response_json_2}"
+            )
+            """
+            Connection to this current node failed.
+            So either this node could not ingest the file or could not export
+            Either way, we create an edge to this node
+            and another edge from this node to terminated
+            Why: a JSON blob is returned when the node cannot ingest it
+            This way we also know clearly where it failed
+            """
+            if step_number == 0:
+                add_edge(first_node, step, file)
+                add_edge(step, "termination", response_json_2, step_number + 1)
+            else:
+                add_edge(chain[step_number - 1], step, file)
+                add_edge(step, "termination", response_json_2, step_number + 1)
+
+            return (True, response_json_2)
+            # We must not be terminating the entire run, just what cannot be reached after
+        if step_number == chain_length - 1 and step_number == 0:
+            # Last element
+            add_edge(first_node, step, file)
+            add_edge(step, "end", response_json_2, step_number + 1)
+        elif step_number == 0:
+            """
+            If its the first hop then we need to read the first_node field
+            """
+            add_edge(first_node, step, file)
+        elif step_number == chain_length - 1:
+            # Last element
+            add_edge(chain[step_number - 1], step, file)
+            add_edge(step, "end", response_json_2, step_number + 1)
+
+        else:
+            add_edge(chain[step_number - 1], step, file)
 
-    return (False, response_json_2)
+        return (False, response_json_2)
 
 
 chain_config = OptionGroup(
@@ -216,20 +336,48 @@ chain_config = OptionGroup(
 
 @click.command()
 @add_chain_options
-def cli_options(chain_length, file, generate, chain, all_chains, file_type, diff_type):
+def cli_options(
+    chain_length,
+    workers,
+    no_cache,
+    file,
+    generate,
+    chain,
+    all_chains,
+    file_type,
+    diff_type,
+):
     telephone_function(
-        chain_length, file, generate, chain, all_chains, file_type, diff_type
+        chain_length,
+        file,
+        generate,
+        chain,
+        all_chains,
+        file_type,
+        diff_type,
+        workers,
+        not no_cache,
     )
 
 
 def telephone_function(
-    chain_length, file, generate, chain, all_chains, file_type, diff_type
+    chain_length,
+    file,
+    generate,
+    chain,
+    all_chains,
+    file_type,
+    diff_type,
+    workers=8,
+    use_cache=False,
 ):
     """Command line options for the telephone.py script
     Vista takes a different format (Bundle Resource) as input, whereas others require a patient
+    The hop cache is only used when asked for, the command lines enable it unless --no-cache
     """
     check_connection(chain)  # Make sure all the images are up
     validate_options(file_type, chain, all_chains)
+    hop_cache.enabled = use_cache
     first_node = "file"  # By default assume that we are reading from a CLI file
     guid = str(uuid.uuid4())
 
@@ -264,12 +412,29 @@ def telephone_function(
             print("File creation failed from Synthea")
             sys.exit(1)
 
-    if all_chains:
-        # Traverse all the chains possible now
-        dfs(guid, first_node, 0, "", [], chain_length, file, file_type)
-    else:
-        # all chains not specified, so we specified specific hops
-        process_chain(guid, first_node, chain, file, file_type)
+    try:
+        if all_chains:
+            # Traverse all the chains possible now, running independent subtrees concurrently
+            executor = ChainExecutor(workers)
+            executor.submit(
+                dfs,
+                guid,
+                first_node,
+                0,
+                "",
+                [],
+                chain_length,
+                file,
+                file_type,
+                executor,
+            )
+            executor.wait()
+        else:
+            # all chains not specified, so we specified specific hops
+            process_chain(guid, first_node, chain, file, file_type)
+    finally:
+        # Write whatever is still buffered, also when a step raised
+        edge_writer.flush()
     return guid
 
 
@@ -10,17 +10,27 @@ analyzing the results
 from pathlib import Path
 import json
 import sys
-import shutil
 import logging
+import sqlite3
+import hashlib
+import time
+import threading
+import functools
+import contextlib
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 import click
-from clients.echo_clients import EchoClient, EHRMapping, Parsers
+from clients.echo_clients import EchoClient, EHRMapping, Langs, Parsers, link_result
 import deepdiff
 
 from utils import parser
+from utils.canonical import canonical_hash
 
 logger = logging.getLogger(__name__)
 logging.basicConfig()
 
+# Name of the analysis manifest kept in the output directory
+MANIFEST = "manifest.sqlite"
+
 
 class ResultEncoder(json.JSONEncoder):
     """Json serializer for deepdiff results"""
@@ -80,77 +90,215 @@ class OutputTree:
         return self._test_output_path(path, "input")
 
 
+def analyze_dir(item, diff_ignore_order=False, parsers=None):
+    """Diff every parser result in the result directory item against its
+    input.json and return the analysis entry as a json string. Results
+    that are byte-identical to the input or have the same canonical form
+    are reported as an empty diff without running DeepDiff"""
+    diffs = {}
+    errors = {}
+    raw = {}
+    orig = None
+    for result in item.iterdir():
+        if (
+            parsers
+            and result.stem not in parsers
+            or not result.exists()
+            or result.suffix != ".json"
+        ):
+            continue
+        with open(result, "rb") as f:
+            s = f.read()
+        if result.name == "vista.json" and s.startswith(b"{["):
+            # strip outer braces
+            s = s[1:-1]
+        s = s.strip()
+        raw[result.name] = s
+        try:
+            # liberally parse the parser's json output
+            o = parser.parse_expression(s)
+        except (ValueError, RecursionError) as e:
+            o = None
+            logger.info("failed to parse json at %s: %s", result, e)
+            errors[result.name] = f"parse error: {e.__dict__}"
+        if result.name == "input.json":
+            orig = o
+        else:
+            diffs[result.name] = o
+    results = []
+    # the input's canonical form is only needed if some result differs in bytes
+    changed = [k for k in diffs if k not in errors and raw[k] != raw.get("input.json")]
+    orig_hash = canonical_hash(orig, diff_ignore_order, True) if changed else None
+
+    # run diff against all results
+    for k, v in diffs.items():
+        if k in errors:
+            res = errors[k]
+        elif k not in changed or (
+            orig_hash is not None
+            and canonical_hash(v, diff_ignore_order, True) == orig_hash
+        ):
+            res = {}
+        else:
+            args = {
+                "get_deep_distance": True,
+                "ignore_encoding_errors": True,
+                "ignore_string_case": True,
+            }
+            if diff_ignore_order:
+                args["ignore_order"] = True
+            res = deepdiff.DeepDiff(orig, v, **args)
+        results.append({"parser": k, "results": res})
+    return (
+        '{"file": '
+        + json.dumps(str(item))
+        + ', "results":\n'
+        + json.dumps(results, sort_keys=True, indent=1, cls=ResultEncoder)
+        + " }"
+    )
+
+
+def has_diff(file_diff):
+    """True if any parser's result in an analysis entry differs from the input"""
+    return any(result["results"] for result in file_diff["results"])
+
+
+class Manifest:
+    """Record of the analysis of each result directory, stored in
+    output_dir and keyed on the directory and the diff options. Entries
+    are only reused while the fingerprint of the directory is unchanged"""
+
+    def __init__(self, output_dir):
+        self.conn = sqlite3.connect(output_dir / MANIFEST)
+        self.conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS results (
+                dir TEXT,
+                options TEXT,
+                fingerprint TEXT,
+                entry TEXT,
+                has_diff INTEGER,
+                last_used REAL,
+                PRIMARY KEY (dir, options)
+            )
+            """
+        )
+
+    @staticmethod
+    def fingerprint(item):
+        """Hash of the name, size and modification time of every json file in item"""
+        h = hashlib.sha256()
+        for path in sorted(item.glob("*.json")):
+            stat = path.stat()
+            h.update(f"{path.name}:{stat.st_size}:{stat.st_mtime_ns}\n".encode())
+        return h.hexdigest()
+
+    def get(self, item, options, fingerprint):
+        """Return the stored entry for item or None if it is missing or
+        stale, marking the entry as the latest analysis of item"""
+        row = self.conn.execute(
+            "SELECT entry FROM results WHERE dir = ? AND options = ? AND fingerprint = ?",
+            (str(item), options, fingerprint),
+        ).fetchone()
+        if row is None:
+            return None
+        self.conn.execute(
+            "UPDATE results SET last_used = ? WHERE dir = ? AND options = ?",
+            (time.time(), str(item), options),
+        )
+        self.conn.commit()
+        return row[0]
+
+    def put(self, item, options, fingerprint, entry):
+        """Store the analysis entry of item"""
+        self.conn.execute(
+            "INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?, ?)",
+            (
+                str(item),
+                options,
+                fingerprint,
+                entry,
+                has_diff(json.loads(entry)),
+                time.time(),
+            ),
+        )
+        self.conn.commit()
+
+    def prune(self, items):
+        """Forget result directories that are not in items any more"""
+        self.conn.execute("CREATE TEMP TABLE IF NOT EXISTS live (dir TEXT PRIMARY KEY)")
+        self.conn.execute("DELETE FROM live")
+        self.conn.executemany(
+            "INSERT OR IGNORE INTO live VALUES (?)", ((str(i),) for i in items)
+        )
+        self.conn.execute("DELETE FROM results WHERE dir NOT IN (SELECT dir FROM live)")
+        self.conn.commit()
+
+    def iter_diffs(self):
+        """Iterate over the latest analysis entry of each directory that has a diff"""
+        rows = self.conn.execute(
+            """
+            SELECT entry FROM results AS r
+            WHERE has_diff AND last_used = (
+                SELECT MAX(last_used) FROM results WHERE dir = r.dir
+            )
+            ORDER BY dir
+            """
+        )
+        for (entry,) in rows:
+            yield json.loads(entry)
+
+
 class Analyzer:
     """Class for analys parser results save to output_dir"""
 
     def __init__(self, output_dir):
         self.tree = OutputTree(output_dir)
+        self.manifest = Manifest(output_dir)
 
-    def run(self, diff_ignore_order=False, parsers=None):
+    def run(self, diff_ignore_order=False, parsers=None, workers=None, force=False):
         """Run amalysis on all results in output_dir, format output
-        as json and print to stdout"""
-        print("[")
-        first = True
+        as json and print to stdout. Result directories are analyzed by
+        a pool of `workers` processes, default one per core, and printed
+        in the order they are found. Directories whose files did not
+        change since the last run with the same options are read from the
+        manifest unless force is set"""
         if parsers:
             parsers = list(parsers) + ["input"]
-        # for each result directory
-        for item in self.tree.iter_results_dir():
-            diffs = {}
-            errors = {}
-            orig = None
-            print("analyzing", item, flush=True, file=sys.stderr)
-            for result in item.iterdir():
-                if (
-                    parsers
-                    and result.stem not in parsers
-                    or not result.exists()
-                    or result.suffix != ".json"
-                ):
-                    continue
-                with open(result, "rb") as f:
-                    s = f.read()
-                if result.name == "vista.json" and s.startswith(b"{["):
-                    # strip outer braces
-                    s = s[1:-1]
-                s = s.strip()
-                try:
-                    # liberally parse the parser's json output
-                    o = parser.parse_expression(s)
-                except (ValueError, RecursionError) as e:
-                    o = None
-                    logger.info("failed to parse json at %s: %s", result, e)
-                    errors[result.name] = f"parse error: {e.__dict__}"
-                if result.name == "input.json":
-                    orig = o
-                else:
-                    diffs[result.name] = o
-            results = []
-
-            # run diff against all results
-            for k, v in diffs.items():
-                if k not in errors:
-                    args = {
-                        "get_deep_distance": True,
-                        "ignore_encoding_errors": True,
-                        "ignore_string_case": True,
-                    }
-                    if diff_ignore_order:
-                        args["ignore_order"] = True
-                    res = deepdiff.DeepDiff(orig, v, **args)
-                else:
-                    res = errors[k]
-                results.append({"parser": k, "results": res})
-            # don't print comma if first in list
-            if first:
-                first = False
+        options = json.dumps(
+            {"ignore_order": diff_ignore_order, "parsers": sorted(parsers or [])}
+        )
+        items = list(self.tree.iter_results_dir())
+        self.manifest.prune(items)
+        fingerprints = [Manifest.fingerprint(item) for item in items]
+        cached = [
+            None if force else self.manifest.get(item, options, fingerprint)
+            for item, fingerprint in zip(items, fingerprints)
+        ]
+        stale = [item for item, entry in zip(items, cached) if entry is None]
+        analyze = functools.partial(
+            analyze_dir, diff_ignore_order=diff_ignore_order, parsers=parsers
+        )
+        print("[")
+        with contextlib.ExitStack() as stack:
+            if workers == 1 or len(stale) < 2:
+                entries = map(analyze, stale)
             else:
-                print(",")
-            print('{"file":', '"' + str(item) + '"', ', "results": ', flush=True)
-            print(
-                json.dumps(results, sort_keys=True, indent=1, cls=ResultEncoder),
-                "}",
-                flush=True,
-            )
+                pool = stack.enter_context(ProcessPoolExecutor(max_workers=workers))
+                entries = pool.map(analyze, stale)
+            for i, (item, fingerprint, entry) in enumerate(
+                zip(items, fingerprints, cached)
+            ):
+                if entry is None:
+                    entry = next(entries)
+                    self.manifest.put(item, options, fingerprint, entry)
+                    print("analyzed", item, f"({i + 1}/{len(items)})", file=sys.stderr)
+                else:
+                    print("unchanged", item, f"({i + 1}/{len(items)})", file=sys.stderr)
+                # don't print comma if first in list
+                if i:
+                    print(",")
+                print(entry, flush=True)
         print("]")
 
 
@@ -159,14 +307,32 @@ class TestManager:
     of EchoClient, input_dir is a directory containing the json files
     to be test and output_dir is where to write the parsing results"""
 
-    def __init__(self, client, input_dir, output_dir):
+    def __init__(
+        self, client, input_dir, output_dir, raw=False, workers=1, limits=None
+    ):
         self.tree = OutputTree(output_dir)
         self.input_dir = input_dir
         self.client = client
-
-    def test_file(self, path, force=False):
+        self.raw = raw
+        # concurrent requests per language server, limits overrides single languages
+        self.workers = workers
+        self.limits = limits or {}
+
+    def echo(self, ehr, data, output_file):
+        """POST data to a single parser and stream its echo to output_file,
+        then link it under the names of the EHRs that share the parser"""
+        r, _ = self.client.post(ehr, data, self.raw, output_file)
+        if r and r.ok:
+            logger.info("wrote results %s", output_file)
+            for alias in EHRMapping.iter_aliases(ehr):
+                link_result(output_file, output_file.with_stem(alias.ehr.value))
+
+    def test_file(self, path, force=False, submit=None):
         """Run the file at path through all the different parsers and
-        save the results in a single directory named after `path`"""
+        save the results in a single directory named after `path`.
+        submit(ehr, data, output_file) schedules each echo, by default
+        they run one after another"""
+        submit = submit or self.echo
         if str(path).startswith("/"):
             dst = Path(str(path)[1:])
         else:
@@ -178,26 +344,52 @@ class TestManager:
 
         # make result directory
         test_file_path.parent.mkdir(parents=True, exist_ok=True)
-        # save input file
-        shutil.copyfile(path, test_file_path)
-        # run test against all parsers
+        with open(path, "rb") as f:
+            data = f.read()
+        # save input file, an unchanged copy is left alone so that its
+        # modification time and thus its analysis in the manifest stay valid
+        if not (test_file_path.exists() and test_file_path.read_bytes() == data):
+            test_file_path.write_bytes(data)
+        # run test against all parsers, streaming each echo to its result file
         for ehr in EHRMapping.iter_unique():
             output_file = self.tree.test_ehr_path(dst, ehr.ehr)
-            if output_file.exists() and not force:
+            outputs = [output_file] + [
+                self.tree.test_ehr_path(dst, alias.ehr)
+                for alias in EHRMapping.iter_aliases(ehr)
+            ]
+            if all(p.exists() for p in outputs) and not force:
                 logger.info("results for %s exists, skipping", output_file)
                 continue
-            with open(path, "rb") as f:
-                r, v = self.client.post(ehr, f.read())
-            if r and r.ok:
-                logger.info("writing results %s", output_file)
-                logger.debug("%s: %s", ehr.ehr, v)
-                with open(output_file, "wb") as f:
-                    f.write(v)
+            submit(ehr, data, output_file)
 
     def run(self, force):
-        """Run test on every file in intput dir"""
-        for p in self.tree.iter_json_dir(self.input_dir):
-            self.test_file(p, force)
+        """Run test on every file in intput dir. Each language's echo
+        server gets its own pool of workers, so a slow server does not
+        hold up the others"""
+        sizes = {lang: self.limits.get(lang, self.workers) for lang in Langs}
+        pools = {
+            lang: ThreadPoolExecutor(size, thread_name_prefix=f"echo-{lang}")
+            for lang, size in sizes.items()
+        }
+        # bound the queued echoes, so files are only read shortly before they are sent
+        pending = threading.BoundedSemaphore(2 * sum(sizes.values()))
+
+        def done(future):
+            pending.release()
+            if future.exception() is not None:
+                logger.error("echo failed: %s", future.exception())
+
+        def submit(ehr, data, output_file):
+            pending.acquire()
+            future = pools[ehr.language].submit(self.echo, ehr, data, output_file)
+            future.add_done_callback(done)
+
+        try:
+            for p in self.tree.iter_json_dir(self.input_dir):
+                self.test_file(p, force, submit)
+        finally:
+            for pool in pools.values():
+                pool.shutdown()
 
 
 @click.group()
@@ -214,6 +406,20 @@ def cli(verbose, debug):
         logger.setLevel(logging.WARNING)
 
 
+def parse_limits(ctx, param, value):
+    """Turn LANG=N options into a dict of language to number of workers"""
+    limits = {}
+    for item in value:
+        lang, _, count = item.partition("=")
+        try:
+            limits[Langs(lang)] = int(count)
+        except ValueError:
+            raise click.BadParameter(f"expected LANG=N, got {item}")
+        if limits[Langs(lang)] < 1:
+            raise click.BadParameter(f"{lang} needs at least one worker")
+    return limits
+
+
 @cli.command()
 @click.option(
     "-i",
@@ -222,20 +428,21 @@ def cli(verbose, debug):
     default="output.json",
     help="Path to json file generated by `analyze` command",
 )
-def filter(input):
+@click.option(
+    "-m",
+    "--manifest",
+    type=click.Path(exists=True, file_okay=False, path_type=Path),
+    help="Read the latest results from the manifest in this output directory instead",
+)
+def filter(input, manifest):
     """Command to filter entries where no diff exists out of
     json-formatted alnalysis results"""
-    with open(input, "r") as f:
-        data = json.load(f)
-    filtered = []
-    for file_diff in data:
-        has_diff = False
-        for result in file_diff["results"]:
-            if result["results"]:
-                has_diff = True
-                break
-        if has_diff:
-            filtered.append(file_diff)
+    if manifest:
+        filtered = list(Manifest(manifest).iter_diffs())
+    else:
+        with open(input, "r") as f:
+            data = json.load(f)
+        filtered = [file_diff for file_diff in data if has_diff(file_diff)]
     print(json.dumps(filtered, indent=1))
 
 
@@ -257,11 +464,26 @@ def filter(input):
 @click.option(
     "--ignore-order", is_flag=True, help="Ignore order when performing deep diff"
 )
-def analyze(output_dir, ignore_order, parser):
+@click.option(
+    "-w",
+    "--workers",
+    type=click.IntRange(min=1),
+    default=None,
+    help="analysis processes, default is one per core",
+)
+@click.option(
+    "-f",
+    "--force",
+    is_flag=True,
+    help="analyze every result directory, even if the manifest has it",
+)
+def analyze(output_dir, ignore_order, parser, workers, force):
     """Analyze parser results and print a json representation of how
-    each parser's result differs from the input file to stdout"""
+    each parser's result differs from the input file to stdout. Results
+    are recorded in a manifest in output_dir, so only directories that
+    changed are analyzed again"""
     a = Analyzer(output_dir)
-    a.run(ignore_order, parser)
+    a.run(ignore_order, parser, workers, force)
 
 
 @cli.command()
@@ -303,7 +525,39 @@ def analyze(output_dir, ignore_order, parser):
     is_flag=True,
     help="force recreation of result file even if it exists",
 )
-def parse(input_dir, output_dir, pythonurl, clojureurl, vistaurl, javaurl, force):
+@click.option(
+    "--raw",
+    is_flag=True,
+    help="save the exact bytes of each echo instead of joining its lines",
+)
+@click.option(
+    "-w",
+    "--workers",
+    type=click.IntRange(min=1),
+    default=1,
+    help="concurrent requests to each language's echo server",
+)
+@click.option(
+    "-l",
+    "--limit",
+    "limits",
+    multiple=True,
+    callback=parse_limits,
+    metavar="LANG=N",
+    help="concurrent requests to one language's echo server, e.g. java=8",
+)
+def parse(
+    input_dir,
+    output_dir,
+    pythonurl,
+    clojureurl,
+    vistaurl,
+    javaurl,
+    force,
+    raw,
+    workers,
+    limits,
+):
     """Run all json files nested in output_dir through each parser
     variant and save results to output_dir. output_dir's structure is
     that a directory tree is created for each input file, with a
@@ -314,7 +568,7 @@ def parse(input_dir, output_dir, pythonurl, clojureurl, vistaurl, javaurl, force
 
     """
     client = EchoClient(javaurl, vistaurl, clojureurl, pythonurl)
-    mgr = TestManager(client, input_dir, output_dir)
+    mgr = TestManager(client, input_dir, output_dir, raw, workers, limits)
     mgr.run(force)
 
 
@@ -0,0 +1,61 @@
+"""
+Create unit tests for the canonical hash used to skip DeepDiff
+"""
+
+import sys
+import pytest
+from deepdiff import DeepDiff
+
+sys.path.append("..")
+from utils.canonical import canonical_hash, identical
+from utils.parser import parse_expression
+
+
+@pytest.mark.parametrize(
+    "obj1, obj2, options, expected",
+    [
+        ({"a": 1, "b": [1, 2]}, {"b": [1, 2], "a": 1}, {}, True),
+        ([1, 2], [2, 1], {}, False),
+        ([1, 2], [2, 1], {"ignore_order": True}, True),
+        ([[1, 2], 3], [3, [2, 1]], {"ignore_order": True}, True),
+        ("Abc", "aBC", {}, False),
+        ("Abc", "aBC", {"ignore_string_case": True}, True),
+        (1, 1.0, {}, False),
+        (1, True, {}, False),
+        ([1], (1,), {}, False),
+        (float("nan"), float("nan"), {}, False),
+        ({"A": 1, "a": 2}, {"a": 2, "A": 1}, {"ignore_string_case": True}, False),
+        (
+            parse_expression(b'{"a": [1, 2]}'),
+            parse_expression(b'{ "a" :\n  [1,2] }'),
+            {},
+            True,
+        ),
+        (
+            parse_expression(b'{"a": 1, "b": 2}'),
+            parse_expression(b'{"b": 2, "a": 1}'),
+            {},
+            False,
+        ),
+        (parse_expression(b"1.0"), parse_expression(b"1"), {}, False),
+        (
+            parse_expression(b'["X", TRUE]'),
+            parse_expression(b'["x", true]'),
+            {"ignore_string_case": True},
+            True,
+        ),
+    ],
+)
+def test_identical(obj1, obj2, options, expected):
+    """Only documents DeepDiff finds no difference between are identical"""
+    assert identical(obj1, obj2, **options) == expected
+    if expected:
+        assert not DeepDiff(obj1, obj2, **options)
+
+
+def test_no_canonical_form():
+    """Values DeepDiff never finds equal have no hash"""
+    assert canonical_hash([1, float("nan")]) is None
+    assert canonical_hash({1, 2}) is None
+    assert canonical_hash({"A": 1, "a": 1}) is not None
+    assert canonical_hash({"A": 1, "a": 1}, ignore_string_case=True) is None
@@ -0,0 +1,86 @@
+"""
+Create unit tests for the persistent cache of pairwise diffs
+"""
+
+import sys
+import itertools
+import pytest
+
+sys.path.append("..")
+import diff_cache
+from diff_cache import DiffCache
+
+FILE1 = '{"resourceType": "Bundle", "entry": []}'
+FILE2 = '{"resourceType": "Bundle", "entry": [{}]}'
+OPTIONS = {"ignore_order": False, "diff_type": "full", "engine": "deepdiff"}
+RESULT = (False, "{'iterable_item_added': {\"root['entry'][0]\": {}}}")
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """Advance the time used for last_used by one second per call"""
+    ticks = itertools.count(1000)
+    monkeypatch.setattr(diff_cache.time, "time", lambda: float(next(ticks)))
+
+
+@pytest.fixture
+def cache(tmp_path, clock):
+    return DiffCache(str(tmp_path / "cache" / "diffs.sqlite"), max_entries=3)
+
+
+def test_hit(cache):
+    """A stored diff is returned for the same payloads, file type and options"""
+    cache.put(DiffCache.key(FILE1, FILE2, "json", OPTIONS), RESULT)
+    assert cache.get(DiffCache.key(FILE1, FILE2, "JSON", dict(OPTIONS))) == RESULT
+    assert DiffCache(cache.path).get(DiffCache.key(FILE1, FILE2, "json", OPTIONS))
+
+
+@pytest.mark.parametrize(
+    "file1, file2, file_type, options",
+    [
+        (FILE2, FILE1, "json", OPTIONS),
+        (FILE1, FILE1, "json", OPTIONS),
+        (FILE1, FILE2, "xml", OPTIONS),
+        (FILE1, FILE2, "json", dict(OPTIONS, diff_type="summary")),
+        (FILE1, FILE2, "json", dict(OPTIONS, engine="fhir")),
+    ],
+)
+def test_miss(cache, file1, file2, file_type, options):
+    """Other payloads, their reverse order, file types and options are a miss"""
+    cache.put(DiffCache.key(FILE1, FILE2, "json", OPTIONS), RESULT)
+    assert cache.get(DiffCache.key(file1, file2, file_type, options)) is None
+
+
+def test_key_stability():
+    """Keys depend on the payloads and options only, not on the order of the options"""
+    options = dict(reversed(list(OPTIONS.items())))
+    key = DiffCache.key(FILE1, FILE2, "json", OPTIONS)
+    assert DiffCache.key(FILE1, FILE2, "json", options) == key
+    assert key == (
+        diff_cache.payload_hash(FILE1),
+        diff_cache.payload_hash(FILE2),
+        "json",
+        '{"diff_type": "full", "engine": "deepdiff", "ignore_order": false}',
+    )
+
+
+def test_eviction(cache):
+    """Beyond max_entries the least recently used entries are evicted"""
+    keys = [DiffCache.key(FILE1, str(i), "json", OPTIONS) for i in range(4)]
+    for key in keys[:3]:
+        cache.put(key, RESULT)
+    # Using the oldest entry makes the second one the least recently used
+    assert cache.get(keys[0]) == RESULT
+    cache.put(keys[3], RESULT)
+    assert [cache.get(key) is not None for key in keys] == [True, False, True, True]
+
+
+def test_disabled(cache):
+    """A disabled cache neither stores nor returns diffs, nor empty results"""
+    key = DiffCache.key(FILE1, FILE2, "json", OPTIONS)
+    cache.put(key, None)
+    assert cache.get(key) is None
+    cache.enabled = False
+    cache.put(key, RESULT)
+    cache.enabled = True
+    assert cache.get(key) is None
@@ -0,0 +1,105 @@
+"""
+Create unit tests for the incremental analysis of echo test results
+"""
+
+import os
+import sys
+import json
+import pytest
+from types import SimpleNamespace
+
+sys.path.append("..")
+import test_json_echo
+
+# Modification time the result files are moved back to after they were written
+PAST = (1_600_000_000, 1_600_000_000)
+
+
+class FakeClient:
+    """Echoes every document back unchanged, like a perfect parser"""
+
+    def post(self, who, data, raw=False, output=None):
+        with open(output, "wb") as f:
+            f.write(data)
+        return SimpleNamespace(ok=True), None
+
+
+@pytest.fixture
+def inputs(tmp_path):
+    input_dir = tmp_path / "input"
+    input_dir.mkdir()
+    paths = []
+    for name in ("a", "b", "c"):
+        path = input_dir / f"{name}.json"
+        path.write_text(json.dumps({"resourceType": "Patient", "id": name}))
+        paths.append(path)
+    return paths
+
+
+@pytest.fixture
+def analyzed(monkeypatch):
+    """Result directories analyzed by each Analyzer run"""
+    dirs = []
+    analyze_dir = test_json_echo.analyze_dir
+
+    def record(item, **options):
+        dirs.append(item.parent.name if item.name == "input.json" else item.name)
+        return analyze_dir(item, **options)
+
+    monkeypatch.setattr(test_json_echo, "analyze_dir", record)
+    return dirs
+
+
+def echo_all(manager, paths):
+    for path in paths:
+        manager.test_file(path)
+
+
+def age_results(output_dir):
+    """Move the modification time of every result file into the past, so that
+    rewriting a file always changes it"""
+    for dirpath, dirnames, filenames in os.walk(output_dir):
+        for filename in filenames:
+            if filename.endswith(".json"):
+                os.utime(os.path.join(dirpath, filename), PAST)
+
+
+def analyze(output_dir, analyzed):
+    """Run the analysis and return the names of the inputs that were analyzed"""
+    del analyzed[:]
+    test_json_echo.Analyzer(output_dir).run(workers=1)
+    return sorted(analyzed)
+
+
+def test_rerun_unchanged(tmp_path, inputs, analyzed, capsys):
+    """Echoing unchanged files again does not make their analysis stale"""
+    output_dir = tmp_path / "output"
+    manager = test_json_echo.TestManager(FakeClient(), inputs[0].parent, output_dir)
+    echo_all(manager, inputs)
+    age_results(output_dir)
+    assert analyze(output_dir, analyzed) == ["a.json", "b.json", "c.json"]
+
+    echo_all(manager, inputs)
+    capsys.readouterr()
+    assert analyze(output_dir, analyzed) == []
+    progress = capsys.readouterr().err.splitlines()
+    assert len(progress) == 3
+    assert all(line.startswith("unchanged ") for line in progress)
+
+
+def test_changed_output(tmp_path, inputs, analyzed, capsys):
+    """Only the result directory whose output changed is analyzed again"""
+    output_dir = tmp_path / "output"
+    manager = test_json_echo.TestManager(FakeClient(), inputs[0].parent, output_dir)
+    echo_all(manager, inputs)
+    age_results(output_dir)
+    analyze(output_dir, analyzed)
+
+    result_dir = manager.tree.test_file_path(str(inputs[1])[1:]).parent
+    output = next(p for p in result_dir.glob("*.json") if p.name != "input.json")
+    output.write_text(json.dumps({"resourceType": "Patient", "id": "changed"}))
+    echo_all(manager, inputs)
+    capsys.readouterr()
+    assert analyze(output_dir, analyzed) == ["b.json"]
+    # unchanged directories are still reported, from the manifest
+    assert len(json.loads(capsys.readouterr().out)) == 3
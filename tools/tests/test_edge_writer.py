@@ -0,0 +1,87 @@
+"""
+Create unit tests for the batched Neo4j edge writes
+"""
+
+import sys
+import time
+import pytest
+
+sys.path.append("..")
+import db
+from db import EdgeWriter
+
+
+class FlakyNeo4j:
+    """Stands in for write_edges, rejecting batches while down"""
+
+    def __init__(self):
+        self.down = False
+        self.batches = []
+
+    def write_edges(self, edges):
+        if self.down:
+            raise ConnectionError("Neo4j rejected the batch")
+        self.batches.append([(e["node1"], e["node2"], e["hop"]) for e in edges])
+
+
+@pytest.fixture
+def neo4j(monkeypatch):
+    neo4j = FlakyNeo4j()
+    monkeypatch.setattr(db, "write_edges", neo4j.write_edges)
+    return neo4j
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.01)
+
+
+def test_full_batch(neo4j):
+    """A full batch is written at once, in the order edges were added"""
+    writer = EdgeWriter(max_edges=2, max_seconds=60)
+    writer.add("guid", "synthea", "hapi", {}, hop=0)
+    assert neo4j.batches == []
+    writer.add("guid", "hapi", "blaze", {}, hop=1)
+    assert neo4j.batches == [[("synthea", "hapi", 0), ("hapi", "blaze", 1)]]
+    assert writer.timer is None
+
+
+def test_timer_flush(neo4j):
+    """A batch that is not full is written max_seconds after its first edge"""
+    writer = EdgeWriter(max_edges=10, max_seconds=0.05)
+    writer.add("guid", "synthea", "hapi", {}, hop=0)
+    wait_for(lambda: neo4j.batches)
+    assert neo4j.batches == [[("synthea", "hapi", 0)]]
+    writer.flush()
+    assert len(neo4j.batches) == 1
+
+
+def test_timer_flush_failed(neo4j):
+    """A batch the timer fails to write stays queued and flush() raises its error"""
+    neo4j.down = True
+    writer = EdgeWriter(max_edges=10, max_seconds=0.05)
+    writer.add("guid", "synthea", "hapi", {}, hop=0)
+    wait_for(lambda: writer.error is not None)
+    writer.add("guid", "hapi", "blaze", {}, hop=1)
+    neo4j.down = False
+    with pytest.raises(ConnectionError):
+        writer.flush()
+    # retried once Neo4j is back, in order, whether by a later timer or the flush
+    edges = [edge for batch in neo4j.batches for edge in batch]
+    assert edges == [("synthea", "hapi", 0), ("hapi", "blaze", 1)]
+    writer.flush()
+    assert writer.edges == []
+
+
+def test_flush_failed(neo4j):
+    """A failed flush() raises and keeps its edges for the next one"""
+    writer = EdgeWriter(max_edges=10, max_seconds=60)
+    writer.add("guid", "synthea", "hapi", {}, hop=0)
+    neo4j.down = True
+    with pytest.raises(ConnectionError):
+        writer.flush()
+    neo4j.down = False
+    writer.flush()
+    assert neo4j.batches == [[("synthea", "hapi", 0)]]
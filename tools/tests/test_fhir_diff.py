@@ -0,0 +1,118 @@
+"""
+Create unit tests for the resource-by-resource FHIR Bundle diff
+"""
+
+import sys
+import copy
+import json
+import pytest
+import xmltodict
+from deepdiff import DeepDiff
+
+sys.path.append("..")
+from fhir_diff import fhir_diff, match_entries
+from llm_4_diff import split_deepdiff_output
+
+BUNDLE = "./test_files/Suzanne628_Jesus702_Stehr398_1589ce57-c816-e5d4-744e-a0e9899bab32.json"
+XML_BUNDLE = "./test_files/Elena945_Sipes176.xml"
+
+
+def entry(resource_type, resource_id=None, full_url=None, **fields):
+    """Build a bundle entry"""
+    resource = {"resourceType": resource_type, **fields}
+    if resource_id is not None:
+        resource["id"] = resource_id
+    result = {"resource": resource}
+    if full_url is not None:
+        result["fullUrl"] = full_url
+    return result
+
+
+@pytest.fixture(scope="module")
+def bundle():
+    with open(BUNDLE) as f:
+        return json.load(f)
+
+
+@pytest.mark.parametrize(
+    "entries1, entries2, expected",
+    [
+        (
+            [entry("Patient", "a"), entry("Observation", "b")],
+            [entry("Observation", "b"), entry("Patient", "a")],
+            ([(0, 1), (1, 0)], [], []),
+        ),
+        (
+            [entry("Patient", full_url="urn:uuid:a")],
+            [entry("Patient", "a", "http://hapi/fhir/Patient/a")],
+            ([(0, 0)], [], []),
+        ),
+        (
+            [entry("Patient", "a", identifier=[{"system": "s", "value": "1"}])],
+            [entry("Patient", "7", identifier=[{"system": "s", "value": "1"}])],
+            ([(0, 0)], [], []),
+        ),
+        (
+            [entry("Observation", "a"), entry("Observation", "b")],
+            [entry("Observation", "1"), entry("Encounter", "2")],
+            ([(0, 0)], [1], [1]),
+        ),
+    ],
+)
+def test_match_entries(entries1, entries2, expected):
+    """Entries match on id, fullUrl and identifiers, then by position within a type"""
+    assert match_entries(entries1, entries2) == expected
+
+
+def test_reordered_bundle_is_identical(bundle):
+    """Moving entries around is not a difference"""
+    other = copy.deepcopy(bundle)
+    other["entry"].reverse()
+    assert fhir_diff(bundle, other) == {}
+    assert DeepDiff(bundle, other)
+
+
+def test_bundle_changes(bundle):
+    """Changed resources are diffed in place, unmatched entries are added or removed"""
+    other = copy.deepcopy(bundle)
+    other["entry"][5]["resource"]["status"] = "changed"
+    removed = other["entry"].pop(10)
+    other["entry"].reverse()
+    other["entry"].append(entry("Basic", "new"))
+    diff = fhir_diff(bundle, other)
+    assert diff["values_changed"] == {
+        "root['entry'][5]['resource']['status']": {
+            "new_value": "changed",
+            "old_value": bundle["entry"][5]["resource"]["status"],
+        }
+    }
+    assert diff["resource_removed"] == {"root['entry'][10]": removed["fullUrl"]}
+    assert diff["resource_added"] == {
+        f"root['entry'][{len(other['entry']) - 1}]": "Basic/new"
+    }
+
+
+def test_xml_bundle():
+    """Bundles parsed by xmltodict are matched the same way"""
+    with open(XML_BUNDLE) as f:
+        bundle = xmltodict.parse(f.read())
+    other = copy.deepcopy(bundle)
+    other["Bundle"]["entry"].reverse()
+    assert fhir_diff(bundle, other) == {}
+
+
+def test_not_a_bundle():
+    """Anything but two bundles falls back to DeepDiff"""
+    assert fhir_diff({"resourceType": "Patient"}, [1]) == DeepDiff(
+        {"resourceType": "Patient"}, [1]
+    )
+
+
+def test_summary_chunks():
+    """Added and removed resources reach the diff summary"""
+    bundle1 = {"resourceType": "Bundle", "entry": [entry("Patient", "a")]}
+    bundle2 = {"resourceType": "Bundle", "entry": [entry("Observation", "b")]}
+    assert split_deepdiff_output(fhir_diff(bundle1, bundle2)) == [
+        "Resource Added at root['entry'][0]: Observation/b",
+        "Resource Removed at root['entry'][0]: Patient/a",
+    ]
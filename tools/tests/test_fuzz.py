@@ -0,0 +1,204 @@
+"""
+Create unit tests for fuzzing generated files on the Synthea server
+"""
+
+import sys
+import os
+import json
+import random
+import multiprocessing
+from concurrent.futures import Future, ProcessPoolExecutor
+import pytest
+
+sys.path.append(
+    os.path.abspath(os.path.join(os.path.dirname(__file__), "../../ehr-garden/synthea"))
+)
+pytest.importorskip("pyjfuzz.lib")
+from fuzzer import fuzz
+
+PATIENT = {
+    "resourceType": "Patient",
+    "id": "1589ce57",
+    "active": True,
+    "name": [{"family": "Stehr398", "given": ["Suzanne628", "Jesus702"]}],
+    "telecom": [{"system": "phone", "value": "555-613-2771", "use": "home"}],
+    "birthDate": "1967-02-13",
+    "multipleBirthBoolean": False,
+}
+SEEDS = [7, 2**63, 12345, 99, 2**40 + 1]
+
+
+@pytest.fixture
+def seed_file(tmp_path):
+    path = tmp_path / "patient.json"
+    path.write_text(json.dumps(PATIENT))
+    fuzz.load_fuzzer.cache_clear()
+    return str(path)
+
+
+def fuzz_seeds(seed_file, out_dir, seeds):
+    """Fuzz seed_file in this process, as a worker does, once per seed"""
+    outputs = []
+    for i, seed in enumerate(seeds):
+        output = out_dir / f"{i}.json"
+        fuzz.fuzz_file(seed_file, str(output), seed)
+        outputs.append(output.read_bytes())
+    return outputs
+
+
+def fuzz_on_pool(seed_file, out_dir, seeds, workers):
+    """Fuzz seed_file on fresh worker processes, once per seed"""
+    context = multiprocessing.get_context("forkserver")
+    with ProcessPoolExecutor(max_workers=workers, mp_context=context) as pool:
+        outputs = [str(out_dir / f"{workers}.{i}.json") for i in range(len(seeds))]
+        for future in [
+            pool.submit(fuzz.fuzz_file, seed_file, output, seed)
+            for output, seed in zip(outputs, seeds)
+        ]:
+            future.result()
+    return [open(output, "rb").read() for output in outputs]
+
+
+def test_fresh_and_reused_worker(seed_file, tmp_path):
+    """A seed gives the same bytes on a fresh worker and after other events"""
+    (fresh,) = fuzz_seeds(seed_file, tmp_path, [SEEDS[0]])
+    fuzz_seeds(seed_file, tmp_path, SEEDS[1:])
+    assert fuzz.load_fuzzer.cache_info().currsize == 1
+    (reused,) = fuzz_seeds(seed_file, tmp_path, [SEEDS[0]])
+    assert reused == fresh
+
+
+def test_mutators_seeded(seed_file, tmp_path):
+    """Payloads the mutators draw when they are built only depend on the event
+    seed, not on the random state of the worker that loaded the seed file"""
+    payloads = []
+    for worker_state in (1, 2):
+        fuzz.load_fuzzer.cache_clear()
+        random.seed(worker_state)
+        fuzz_seeds(seed_file, tmp_path, [SEEDS[0]])
+        fuzzer = fuzz.load_fuzzer(seed_file, os.stat(seed_file).st_mtime_ns)
+        payloads.append(fuzzer.mutator.decorators.Mutators.polyglot_attacks)
+    assert payloads[0] == payloads[1]
+
+
+def test_seed_intact(seed_file, tmp_path):
+    """The cached fuzzer never mutates the parsed seed it keeps"""
+    fuzz_seeds(seed_file, tmp_path, SEEDS)
+    fuzzer = fuzz.load_fuzzer(seed_file, os.stat(seed_file).st_mtime_ns)
+    assert fuzzer.config.json == PATIENT
+
+
+def test_seed_file_changed(seed_file, tmp_path):
+    """A rewritten seed file is parsed again"""
+    (before,) = fuzz_seeds(seed_file, tmp_path, [SEEDS[0]])
+    # keys are kept by the mutations, values may be replaced
+    with open(seed_file, "w") as f:
+        json.dump(dict(PATIENT, gender="female"), f)
+    os.utime(seed_file, ns=(0, os.stat(seed_file).st_mtime_ns + 1))
+    (after,) = fuzz_seeds(seed_file, tmp_path, [SEEDS[0]])
+    assert b'"gender"' not in before and b'"gender"' in after
+
+
+def test_worker_count(seed_file, tmp_path):
+    """The outputs only depend on the seeds, not on the number of workers"""
+    expected = fuzz_seeds(seed_file, tmp_path, SEEDS)
+    assert fuzz_on_pool(seed_file, tmp_path, SEEDS, 1) == expected
+    assert fuzz_on_pool(seed_file, tmp_path, SEEDS, 3) == expected
+
+
+class FakeExecutor:
+    """Stands in for the process pool, its futures finish when a test says so"""
+
+    def __init__(self):
+        self.futures = []
+
+    def submit(self, fn, *args):
+        future = Future()
+        self.futures.append(future)
+        return future
+
+
+@pytest.fixture
+def executor(monkeypatch, tmp_path):
+    executor = FakeExecutor()
+    monkeypatch.setattr(fuzz.JsonFuzzSession, "POOL", executor)
+    monkeypatch.setattr(fuzz.JsonFuzzSession, "OUTPUT_DIR", tmp_path / "fuzzed")
+    return executor
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """The time of the session's throughput, moved by setting clock[0]"""
+    now = [10.0]
+    monkeypatch.setattr(fuzz.time, "monotonic", lambda: now[0])
+    return now
+
+
+def test_session_fuzzed(seed_file, executor, clock):
+    """Events stay pending until their outputs are written"""
+    sess = fuzz.JsonFuzzSession(seed_file, seed=1)
+    events = sess.fuzz(3)
+    assert [e.future for e in events] == executor.futures
+    assert sess.pending_fuzzes == [e.output_path for e in events]
+    executor.futures[0].set_result(None)
+    assert (sess.running, sess.finished) == (2, 1)
+    assert sess.pending_fuzzes == [e.output_path for e in events[1:]]
+    for future in executor.futures[1:]:
+        future.set_result(None)
+    assert all(e.fuzzed and not e.failed for e in events)
+    assert (sess.running, sess.finished) == (0, 3)
+    assert sess.pending_fuzzes == [] and sess.events == []
+
+
+def test_session_failed(seed_file, executor, clock):
+    """A failed event is recorded on the event and no longer pending"""
+    sess = fuzz.JsonFuzzSession(seed_file, seed=1)
+    failed, fuzzed = sess.fuzz(2)
+    failed.future.set_exception(ValueError("boom"))
+    assert failed.failed and not failed.fuzzed
+    assert sess.pending_fuzzes == [fuzzed.output_path]
+    fuzzed.future.set_result(None)
+    assert sess.pending_fuzzes == []
+    assert sess.stats["fuzzed"] == 2
+
+
+def test_session_stats(seed_file, executor, clock):
+    """The throughput covers one run, from its first submission to its last output"""
+    sess = fuzz.JsonFuzzSession(seed_file, seed=1)
+    assert sess.stats == {"fuzzed": 0, "seconds": 0.0, "files_per_second": 0.0}
+    sess.fuzz(2)
+    clock[0] = 11.0
+    # submitted while the run is going on, part of the same run
+    sess.fuzz(2)
+    executor.futures[0].set_result(None)
+    clock[0] = 12.0
+    assert sess.stats == {"fuzzed": 1, "seconds": 2.0, "files_per_second": 0.5}
+    for future in executor.futures[1:]:
+        future.set_result(None)
+    clock[0] = 30.0
+    assert sess.stats == {"fuzzed": 4, "seconds": 2.0, "files_per_second": 2.0}
+    # a new run starts counting again
+    sess.fuzz(1)
+    executor.futures[-1].set_result(None)
+    assert sess.stats == {"fuzzed": 1, "seconds": 0.0, "files_per_second": 0.0}
+
+
+def test_session_seeds(seed_file, executor):
+    """A session seed gives the same event seeds, whatever was fuzzed before"""
+    sess = fuzz.JsonFuzzSession(seed_file, seed=1)
+    first = [e.seed for e in sess.fuzz(3)]
+    sess.fuzz(2)
+    assert [e.seed for e in sess.fuzz(3, seed=1)] == first
+    assert [e.seed for e in fuzz.JsonFuzzSession(seed_file, seed=1).fuzz(3)] == first
+
+
+def test_pool_started_lazily(monkeypatch):
+    """The pool is started once, on first use, from a forkserver"""
+    pools = []
+    monkeypatch.setattr(fuzz.JsonFuzzSession, "POOL", None)
+    monkeypatch.setattr(
+        fuzz, "ProcessPoolExecutor", lambda **kwargs: pools.append(kwargs) or kwargs
+    )
+    assert fuzz.JsonFuzzSession.pool() is fuzz.JsonFuzzSession.pool()
+    assert len(pools) == 1
+    assert pools[0]["mp_context"].get_start_method() == "forkserver"
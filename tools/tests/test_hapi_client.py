@@ -2,12 +2,13 @@
 Create unit tests for Hapi Client
 """
 
+import asyncio
 import json
 import sys
 import pytest
 
 sys.path.append("../clients")
-from hapi_client import HapiClient
+from hapi_client import HapiClient, AsyncHapiClient
 
 
 # Define fixture with scope limited to duration of module
@@ -117,6 +118,31 @@ class TestHapiClient:
         assert isinstance(response_json, resp_type)
         assert isinstance(export_response, resp_type)
 
+    @pytest.mark.parametrize(
+        "filename, file_type",
+        [
+            (
+                "./test_files/Suzanne628_Jesus702_Stehr398_1589ce57-c816-e5d4-744e-a0e9899bab32.json",
+                "json",
+            ),
+            ("./test_files/Elena945_Sipes176.xml", "xml"),
+        ],
+    )
+    def test_async_step(self, filename, file_type):
+        """Test the asyncio client on the first step"""
+        with open(filename, "r", encoding="utf-8") as file:
+            data = file.read()
+
+        async def run_step():
+            async with AsyncHapiClient("http://localhost:8004", "fhir") as client:
+                return await client.step(0, data, file_type)
+
+        patient_id, response_json, export_response = asyncio.run(run_step())
+        assert patient_id is not None
+        resp_type = dict if file_type == "json" else str
+        assert isinstance(response_json, resp_type)
+        assert isinstance(export_response, resp_type)
+
 
 if __name__ == "__main__":
     pytest.main()
@@ -0,0 +1,82 @@
+"""
+Create unit tests for the persistent cache of hop results
+"""
+
+import sys
+import pytest
+
+sys.path.append("..")
+from hop_cache import HopCache, payload_hash
+
+BUNDLE = '{"resourceType": "Bundle", "entry": []}'
+RESULT = ("42", {"id": "42"}, '{"resourceType": "Bundle"}')
+
+
+@pytest.fixture
+def cache(tmp_path):
+    return HopCache(str(tmp_path / "cache" / "hops.sqlite"))
+
+
+def test_hit(cache):
+    """A stored hop is returned for the same input, server, version, type and stage"""
+    key = HopCache.key(BUNDLE, "hapi", "7.0.0", "json", "initial")
+    cache.put(key, RESULT)
+    assert cache.get(HopCache.key(BUNDLE, "hapi", "7.0.0", "json", "initial")) == RESULT
+
+
+def test_persisted(cache):
+    """Hops survive the process, a new cache on the same file finds them"""
+    key = HopCache.key(BUNDLE, "hapi", "7.0.0", "json", "initial")
+    cache.put(key, RESULT)
+    assert HopCache(cache.path).get(key) == RESULT
+
+
+@pytest.mark.parametrize(
+    "data, server, fingerprint, file_type, stage",
+    [
+        (
+            '{"resourceType": "Bundle", "entry": [{}]}',
+            "hapi",
+            "7.0.0",
+            "json",
+            "initial",
+        ),
+        (BUNDLE, "blaze", "7.0.0", "json", "initial"),
+        (BUNDLE, "hapi", "7.0.0", "json", "relay"),
+        (BUNDLE, "hapi", "7.0.0", "xml", "initial"),
+    ],
+)
+def test_miss(cache, data, server, fingerprint, file_type, stage):
+    """Any other input, server, file type or stage is a miss"""
+    cache.put(HopCache.key(BUNDLE, "hapi", "7.0.0", "json", "initial"), RESULT)
+    assert cache.get(HopCache.key(data, server, fingerprint, file_type, stage)) is None
+
+
+def test_invalidated_by_server_version(cache):
+    """Upgrading a server invalidates the hops it served"""
+    cache.put(HopCache.key(BUNDLE, "hapi", "7.0.0", "json", "initial"), RESULT)
+    assert cache.get(HopCache.key(BUNDLE, "hapi", "7.2.0", "json", "initial")) is None
+
+
+def test_failed_hops_not_stored(cache):
+    """A hop without a patient id is retried on the next run"""
+    key = HopCache.key(BUNDLE, "hapi", "7.0.0", "json", "initial")
+    cache.put(key, (None, {"error": "down"}, None))
+    assert cache.get(key) is None
+
+
+def test_disabled(cache):
+    """A disabled cache neither stores nor returns hops"""
+    key = HopCache.key(BUNDLE, "hapi", "7.0.0", "json", "initial")
+    cache.put(key, RESULT)
+    cache.enabled = False
+    assert cache.get(key) is None
+    cache.put(HopCache.key(BUNDLE, "ibm", "5.0.0", "json", "relay"), RESULT)
+    cache.enabled = True
+    assert cache.get(HopCache.key(BUNDLE, "ibm", "5.0.0", "json", "relay")) is None
+
+
+def test_payload_hash():
+    """Parsed bundles hash the same whatever their key order"""
+    assert payload_hash({"a": 1, "b": 2}) == payload_hash({"b": 2, "a": 1})
+    assert payload_hash(BUNDLE) == payload_hash(BUNDLE.encode("utf-8"))
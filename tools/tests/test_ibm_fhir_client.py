@@ -2,12 +2,18 @@
 Create unit tests for Vista Client
 """
 
+import asyncio
 import json
 import sys
 import pytest
 
 sys.path.append("../clients")
-from ibm_fhir_client import IBMFHIRClient
+from ibm_fhir_client import (
+    IBMFHIRClient,
+    AsyncIBMFHIRClient,
+    _created_bundle_id,
+    _newest_bundle_id,
+)
 
 
 @pytest.fixture(scope="module")
@@ -87,6 +93,81 @@ class TestIBMFHIRClient:
         assert isinstance(response_json, dict)
         assert isinstance(export_response, dict)
 
+    def test_async_step(self):
+        """Test the asyncio client on the first step"""
+        with open(
+            "./test_files/Suzanne628_Jesus702_Stehr398_1589ce57-c816-e5d4-744e-a0e9899bab32.json",
+            "r",
+            encoding="utf-8",
+        ) as file:
+            data = file.read()
+
+        async def run_step():
+            async with AsyncIBMFHIRClient(
+                "https://localhost:8005", "fhir-server/api/v4"
+            ) as client:
+                return await client.step(0, data, "json")
+
+        patient_id, response_json, export_response = asyncio.run(run_step())
+        assert patient_id is not None
+        assert isinstance(response_json, dict)
+        assert isinstance(export_response, dict)
+
 
 if __name__ == "__main__":
     pytest.main()
+
+
+@pytest.mark.parametrize(
+    "location, body, expected",
+    [
+        ("https://localhost:8005/fhir-server/api/v4/Bundle/17a/_history/1", "", "17a"),
+        (None, json.dumps({"resourceType": "Bundle", "id": "17b"}), "17b"),
+        (
+            None,
+            json.dumps(
+                {
+                    "resourceType": "Bundle",
+                    "type": "transaction-response",
+                    "entry": [
+                        {"response": {"location": "Patient/9/_history/1"}},
+                        {"response": {"location": "Bundle/17c/_history/1"}},
+                    ],
+                }
+            ),
+            "17c",
+        ),
+        (
+            None,
+            json.dumps(
+                {
+                    "resourceType": "Bundle",
+                    "type": "transaction-response",
+                    "entry": [{"response": {"location": "Patient/9/_history/1"}}],
+                }
+            ),
+            None,
+        ),
+        ("", json.dumps({"resourceType": "OperationOutcome", "id": "x"}), None),
+        (None, "", None),
+        (None, "not json", None),
+        (None, "[]", None),
+    ],
+)
+def test_created_bundle_id(location, body, expected):
+    """The Bundle id is read from the Location header, then from the response body"""
+    assert _created_bundle_id(location, body) == expected
+
+
+@pytest.mark.parametrize(
+    "search_json, expected",
+    [
+        ({"resourceType": "Bundle", "entry": [{"resource": {"id": "17d"}}]}, "17d"),
+        ({"resourceType": "Bundle", "total": 0}, None),
+        ({"resourceType": "Bundle", "entry": []}, None),
+        ("error", None),
+    ],
+)
+def test_newest_bundle_id(search_json, expected):
+    """The id of the first entry of a search, None if the search found nothing"""
+    assert _newest_bundle_id(search_json) == expected
@@ -0,0 +1,62 @@
+"""
+Create unit tests for the job registry of the Synthea server
+"""
+
+import sys
+import os
+import threading
+from concurrent.futures import Future
+import pytest
+
+sys.path.append(
+    os.path.abspath(os.path.join(os.path.dirname(__file__), "../../ehr-garden/synthea"))
+)
+from jobs import JobRegistry
+
+
+@pytest.fixture
+def registry():
+    registry = JobRegistry(workers=1)
+    yield registry
+    registry.executor.shutdown(wait=False)
+
+
+def test_submit(registry):
+    """A job runs fn on a worker and keeps its result"""
+    job = registry.submit("generate", {}, lambda count: list(range(count)), 3)
+    assert registry.wait(job.id, 5).status == "done"
+    assert job.result == [0, 1, 2]
+
+
+def test_submit_futures(registry):
+    """A job waiting on futures finishes with the last of them, without a worker"""
+    futures = [Future(), Future()]
+    job = registry.submit_futures("fuzz", {}, futures, lambda: "fuzzed")
+    assert job.status == "running"
+    # the only worker is free for other jobs while the futures run
+    other = registry.submit("generate", {}, lambda: "generated")
+    assert registry.wait(other.id, 5).status == "done"
+    futures[0].set_result(None)
+    assert not job.done.is_set()
+    futures[1].set_result(None)
+    assert job.done.is_set() and job.status == "done" and job.result == "fuzzed"
+
+
+def test_submit_futures_failed(registry):
+    """A job fails with the error fn raises for a failed future"""
+    futures = [Future()]
+    job = registry.submit_futures("fuzz", {}, futures, futures[0].result)
+    futures[0].set_exception(ValueError("boom"))
+    assert job.status == "failed" and job.error == "boom"
+
+
+def test_events(registry):
+    """Subscribers see every status change of a job"""
+    events = registry.subscribe()
+    futures = [Future()]
+    job = registry.submit_futures("fuzz", {}, futures, lambda: None)
+    threading.Thread(target=futures[0].set_result, args=(None,)).start()
+    registry.wait(job.id, 5)
+    statuses = [events.get(timeout=5)["status"] for _ in range(3)]
+    assert statuses == ["pending", "running", "done"]
+    registry.unsubscribe(events)
@@ -0,0 +1,174 @@
+"""
+Create unit tests for the tolerant JSON parser
+"""
+
+import io
+import sys
+import pytest
+
+sys.path.append("..")
+from utils.parser import (
+    JSONNode,
+    JSONType,
+    iter_values,
+    parse_expression,
+    parse_file,
+    parse_list,
+    parse_object,
+    parse_stream,
+    parse_string,
+)
+
+BUNDLE = "./test_files/Suzanne628_Jesus702_Stehr398_1589ce57-c816-e5d4-744e-a0e9899bab32.json"
+
+
+def chunks(data, size):
+    """Split data into chunks of size bytes"""
+    return (data[i : i + size] for i in range(0, len(data), size))
+
+
+def leaf(node_type, value):
+    """Build a scalar node"""
+    return JSONNode(node_type, value)
+
+
+@pytest.mark.parametrize(
+    "data, expected, remaining",
+    [
+        (b"-1.5e+3 rest", leaf(JSONType.Number, b"-1.5e+3"), b" rest"),
+        (b"NULL", leaf(JSONType.Null, b"NULL"), b""),
+        (b"False,", leaf(JSONType.Bool, b"False"), b","),
+        (b"'single'", leaf(JSONType.String, b"'single'"), b""),
+        (rb'"esc\"aped"}', leaf(JSONType.String, rb'"esc\"aped"'), b"}"),
+        (
+            b"[1, 2,, 3 4]",
+            JSONNode(
+                JSONType.List,
+                [
+                    leaf(JSONType.Number, b"1"),
+                    leaf(JSONType.Number, b"2"),
+                    leaf(JSONType.Number, b"3"),
+                    leaf(JSONType.Number, b"4"),
+                ],
+            ),
+            b"",
+        ),
+        (
+            b'{"a": 1, "b": [true], }tail',
+            JSONNode(
+                JSONType.Object,
+                [
+                    [leaf(JSONType.String, b'"a"'), leaf(JSONType.Number, b"1")],
+                    [
+                        leaf(JSONType.String, b'"b"'),
+                        JSONNode(JSONType.List, [leaf(JSONType.Bool, b"true")]),
+                    ],
+                ],
+            ),
+            b"tail",
+        ),
+        (
+            b'{"a": 1: 2',
+            JSONNode(
+                JSONType.Object,
+                [
+                    [
+                        leaf(JSONType.String, b'"a"'),
+                        leaf(JSONType.Number, b"1"),
+                        leaf(JSONType.Number, b"2"),
+                    ]
+                ],
+            ),
+            b"",
+        ),
+        (b"[x]", JSONNode(JSONType.List, []), b"x]"),
+    ],
+)
+def test_parse_expression(data, expected, remaining):
+    """Lenient parsing keeps the same trees and leaves the same input unconsumed"""
+    assert parse_expression(data) == (expected, remaining)
+
+
+@pytest.mark.parametrize(
+    "function, data",
+    [
+        (parse_expression, b""),
+        (parse_expression, b"nul"),
+        (parse_expression, b"}"),
+        (parse_string, b'"unterminated'),
+        (parse_list, b"{}"),
+        (parse_object, b"[]"),
+    ],
+)
+def test_parse_errors(function, data):
+    """Inputs that do not start with a value raise ValueError"""
+    with pytest.raises(ValueError):
+        function(data)
+
+
+def test_unterminated_string_is_linear():
+    """A long unterminated string with colons fails quickly"""
+    with pytest.raises(ValueError):
+        parse_string(b'"' + b":" * 100000)
+
+
+def test_deep_nesting():
+    """Nesting far beyond the recursion limit parses without RecursionError"""
+    depth = sys.getrecursionlimit() * 10
+    node, remaining = parse_expression(b"[" * depth + b"]" * depth + b" ")
+    assert remaining == b" "
+    for _ in range(depth - 1):
+        assert node.type == JSONType.List and len(node.value) == 1
+        node = node.value[0]
+    assert node == JSONNode(JSONType.List, [])
+
+
+def test_equal_scalars_share_nodes():
+    """Repeated keys and values of one parse are the same node"""
+    node, _ = parse_expression(b'[{"id": 1}, {"id": 1}, {"id": 2}]')
+    first, second, third = (item.value[0] for item in node.value)
+    assert first[0] is second[0] is third[0]
+    assert first[1] is second[1]
+    assert first[1] is not third[1]
+
+
+@pytest.mark.parametrize(
+    "data",
+    [
+        b'{"a": [1, 22, 333], "b": "long string", \'c\': NULL, "d": tRUE}',
+        b"[1, 2,, 3 4]",
+        b'{"a": 1: 2',
+        b"  123456789  ",
+        b'"unterminated',
+        b'"esc\\"aped"',
+    ],
+)
+@pytest.mark.parametrize("size", [1, 2, 3, 7])
+def test_parse_stream_matches_parse_expression(data, size):
+    """Tokens split across chunk boundaries parse the same as in memory"""
+    try:
+        expected = parse_expression(data.strip())[0]
+    except ValueError:
+        with pytest.raises(ValueError):
+            parse_stream(chunks(data.strip(), size))
+        return
+    assert parse_stream(chunks(data.strip(), size)) == expected
+
+
+def test_parse_file():
+    """A Synthea bundle parses the same from a file as from bytes"""
+    with open(BUNDLE, "rb") as f:
+        data = f.read()
+    assert parse_file(BUNDLE) == parse_expression(data)[0]
+    assert parse_stream(io.BytesIO(data)) == parse_expression(data)[0]
+
+
+def test_iter_values():
+    """Values at the requested depth are yielded in document order"""
+    data = b'{"entry": [{"id": 1}, {"id": 2}], "type": "collection"}'
+    values = list(iter_values(chunks(data, 4), depth=2))
+    assert values == [
+        parse_expression(b'{"id": 1}')[0],
+        parse_expression(b'{"id": 2}')[0],
+    ]
+    assert len(list(iter_values(io.BytesIO(data), depth=1))) == 4
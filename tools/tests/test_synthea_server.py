@@ -0,0 +1,55 @@
+"""
+Create unit tests for the pre-generated patient pool of the Synthea server
+"""
+
+import sys
+import os
+import time
+import itertools
+import threading
+import pytest
+
+sys.path.append(
+    os.path.abspath(os.path.join(os.path.dirname(__file__), "../../ehr-garden/synthea"))
+)
+pytest.importorskip("flask")
+pytest.importorskip("pyjfuzz.lib")
+import server
+
+
+@pytest.fixture
+def generated(monkeypatch):
+    """Replace Synthea with a generator of numbered file names"""
+    generated = []
+    numbers = itertools.count()
+    lock = threading.Lock()
+
+    def generate(count=1, seed=None, modules=()):
+        with lock:
+            filenames = [f"patient{next(numbers)}.json" for _ in range(count)]
+        generated.append(filenames)
+        return filenames
+
+    monkeypatch.setattr(server, "generate", generate)
+    return generated
+
+
+def test_import_starts_nothing():
+    """Importing the server does not start filling the pool"""
+    assert server.pool.thread is None
+
+
+def test_pool_started_on_first_request(monkeypatch, generated):
+    """The first generation request starts the pool, later ones are served from it"""
+    pool = server.Pool(2)
+    monkeypatch.setattr(server, "pool", pool)
+    client = server.app.test_client()
+    assert client.get("/?count=1").status_code == 200
+    assert pool.thread is not None
+    deadline = time.monotonic() + 5
+    while len(pool.files) < 2:
+        assert time.monotonic() < deadline, "pool not filled"
+        time.sleep(0.01)
+    thread, pooled = pool.thread, list(pool.files)
+    assert client.get("/?count=2").json["filenames"] == pooled
+    assert pool.thread is thread
@@ -4,11 +4,19 @@ Create unit tests for Game Of Telephone
 
 import sys
 import os
+import json
+import time
+import random
+import threading
+from itertools import product
+from types import SimpleNamespace
 import pytest
 from neo4j import GraphDatabase
 
 # Adding path to clients directory to sys.path (err - clients not reachable from tests through telephone.py)
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "../clients")))
+import diff
+import telephone
 from telephone import telephone_function
 
 URI = "neo4j://localhost:7688"
@@ -46,8 +54,16 @@ def test_chain_creation_and_cleanup(
 ):
     """Run telephone chain and test if edges are created"""
 
+    # Without the hop cache, so every hop reaches the servers
     guid = telephone_function(
-        chain_length, file, generate, chain, all_chains, file_type
+        chain_length,
+        file,
+        generate,
+        chain,
+        all_chains,
+        file_type,
+        "full",
+        use_cache=False,
     )
 
     # Check if all nodes exist
@@ -65,9 +81,9 @@ def test_chain_creation_and_cleanup(
 
 
 def get_all_nodes(neo4j_test_db):
-    """Query to get all nodes in the db"""
+    """Query to get all Server nodes in the db"""
     with neo4j_test_db.session() as session:
-        query = """MATCH (n) RETURN n.name"""
+        query = """MATCH (n:Server) RETURN n.name"""
         result = session.run(query)
         return [record for record in result]
 
@@ -88,3 +104,132 @@ def remove_edges_by_guid(neo4j_test_db, guid):
         query = """MATCH (n1)-[r:LINK {guid: $guid}]->(n2)
             DELETE r"""
         session.run(query, parameters={"guid": guid})
+
+
+class FakeClient:
+    """Stands in for a server, its export lists the servers the payload went through"""
+
+    def __init__(self, name):
+        self.name = name
+
+    def step(self, step_number, data, file_type):
+        bundle = json.loads(data) if isinstance(data, str) else data
+        # Let the hops of different chains overlap
+        time.sleep(random.random() / 100)
+        return (self.name, {}, dict(bundle, hops=bundle["hops"] + [self.name]))
+
+
+class FakeNode:
+    def __init__(self, name):
+        self.name = name
+
+    def get(self, key, default=None):
+        return self.name if key == "name" else default
+
+
+class FakeRelationship:
+    """LINK edge as returned by the neo4j driver, with its payload inline"""
+
+    def __init__(self, id, node1, node2, properties):
+        self.id = id
+        self.start_node = FakeNode(node1)
+        self.end_node = FakeNode(node2)
+        self.properties = properties
+
+    def get(self, key, default=None):
+        return self.properties.get(key, default)
+
+
+class RecordingWriter:
+    """Keeps edges in memory, in the order the chains added them"""
+
+    def __init__(self):
+        self.edges = []
+        self.lock = threading.Lock()
+
+    def add(self, guid, node1, node2, json_string, **properties):
+        properties = dict(properties, guid=guid, json=json.dumps(json_string))
+        with self.lock:
+            self.edges.append(
+                FakeRelationship(len(self.edges), node1, node2, properties)
+            )
+
+    def flush(self):
+        pass
+
+
+def all_paths(edges, max_length):
+    """Every path of at most max_length edges from the file to the end node, like the
+    all depths query in diff.py"""
+    paths = []
+    stack = [[edge] for edge in edges if edge.start_node.name == "file"]
+    while stack:
+        path = stack.pop()
+        last = path[-1].end_node.name
+        if last == "end":
+            paths.append(SimpleNamespace(relationships=path))
+        elif len(path) < max_length:
+            stack += [
+                path + [edge]
+                for edge in edges
+                if edge.start_node.name == last and edge not in path
+            ]
+    return paths
+
+
+def hops(payload):
+    """Servers a serialized edge payload went through"""
+    data = json.loads(payload)
+    # The input file is a JSON string stored as a string
+    return (json.loads(data) if isinstance(data, str) else data)["hops"]
+
+
+def test_concurrent_chains_diff(monkeypatch):
+    """Chains run concurrently interleave their edges, diff.py still compares every
+    chain on its own"""
+    servers = list(telephone.config)
+    chain_length = 2
+    writer = RecordingWriter()
+    monkeypatch.setattr(
+        telephone, "client_map", {name: FakeClient(name) for name in servers}
+    )
+    monkeypatch.setattr(telephone, "edge_writer", writer)
+    monkeypatch.setattr(telephone.hop_cache, "enabled", False)
+
+    executor = telephone.ChainExecutor(8)
+    executor.submit(
+        telephone.dfs,
+        "guid",
+        "file",
+        0,
+        "",
+        [],
+        chain_length,
+        json.dumps({"hops": []}),
+        "json",
+        executor,
+    )
+    executor.wait()
+
+    paths = all_paths(writer.edges, chain_length + 1)
+    chain_paths = [path for path in paths if diff.chain_path(path)]
+    assert len(paths) > len(chain_paths)
+    assert sorted(
+        tuple(hops(path.relationships[-1].get("json"))) for path in chain_paths
+    ) == sorted(product(servers, repeat=chain_length))
+    for path in chain_paths:
+        names = [r.end_node.name for r in path.relationships]
+        assert hops(path.relationships[-1].get("json")) == names[:-1]
+
+    jobs = []
+
+    def record_diffs(pairs, *args):
+        jobs.extend(pairs)
+        return [(True, "identical")] * len(pairs)
+
+    monkeypatch.setattr(diff, "cached_diffs", record_diffs)
+    diff.compare_paths(paths, True, "json", "full", workers=1)
+    assert len(jobs) == len(servers) ** chain_length * chain_length
+    for file1, file2, source in jobs:
+        # Consecutive links of one chain, the second payload went through one more server
+        assert hops(file2)[:-1] == hops(file1)
@@ -0,0 +1,98 @@
+import dataclasses
+import hashlib
+
+from enum import Enum
+from typing import Any
+
+# A canonical hash stands in for a full DeepDiff when two values are the same.
+# Equal hashes must mean DeepDiff with the same options reports nothing, so the
+# encoding only merges what DeepDiff itself treats as equal: dict key order,
+# whitespace and number spellings that parse to the same value, list order under
+# ignore_order and string case under ignore_string_case. Anything it cannot
+# vouch for (NaN, unknown types, case-colliding keys) has no hash, and the
+# caller falls back to DeepDiff.
+
+
+class _NoCanonicalForm(Exception):
+    pass
+
+
+def _hash_bytes(tag: bytes, cls: type, items: list[bytes]) -> bytes:
+    name = cls.__qualname__.encode()
+    digest = hashlib.sha256(b"".join(items)).digest()
+    return b"%s%d:%s%s" % (tag, len(name), name, digest)
+
+
+def _encode(obj: Any, ignore_order: bool, ignore_string_case: bool) -> bytes:
+    # encodings of objects seen before, parse trees share their scalar nodes
+    seen: dict[int, bytes] = {}
+
+    def encode(o: Any) -> bytes:
+        t = type(o)
+        if o is None:
+            return b"N"
+        if t is bool:
+            return b"T" if o else b"F"
+        if t is int:
+            return b"i%d;" % o
+        if t is float:
+            if o != o:
+                # NaN is never equal to itself
+                raise _NoCanonicalForm
+            return b"f%s;" % repr(o).encode()
+        if t is str:
+            if ignore_string_case:
+                o = o.lower()
+            data = o.encode("utf-8", "surrogatepass")
+            return b"s%d:%s" % (len(data), data)
+        if t is bytes:
+            if ignore_string_case:
+                o = o.lower()
+            return b"b%d:%s" % (len(o), o)
+        if isinstance(o, Enum):
+            return _hash_bytes(b"e", t, [o.name.encode()])
+        if isinstance(o, (list, tuple)):
+            items = [encode(item) for item in o]
+            if ignore_order:
+                items.sort()
+            return _hash_bytes(b"l", t, items)
+        if isinstance(o, dict):
+            if ignore_string_case:
+                keys = [k for k in o if isinstance(k, (str, bytes))]
+                if len({k.lower() for k in keys}) != len(keys):
+                    # DeepDiff would pair these keys up by their first occurrence
+                    raise _NoCanonicalForm
+            return _hash_bytes(
+                b"d", t, sorted(encode(k) + encode(v) for k, v in o.items())
+            )
+        if dataclasses.is_dataclass(o) and hasattr(o, "__dict__"):
+            if id(o) not in seen:
+                seen[id(o)] = _hash_bytes(b"o", t, [encode(vars(o))])
+            return seen[id(o)]
+        raise _NoCanonicalForm
+
+    return encode(obj)
+
+
+def canonical_hash(
+    obj: Any, ignore_order: bool = False, ignore_string_case: bool = False
+) -> bytes | None:
+    """
+    Hash of a parsed document that is equal for two documents only if DeepDiff with
+    the same ignore_order and ignore_string_case options finds no difference.
+    Returns None when the document has no canonical form.
+    """
+    try:
+        return hashlib.sha256(_encode(obj, ignore_order, ignore_string_case)).digest()
+    except (_NoCanonicalForm, RecursionError):
+        return None
+
+
+def identical(
+    obj1: Any, obj2: Any, ignore_order: bool = False, ignore_string_case: bool = False
+) -> bool:
+    """True if two parsed documents are known to be the same without running DeepDiff"""
+    hash1 = canonical_hash(obj1, ignore_order, ignore_string_case)
+    return hash1 is not None and hash1 == canonical_hash(
+        obj2, ignore_order, ignore_string_case
+    )
@@ -1,9 +1,11 @@
+import os
 import re
 import sys
 
 from dataclasses import dataclass
 from enum import Enum
-from typing import Callable, Final, Self
+from types import GeneratorType
+from typing import BinaryIO, Callable, Final, Generator, Iterable, Iterator, Self
 
 
 class JSONType(Enum):
@@ -15,20 +17,30 @@ class JSONType(Enum):
     Object = 5
 
 
+# A parse shares one node between all equal scalars, e.g. the keys repeated in every entry,
+# so large bundles allocate far fewer nodes. Nodes stay plain dataclasses rather than
+# __slots__ classes or offsets into the input: DeepDiff walks and hashes them through
+# their __dict__, and slotted nodes change its ignore_order results in Analyzer.
 @dataclass
 class JSONNode:
     type: JSONType
     value: bytes | list[Self] | list[list[Self]]
 
 
+# The parser walks a single buffer with an offset instead of slicing off every token,
+# and keeps open lists and objects on an explicit stack instead of recursing.
+# The buffer is either the whole input or a window over a stream of chunks.
+# The public parse_* and consume_* functions keep their (result, remaining) signatures.
+
+
 def _parse_with_pattern(data: bytes, pattern: re.Pattern[bytes]) -> tuple[bytes, bytes]:
-    m: re.Match[bytes] | None = re.match(pattern, data)
-    if m is None or m.start() != 0:
+    m: re.Match[bytes] | None = pattern.match(data)
+    if m is None:
         raise ValueError
-    return (data[m.start() : m.end()], data[m.end() :])
+    return (data[: m.end()], data[m.end() :])
 
 
-_NUMBER_RE: Final[re.Pattern[bytes]] = re.compile(rb"\A[0-9_\.e+\-]+")
+_NUMBER_RE: Final[re.Pattern[bytes]] = re.compile(rb"[0-9_\.e+\-]+")
 
 
 def parse_number(data: bytes) -> tuple[JSONNode, bytes]:
@@ -36,7 +48,7 @@ def parse_number(data: bytes) -> tuple[JSONNode, bytes]:
     return (JSONNode(JSONType.Number, consumed), remaining)
 
 
-_NULL_RE: Final[re.Pattern[bytes]] = re.compile(rb"\A[Nn][Uu][Ll][Ll]")
+_NULL_RE: Final[re.Pattern[bytes]] = re.compile(rb"[Nn][Uu][Ll][Ll]")
 
 
 def parse_null(data: bytes) -> tuple[JSONNode, bytes]:
@@ -45,8 +57,10 @@ def parse_null(data: bytes) -> tuple[JSONNode, bytes]:
 
 
 # This works due to a nice property of UTF-8: no code point's UTF-8 representation contains '\x22', except '\x22' == '"' itself.
+# Every character is either a plain character or a backslash escape, so there is exactly one way
+# to match and a missing closing quote fails without backtracking.
 _STRING_RE: Final[re.Pattern[bytes]] = re.compile(
-    rb'\A"(:?[^"\\]|\\.)*"' + b"|" + rb"\A\'(:?[^'\\]|\\.)*\'"
+    rb'"(?:[^"\\]|\\.)*"' + b"|" + rb"\'(?:[^'\\]|\\.)*\'"
 )
 
 
@@ -56,7 +70,7 @@ def parse_string(data: bytes) -> tuple[JSONNode, bytes]:
 
 
 _BOOL_RE: Final[re.Pattern[bytes]] = re.compile(
-    rb"\A[Tt][Rr][Uu][Ee]|[Ff][Aa][Ll][Ss][Ee]"
+    rb"[Tt][Rr][Uu][Ee]|[Ff][Aa][Ll][Ss][Ee]"
 )
 
 
@@ -66,7 +80,7 @@ def parse_bool(data: bytes) -> tuple[JSONNode, bytes]:
 
 
 _WHITESPACE_RE: Final[re.Pattern[bytes]] = re.compile(
-    rb"\A[\x09-\x0d\x1c-\x1f\x20\x85\xa0]*"
+    rb"[\x09-\x0d\x1c-\x1f\x20\x85\xa0]*"
 )
 
 
@@ -74,146 +88,343 @@ def consume_whitespace(data: bytes) -> bytes:
     return _parse_with_pattern(data, _WHITESPACE_RE)[1]
 
 
-_COMMA_RE: Final[re.Pattern[bytes]] = re.compile(rb"\A,")
+def _consume_byte(data: bytes, char: bytes) -> bytes:
+    if not data.startswith(char):
+        raise ValueError
+    return data[1:]
 
 
 def consume_comma(data: bytes) -> bytes:
-    return _parse_with_pattern(data, _COMMA_RE)[1]
-
-
-_OPEN_BRACKET_RE: Final[re.Pattern[bytes]] = re.compile(rb"\A\[")
+    return _consume_byte(data, b",")
 
 
 def consume_open_bracket(data: bytes) -> bytes:
-    return _parse_with_pattern(data, _OPEN_BRACKET_RE)[1]
-
-
-_CLOSE_BRACKET_RE: Final[re.Pattern[bytes]] = re.compile(rb"\A\]")
+    return _consume_byte(data, b"[")
 
 
 def consume_close_bracket(data: bytes) -> bytes:
-    return _parse_with_pattern(data, _CLOSE_BRACKET_RE)[1]
-
-
-_OPEN_CURLY_RE: Final[re.Pattern[bytes]] = re.compile(rb"\A\{")
+    return _consume_byte(data, b"]")
 
 
 def consume_open_curly(data: bytes) -> bytes:
-    return _parse_with_pattern(data, _OPEN_CURLY_RE)[1]
-
-
-_CLOSE_CURLY_RE: Final[re.Pattern[bytes]] = re.compile(rb"\A\}")
+    return _consume_byte(data, b"{")
 
 
 def consume_close_curly(data: bytes) -> bytes:
-    return _parse_with_pattern(data, _CLOSE_CURLY_RE)[1]
+    return _consume_byte(data, b"}")
 
 
-_COLON_RE: Final[re.Pattern[bytes]] = re.compile(rb"\A:")
+def consume_colon(data: bytes) -> bytes:
+    return _consume_byte(data, b":")
+
+
+class _Buffer:
+    """Input held in memory, addressed by absolute offsets"""
+
+    def __init__(self, data: bytes):
+        self.data = data
+
+    def skip_whitespace(self, pos: int) -> int:
+        return _WHITESPACE_RE.match(self.data, pos).end()
+
+    def startswith(self, char: bytes, pos: int) -> bool:
+        return self.data.startswith(char, pos)
+
+    def byte(self, pos: int) -> int | None:
+        return self.data[pos] if pos < len(self.data) else None
+
+    def match(self, pattern: re.Pattern[bytes], pos: int) -> bytes | None:
+        m = pattern.match(self.data, pos)
+        return None if m is None else m.group()
+
+
+# How many more bytes could still turn a failed match at the end of the buffer into a match
+_INCOMPLETE: Final[dict[re.Pattern[bytes], re.Pattern[bytes]]] = {
+    _NUMBER_RE: re.compile(rb"(?!)"),
+    _NULL_RE: re.compile(rb".{0,3}\Z", re.DOTALL),
+    _BOOL_RE: re.compile(rb".{0,4}\Z", re.DOTALL),
+    _STRING_RE: re.compile(
+        rb'"(?:[^"\\]|\\.)*\\?\Z' + b"|" + rb"'(?:[^'\\]|\\.)*\\?\Z"
+    ),
+}
+
+
+class _Stream(_Buffer):
+    """
+    Input pulled from an iterator of byte chunks
+    Only the input from the current offset on is kept. Whenever a token reaches the end
+    of the buffer, more chunks are read and the token is matched again.
+    """
+
+    def __init__(self, chunks: Iterator[bytes]):
+        self.chunks = chunks
+        self.data = b""
+        self.base = 0
+        self.eof = False
+
+    def fill(self, pos: int) -> None:
+        """Drop the input before pos, then at least double what is left"""
+        parts = [self.data[pos - self.base :]]
+        self.base = pos
+        size, wanted = len(parts[0]), 2 * len(parts[0]) + 1
+        while size < wanted:
+            chunk = next(self.chunks, None)
+            if chunk is None:
+                self.eof = True
+                break
+            parts.append(chunk)
+            size += len(chunk)
+        self.data = b"".join(parts)
 
+    def skip_whitespace(self, pos: int) -> int:
+        while True:
+            end = _WHITESPACE_RE.match(self.data, pos - self.base).end()
+            if end < len(self.data) or self.eof:
+                return end + self.base
+            self.fill(end + self.base)
+            pos = self.base
+
+    def startswith(self, char: bytes, pos: int) -> bool:
+        while pos - self.base >= len(self.data) and not self.eof:
+            self.fill(pos)
+        return self.data.startswith(char, pos - self.base)
+
+    def byte(self, pos: int) -> int | None:
+        while pos - self.base >= len(self.data) and not self.eof:
+            self.fill(pos)
+        return super().byte(pos - self.base)
+
+    def match(self, pattern: re.Pattern[bytes], pos: int) -> bytes | None:
+        while True:
+            m = pattern.match(self.data, pos - self.base)
+            if self.eof:
+                break
+            if m is None:
+                if not _INCOMPLETE[pattern].match(self.data, pos - self.base):
+                    break
+            elif m.end() < len(self.data):
+                break
+            self.fill(pos)
+        return None if m is None else m.group()
 
-def consume_colon(data: bytes) -> bytes:
-    return _parse_with_pattern(data, _COLON_RE)[1]
 
+def _chunks(source: BinaryIO | Iterable[bytes], size: int = 1 << 16) -> Iterator[bytes]:
+    """Chunks of a binary file object, or the items of an iterable of bytes"""
+    if hasattr(source, "read"):
+        return iter(lambda: source.read(size), b"")
+    return iter(source)
 
-def parse_expression(data: bytes) -> tuple[JSONNode, bytes]:
-    for f in (
-        parse_number,
-        parse_null,
-        parse_string,
-        parse_bool,
-        parse_list,
-        parse_object,
-    ):
-        try:
-            return f(data)
-        except ValueError:
-            pass
-    raise ValueError
 
+# A list or object being parsed. It yields the offset of each value it wants parsed
+# and is sent back (node, end offset), or None if no value could be parsed there.
+_Frame = Generator[int, tuple[JSONNode, int] | None, tuple[JSONNode, int]]
 
-def parse_list(data: bytes) -> tuple[JSONNode, bytes]:
-    data = consume_open_bracket(data)
-    data_len = None
+
+def _list_items(src: _Buffer, pos: int) -> _Frame:
+    """Parse the items of a list, pos is just past the opening bracket"""
+    last = None
     result: list[JSONNode] = []
     while True:
-        data = consume_whitespace(data)
-        new_len = len(data)
-        if data_len == new_len:
+        pos = src.skip_whitespace(pos)
+        if last == pos:
             break
-        data_len = new_len
+        last = pos
 
-        try:
-            item, data = parse_expression(data)
+        parsed = yield pos
+        if parsed is not None:
+            item, pos = parsed
             result.append(item)
-        except ValueError:
-            pass
-
-        data = consume_whitespace(data)
-
-        try:
-            data = consume_comma(data)
-        except ValueError:
-            pass
 
-        data = consume_whitespace(data)
+        pos = src.skip_whitespace(pos)
+        if src.startswith(b",", pos):
+            pos += 1
+        pos = src.skip_whitespace(pos)
 
-        try:
-            data = consume_close_bracket(data)
+        if src.startswith(b"]", pos):
+            pos += 1
             break
-        except ValueError:
-            pass
 
-    return (JSONNode(JSONType.List, result), data)
+    return (JSONNode(JSONType.List, result), pos)
 
 
-def parse_object(data: bytes) -> tuple[JSONNode, bytes]:
-    data = consume_open_curly(data)
-    data_len = None
+def _object_items(src: _Buffer, pos: int) -> _Frame:
+    """Parse the items of an object, pos is just past the opening curly"""
+    last = None
     result: list[list[JSONNode]] = []
     while True:
-        new_len = len(data)
-        if data_len == new_len:
+        if last == pos:
             break
-        data_len = new_len
+        last = pos
         # Eat values separated by colons until there's no colon
         kvp: list[JSONNode] = []
         while True:
-            data = consume_whitespace(data)
-            try:
-                item, data = parse_expression(data)
-                kvp.append(item)
-            except:
+            pos = src.skip_whitespace(pos)
+            parsed = yield pos
+            if parsed is None:
                 break
-            data = consume_whitespace(data)
-            try:
-                data = consume_colon(data)
-            except:
+            item, pos = parsed
+            kvp.append(item)
+            pos = src.skip_whitespace(pos)
+            if not src.startswith(b":", pos):
                 break
-            new_len = len(data)
-            if data_len == new_len:
+            pos += 1
+            if last == pos:
                 break
-            data_len = new_len
+            last = pos
 
         if len(kvp) > 0:
             result.append(kvp)
 
         # Optionally eat a comma
-        try:
-            data = consume_comma(data)
-        except ValueError:
-            pass
-        data = consume_whitespace(data)
+        if src.startswith(b",", pos):
+            pos += 1
+        pos = src.skip_whitespace(pos)
 
         # If we hit a close curly, break
-        try:
-            data = consume_close_curly(data)
+        if src.startswith(b"}", pos):
+            pos += 1
             break
+
+    return (JSONNode(JSONType.Object, result), pos)
+
+
+def _leaf(
+    pattern: re.Pattern[bytes], node_type: JSONType
+) -> Callable[[_Buffer, int, dict[bytes, JSONNode]], tuple[JSONNode, int]]:
+    def parse(
+        src: _Buffer, pos: int, leaves: dict[bytes, JSONNode]
+    ) -> tuple[JSONNode, int]:
+        value = src.match(pattern, pos)
+        if value is None:
+            raise ValueError
+        # The first byte determines the type, so the bytes alone identify a scalar
+        node = leaves.get(value)
+        if node is None:
+            node = leaves[value] = JSONNode(node_type, value)
+        return (node, pos + len(value))
+
+    return parse
+
+
+# The first byte of a value decides which parser can match it, as their first bytes are disjoint
+_START: Final[
+    dict[
+        int,
+        Callable[[_Buffer, int, dict[bytes, JSONNode]], tuple[JSONNode, int] | _Frame],
+    ]
+] = {}
+for chars, start in (
+    (b"0123456789_.e+-", _leaf(_NUMBER_RE, JSONType.Number)),
+    (b"Nn", _leaf(_NULL_RE, JSONType.Null)),
+    (b"\"'", _leaf(_STRING_RE, JSONType.String)),
+    (b"TtFf", _leaf(_BOOL_RE, JSONType.Bool)),
+    (b"[", lambda src, pos, leaves: _list_items(src, pos + 1)),
+    (b"{", lambda src, pos, leaves: _object_items(src, pos + 1)),
+):
+    for char in chars:
+        _START[char] = start
+
+
+def _start_value(
+    src: _Buffer, pos: int, leaves: dict[bytes, JSONNode]
+) -> tuple[JSONNode, int] | _Frame:
+    """Parse a scalar at pos, or open the frame of a list or object"""
+    char = src.byte(pos)
+    if char not in _START:
+        raise ValueError
+    return _START[char](src, pos, leaves)
+
+
+def _walk(
+    src: _Buffer, pos: int, depth: int | None = None
+) -> Generator[JSONNode, None, tuple[JSONNode, int]]:
+    """
+    Parse the value at pos and return it with the offset just past it
+    With a depth, every value completed that many containers deep is yielded
+    and left out of the tree, so memory stays bounded by the largest such value.
+    """
+    stack: list[_Frame] = []
+    leaves: dict[bytes, JSONNode] = {}
+    value: tuple[JSONNode, int] | _Frame | None = _start_value(src, pos, leaves)
+    while True:
+        if isinstance(value, GeneratorType):
+            stack.append(value)
+            message = None
+        elif not stack:
+            return value
+        else:
+            message = value
+            if message is not None and len(stack) == depth:
+                yield message[0]
+                message = (None, message[1])
+                leaves.clear()
+        try:
+            pos = stack[-1].send(message)
+        except StopIteration as done:
+            stack.pop()
+            value = done.value
+            continue
+        try:
+            value = _start_value(src, pos, leaves)
         except ValueError:
-            pass
+            value = None
+
+
+def _parse(src: _Buffer, pos: int) -> tuple[JSONNode, int]:
+    """Parse the value at pos and return it with the offset just past it"""
+    try:
+        next(_walk(src, pos))
+    except StopIteration as done:
+        return done.value
+    raise AssertionError("_walk only yields with a depth")
+
+
+def parse_expression(data: bytes) -> tuple[JSONNode, bytes]:
+    node, end = _parse(_Buffer(data), 0)
+    return (node, data[end:])
+
+
+def parse_list(data: bytes) -> tuple[JSONNode, bytes]:
+    if not data.startswith(b"["):
+        raise ValueError
+    return parse_expression(data)
+
+
+def parse_object(data: bytes) -> tuple[JSONNode, bytes]:
+    if not data.startswith(b"{"):
+        raise ValueError
+    return parse_expression(data)
+
+
+def parse_stream(source: BinaryIO | Iterable[bytes]) -> JSONNode:
+    """
+    Parse the first value of a binary file object or an iterable of byte chunks,
+    e.g. requests' iter_content(). Chunks are read as needed and input after the value is not read.
+    Chunks must be the raw bytes: iter_lines() drops the line breaks between tokens.
+    """
+    node, _ = _parse(_Stream(_chunks(source)), 0)
+    return node
+
+
+def parse_file(path: str | os.PathLike) -> JSONNode:
+    """Parse the first value of the file at path, reading it in chunks"""
+    with open(path, "rb") as f:
+        return parse_stream(f)
+
 
-    return (JSONNode(JSONType.Object, result), data)
+def iter_values(
+    source: BinaryIO | Iterable[bytes], depth: int = 1
+) -> Iterator[JSONNode]:
+    """
+    Yield every value nested `depth` containers deep as soon as it is parsed, like parse_stream.
+    Depth 1 yields the items of the top level list, or the keys and values of the top level object.
+    Depth 2 yields the entries of a FHIR Bundle, among the items of its other top level values.
+    Yielded values are not kept, so a large document is never held in memory at once.
+    """
+    if depth < 1:
+        raise ValueError("depth must be at least 1")
+    yield from _walk(_Stream(_chunks(source)), 0, depth)
 
 
 if __name__ == "__main__":
-    print(parse_expression(sys.stdin.buffer.read()))
+    print(parse_stream(sys.stdin.buffer))